@@ -0,0 +1,335 @@
+import asyncio
+import socket
+import time
+
+from contextlib import suppress
+
+import heartbeat
+import metrics
+import outbound
+import protocol
+import ratelimit
+import server
+import sessions
+import tls
+
+#Before a handoff, seconds handlers get to use up what they already read,
+#and the most writers get to empty the transports' buffers
+HANDOFF_SETTLE = 0.1
+HANDOFF_DRAIN_TIMEOUT = 2.0
+
+
+class StreamClient():
+    """Socket-like adapter so Server can talk to an asyncio stream"""
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, queue: outbound.OutboundQueue,
+                 decoder: protocol.FrameDecoder, latency_budget: float=0.0):
+        self.reader = reader
+        self.writer = writer
+        self.queue = queue
+        self.decoder = decoder
+        #Seconds a message may wait for more to share its write
+        self.latency_budget = latency_budget
+        self.peername = writer.get_extra_info('peername')
+        #Kept, the server still finds the session by it after closing
+        self.fd = writer.get_extra_info('socket').fileno()
+        self.ready = asyncio.Event()
+        self.drainer = asyncio.create_task(self.drain())
+
+    def __repr__(self) -> str:
+        return f"<StreamClient peer={self.peername}>"
+
+    def close(self) -> None:
+        """Hand anything still queued to the transport and close it"""
+        self.drainer.cancel()
+        while self.queue and not self.writer.is_closing():
+            self.writer.write(self.queue.pop())
+        self.writer.close()
+
+    async def drain(self) -> None:
+        """Writer task, moves queued messages to the transport as it drains"""
+        while True:
+            await self.ready.wait()
+            #Waking up only after the current callback already lets a whole
+            #fan-out round pile up, the budget lets a burst build further
+            if self.latency_budget:
+                await asyncio.sleep(self.latency_budget)
+            self.ready.clear()
+            while self.queue:
+                #Transports have no sendmsg, writelines is their one write
+                self.writer.writelines(self.queue.pop_batch())
+                try:
+                    await self.writer.drain()
+                except ConnectionError:
+                    return
+
+    @property
+    def framed(self) -> bool:
+        return self.decoder.framed is True
+
+    @property
+    def version(self) -> int | None:
+        return self.decoder.version
+
+    def getpeername(self) -> tuple:
+        return self.peername
+
+    def kick(self) -> None:
+        """Drop the connection, the handler sees EOF and cleans up"""
+        self.queue.clear()
+        self.writer.transport.abort()
+
+    def sendall(self, data: bytes) -> None:
+        """Queue data for the writer task, never blocks the event loop"""
+        #Peer is already on its way out, disconnect_client cleans it up
+        if self.writer.is_closing():
+            return
+        if not self.queue.push(data):
+            #Slow consumer under the disconnect policy
+            self.kick()
+            return
+        self.ready.set()
+
+    def shutdown(self, how: int) -> None:
+        """Streams have no half-close here, closing covers SHUT_RDWR"""
+        self.close()
+
+    def unsent(self) -> bytes:
+        """Everything queued that the writer task hasn't taken yet"""
+        return b"".join(self.queue.items)
+
+
+async def handle_client(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter,
+                        serv: server.Server) -> None:
+    """Coroutine equivalent of chatroom.handle_client"""
+    serv.metrics.accepted.inc()
+    #Same probing accept_connection turns on for the other engines
+    with suppress(OSError):
+        heartbeat.set_keepalive(writer.get_extra_info("socket"))
+    client = StreamClient(
+        reader, writer, serv.new_outbound_queue(), serv.new_decoder(),
+        serv.write_budget
+    )
+
+    #Same admission the threaded accept loop does before spawning, ahead
+    #of the TLS handshake so a full server doesn't pay for one.
+    #Not to TLS clients, they couldn't read it.
+    try:
+        limiter = serv.admit(client.peername[0] if client.peername else "")
+    except ratelimit.Refused as e:
+        serv.reject(client, e.reason, notify=serv.tls is None)
+        return
+    session = serv.attach(client, limiter)
+
+    if serv.tls is not None:
+        try:
+            await writer.start_tls(
+                serv.tls, ssl_handshake_timeout=tls.HANDSHAKE_TIMEOUT)
+        except (OSError, ValueError) as e:
+            serv.tls_failed(e)
+            serv.disconnect_client(client, metrics.TLS_ERROR)
+            return
+        serv.tls_established(writer.get_extra_info("ssl_object"))
+
+    try:
+        serv.ask_for_username(client)
+        username = await read_username(client, serv)
+    except (OSError, protocol.FrameError) as e:
+        print(f"{serv.time_now()} Error reading username: {e}")
+        serv.disconnect_client(client)
+        return
+
+    if serv.add_client(client=client, username=username):
+        try:
+            serv.new_user_notification(client)
+            serv.send_welcome_msg(client, username)
+        except Exception as e:
+            serv.disconnect_client(client)
+            return
+    else:
+        serv.disconnect_client(client)
+        return
+
+    await read_messages(client, session, username, serv)
+
+
+def adopt(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+          serv: server.Server, state: dict
+          ) -> tuple[StreamClient, sessions.Session, str] | None:
+    """Take on a client handed over past its handshake, None if refused"""
+    client = StreamClient(
+        reader, writer, serv.new_outbound_queue(), serv.new_decoder(),
+        serv.write_budget
+    )
+    try:
+        limiter = serv.admit(client.peername[0] if client.peername else "")
+    except ratelimit.Refused as e:
+        serv.reject(client, e.reason)
+        return None
+    session = serv.attach(client, limiter)
+    return client, session, serv.resume(client, state)
+
+
+async def read_messages(client: StreamClient, session: sessions.Session,
+                        username: str, serv: server.Server) -> None:
+    """Read and dispatch a registered client's frames until it leaves"""
+    reader = client.reader
+    reason = metrics.CLOSED
+    try:
+        while True:
+            try:
+                data = await reader.read(serv.DATASIZE)
+            except ConnectionError as e:
+                print(f"{serv.time_now()} {username} - Connection Error: {e}")
+                reason = metrics.ERROR
+                break
+            except OSError as e:
+                print(f"{serv.time_now()} {username} - OS Error: {e}")
+                reason = metrics.ERROR
+                break
+
+            if not data:
+                print(f"{serv.time_now()} {username}: Connection closed.")
+                break
+            session.last_seen = time.monotonic()
+
+            client.decoder.feed(data)
+            try:
+                for kind, payload in client.decoder.frames():
+                    if kind != protocol.TEXT:
+                        serv.handle_control(client, kind, payload)
+                        continue
+                    verdict, wait = serv.limit(client, len(payload))
+                    if verdict == ratelimit.DELAY:
+                        #Only this client waits, its reads pause meanwhile
+                        await asyncio.sleep(wait)
+                    elif verdict != ratelimit.ALLOW:
+                        continue
+                    if serv.relay(client, payload):
+                        continue
+                    msg = client.decoder.decode_text(payload)
+                    print(f"{serv.time_now()} {username}: {msg}")
+
+                    #Every handler runs on the loop thread, no lock needed
+                    serv.handle_msg(client, username, msg, len(payload))
+            except protocol.FrameError as e:
+                print(f"{serv.time_now()} {username} - Frame Error: {e}")
+                reason = metrics.FRAME_ERROR
+                break
+            except ratelimit.Flooding as e:
+                print(f"{serv.time_now()} {username} - Flooding: {e}")
+                reason = metrics.RATE_LIMITED
+                break
+    finally:
+        serv.disconnect_client(client, reason)
+
+
+async def read_username(client: StreamClient, serv: server.Server) -> str:
+    """Async counterpart of Server.process_username"""
+    while True:
+        for _, payload in client.decoder.frames():
+            return serv.parse_username(client, payload)
+        data = await client.reader.read(serv.DATASIZE)
+        if not data:
+            return serv.parse_username(client, b"")
+        client.decoder.feed(data)
+
+
+async def serve(serv: server.Server,
+                inherited: list[tuple[socket.socket, dict]]=()) -> None:
+    """Serve the chatroom on the server's listening socket"""
+    async def on_connect(reader, writer):
+        try:
+            await handle_client(reader, writer, serv)
+        except asyncio.CancelledError:
+            #Shutting down, handle_client already cleaned up on the way out
+            pass
+
+    async def on_resume(client, session, username):
+        try:
+            await read_messages(client, session, username, serv)
+        except asyncio.CancelledError:
+            pass
+
+    async def hand_off(conn: socket.socket) -> None:
+        #Streams keep buffers the snapshot can't see, so reading stops
+        #and handlers and writer tasks get to finish what they hold
+        clients = [session.client for session in serv.client_map.values()]
+        for client in clients:
+            client.writer.transport.pause_reading()
+        deadline = time.monotonic() + HANDOFF_DRAIN_TIMEOUT
+        await asyncio.sleep(HANDOFF_SETTLE)
+        while time.monotonic() < deadline and any(
+                client.writer.transport.get_write_buffer_size()
+                for client in clients):
+            await asyncio.sleep(HANDOFF_SETTLE)
+        serv.hand_off(conn)
+        #Still here, the new process didn't take over
+        for client in clients:
+            client.writer.transport.resume_reading()
+
+    def on_successor() -> None:
+        conn = serv.accept_successor()
+        if conn is not None:
+            keep(loop.create_task(hand_off(conn)))
+
+    def keep(task: asyncio.Task) -> None:
+        #The loop only holds weak references to tasks
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def tick() -> None:
+        while True:
+            await asyncio.sleep(serv.timers.tick)
+            serv.check_liveness()
+
+    def on_bus() -> None:
+        try:
+            for packet in serv.bus.receive():
+                serv.deliver_remote(packet)
+        except OSError as e:
+            print(f"{serv.time_now()} Worker bus closed: {e}")
+            loop.remove_reader(serv.bus.fileno())
+
+    #Broadcasts from the other workers when running with --workers
+    loop = asyncio.get_running_loop()
+    if serv.bus is not None:
+        loop.add_reader(serv.bus.fileno(), on_bus)
+    #Heartbeats and timeouts, kept referenced so it isn't collected
+    ticker = loop.create_task(tick())
+    tasks = set()
+    if serv.handoff_sock is not None:
+        loop.add_reader(serv.handoff_sock.fileno(), on_successor)
+    #Clients handed over by the process this one replaced, all of them are
+    #back in their rooms before the first is read, or what the first ones
+    #say would miss the rest
+    streams = [(await asyncio.open_connection(sock=sock), state)
+               for sock, state in inherited]
+    adopted = [adopt(reader, writer, serv, state)
+               for (reader, writer), state in streams]
+    for resumed in filter(None, adopted):
+        keep(loop.create_task(on_resume(*resumed)))
+
+    #The socket is already bound and listening, asyncio takes it over as is
+    #and accepts up to backlog connections per wake-up. Connections come in
+    #plain, handle_client starts TLS once they're admitted.
+    aio_server = await asyncio.start_server(
+        on_connect, sock=serv.sock, backlog=serv.backlog
+    )
+    async with aio_server:
+        await aio_server.serve_forever()
+
+
+def run(serv: server.Server,
+        inherited: list[tuple[socket.socket, dict]]=()) -> None:
+    """Run the asyncio engine until interrupted"""
+    try:
+        asyncio.run(serve(serv, inherited))
+    except KeyboardInterrupt as e:
+        print("\nServer has been terminated.")
+        try:
+            serv.close_all_connections()
+        except Exception as e:
+            print(f"{serv.time_now()} Unable to close all connections: {e}")
@@ -0,0 +1,426 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from array import array
+
+import protocol
+
+ENCODING = "utf-8"
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#Every message a bench client sends starts with this, then
+#"<sender>:<monotonic ns>#" and padding up to the message size
+MARKER = b"#bench:"
+
+#Stay well under the server's listen backlog, overflowed handshakes sit
+#in SYN-ACK retransmit backoff for seconds
+CONNECT_CONCURRENCY = 8
+DRAIN_TIME = 1.0
+STARTUP_TIMEOUT = 10.0
+
+#Repeatable load shapes, same numbers on every run so results compare
+SCENARIOS = {
+    "smoke": {"clients": 50, "senders": 5, "rate": 10.0, "size": 64,
+              "duration": 5.0},
+    "chat": {"clients": 500, "senders": 50, "rate": 2.0, "size": 128,
+             "duration": 10.0},
+    "fanout": {"clients": 1000, "senders": 2, "rate": 20.0, "size": 256,
+               "duration": 10.0},
+    "idle": {"clients": 2000, "senders": 1, "rate": 1.0, "size": 32,
+             "duration": 10.0},
+}
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list[int], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+
+def raise_fd_limit() -> None:
+    """Thousands of sockets need more than the usual 1024 descriptors"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def server_rss(pid: int) -> tuple[int, int]:
+    """Current and peak RSS in bytes of pid plus its direct children"""
+    pids = [pid]
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        pids += [int(child) for child in f.read().split()]
+    rss = peak = 0
+    for p in pids:
+        with open(f"/proc/{p}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss += int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak += int(line.split()[1]) * 1024
+    return rss, peak
+
+
+class BenchClient():
+    """One simulated chat user speaking the client.py protocol"""
+
+    def __init__(self, name: str, compress: bool=False):
+        self.name = name
+        self.magic = protocol.MAGIC_ZLIB if compress else protocol.MAGIC_UTF8
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.decoder = protocol.FrameDecoder(version=protocol.FRAMED_UTF8)
+
+    async def connect(self, host: str, port: int) -> None:
+        """Connect and finish the username handshake"""
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        #The username prompt is the only raw text the server sends
+        await self.reader.read(protocol.INITIAL_BUFFER)
+        self.writer.write(self.magic + protocol.encode_frame(
+            self.name.encode(ENCODING)))
+        await self.writer.drain()
+
+    async def receive(self, latencies: array, counts: dict) -> None:
+        """Record the fan-out latency of every bench message received"""
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            now = time.monotonic_ns()
+            counts["bytes"] += len(data)
+            self.decoder.feed(data)
+            for kind, payload in self.decoder.frames():
+                #Idle receivers would otherwise be dropped on long runs
+                if kind == protocol.PING:
+                    self.writer.write(protocol.encode_frame(payload,
+                                                            protocol.PONG))
+                    continue
+                if kind == protocol.ZTEXT:
+                    body = protocol.decompress(payload)
+                else:
+                    body = bytes(payload)
+                start = body.find(MARKER)
+                if start < 0:
+                    continue
+                start += len(MARKER)
+                end = body.index(b"#", start)
+                _, sent_ns = body[start:end].split(b":")
+                latencies.append(now - int(sent_ns))
+                counts["received"] += 1
+
+    async def send(self, index: int, rate: float, size: int,
+                   duration: float, counts: dict) -> None:
+        """Send at a fixed rate, each message stamped with its send time"""
+        interval = 1.0 / rate
+        start = time.monotonic()
+        sent = 0
+        while time.monotonic() - start < duration:
+            body = MARKER + f"{index}:{time.monotonic_ns()}#".encode()
+            body += b"x" * max(0, size - len(body))
+            self.writer.write(protocol.encode_frame(body))
+            await self.writer.drain()
+            sent += 1
+            counts["sent"] += 1
+            delay = start + sent * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def run_shard_async(opts: dict, first: int, count: int,
+                          ready: multiprocessing.Queue,
+                          go: multiprocessing.Event) -> dict:
+    """Drive clients first..first+count of the run from this process"""
+    latencies = array("q")
+    counts = {"sent": 0, "received": 0, "failed": 0, "bytes": 0}
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    clients = [BenchClient(f"bench{i}", opts["compress"])
+               for i in range(first, first + count)]
+
+    async def connect(client: BenchClient) -> bool:
+        async with limit:
+            try:
+                await client.connect(opts["host"], opts["port"])
+                return True
+            except OSError:
+                counts["failed"] += 1
+                return False
+
+    connected = await asyncio.gather(*(connect(c) for c in clients))
+    clients = [c for c, ok in zip(clients, connected) if ok]
+    receivers = [
+        asyncio.create_task(c.receive(latencies, counts)) for c in clients
+    ]
+
+    ready.put(len(clients))
+    while not go.is_set():
+        await asyncio.sleep(0.01)
+
+    #Senders are the clients with the lowest global index
+    senders = [
+        c.send(first + i, opts["rate"], opts["size"], opts["duration"], counts)
+        for i, c in enumerate(clients) if first + i < opts["senders"]
+    ]
+    await asyncio.gather(*senders)
+    await asyncio.sleep(DRAIN_TIME)
+
+    for task in receivers:
+        task.cancel()
+    for client in clients:
+        client.close()
+    counts["latencies"] = latencies.tobytes()
+    return counts
+
+
+def run_shard(opts: dict, first: int, count: int,
+              ready: multiprocessing.Queue, go: multiprocessing.Event,
+              results: multiprocessing.Queue) -> None:
+    """Entry point of one load generator process"""
+    raise_fd_limit()
+    results.put(asyncio.run(run_shard_async(opts, first, count, ready, go)))
+
+
+def start_server(opts: dict) -> subprocess.Popen:
+    """Launch chatroom.py and wait until it accepts connections"""
+    #Its logs go to a scratch directory, not next to the sources
+    workdir = tempfile.TemporaryDirectory(prefix="chatroom-bench-")
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "chatroom.py"),
+         "-a", opts["host"], "-p", str(opts["port"]), "-e", opts["engine"],
+         "-w", str(opts["server_workers"]),
+         "--max-clients", str(opts["clients"] + 1),
+         "--max-host-clients", "0",
+         "--log-sample-rate", "0",
+         #Every simulated client shares one address and sends on schedule
+         "--rate-limit", "0", "--byte-limit", "0",
+         "--host-rate-limit", "0", "--host-byte-limit", "0"]
+        + (["--relay"] if opts["relay"] else []),
+        cwd=workdir.name, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    #Removed once the server has exited
+    proc.workdir = workdir
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((opts["host"], opts["port"])):
+                return proc
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    proc.kill()
+    proc.wait()
+    workdir.cleanup()
+    raise RuntimeError("Server did not start listening in time")
+
+
+def run_scenario(opts: dict) -> dict:
+    """Run one scenario against one engine and summarize the results"""
+    server = start_server(opts) if opts["spawn"] else None
+    context = multiprocessing.get_context("fork")
+    ready, results, go = context.Queue(), context.Queue(), context.Event()
+    shards = []
+    per_shard = -(-opts["clients"] // opts["procs"])
+    for first in range(0, opts["clients"], per_shard):
+        count = min(per_shard, opts["clients"] - first)
+        shard = context.Process(
+            target=run_shard, args=(opts, first, count, ready, go, results)
+        )
+        shard.start()
+        shards.append(shard)
+
+    try:
+        connected = sum(ready.get() for _ in shards)
+        idle_rss = server_rss(server.pid)[0] if server else 0
+        started = time.monotonic()
+        go.set()
+        shard_results = [results.get() for _ in shards]
+        elapsed = time.monotonic() - started - DRAIN_TIME
+        rss, peak_rss = server_rss(server.pid) if server else (0, 0)
+    finally:
+        for shard in shards:
+            shard.join()
+        if server is not None:
+            server.terminate()
+            server.wait()
+            server.workdir.cleanup()
+
+    latencies = array("q")
+    sent = received = failed = received_bytes = 0
+    for result in shard_results:
+        latencies.frombytes(result["latencies"])
+        sent += result["sent"]
+        received += result["received"]
+        failed += result["failed"]
+        received_bytes += result["bytes"]
+    ordered = sorted(latencies)
+    expected = sent * (connected - 1)
+    return {
+        "scenario": opts["scenario"],
+        "engine": opts["engine"],
+        "clients": connected,
+        "failed_connects": failed,
+        "sent": sent,
+        "delivered": received,
+        "delivery_ratio": received / expected if expected else 0.0,
+        "sent_per_sec": sent / elapsed,
+        "delivered_per_sec": received / elapsed,
+        "received_mb": received_bytes / 2**20,
+        "p50_ms": percentile(ordered, 0.50) / 1e6,
+        "p99_ms": percentile(ordered, 0.99) / 1e6,
+        "p999_ms": percentile(ordered, 0.999) / 1e6,
+        "idle_rss_mb": idle_rss / 2**20,
+        "rss_mb": rss / 2**20,
+        "peak_rss_mb": peak_rss / 2**20,
+    }
+
+
+def check_gates(result: dict, args: argparse.Namespace) -> list[str]:
+    """Regression gates that failed for result, empty when all pass"""
+    failures = []
+    if args.max_p99_ms is not None and result["p99_ms"] > args.max_p99_ms:
+        failures.append(f"p99 {result['p99_ms']:.2f} ms > {args.max_p99_ms}")
+    if (args.min_delivered is not None
+            and result["delivered_per_sec"] < args.min_delivered):
+        failures.append(
+            f"delivered {result['delivered_per_sec']:.0f}/s < "
+            f"{args.min_delivered}")
+    if (args.max_rss_mb is not None
+            and result["peak_rss_mb"] > args.max_rss_mb):
+        failures.append(
+            f"peak RSS {result['peak_rss_mb']:.1f} MB > {args.max_rss_mb}")
+    if (args.min_delivery_ratio is not None
+            and result["delivery_ratio"] < args.min_delivery_ratio):
+        failures.append(
+            f"delivery ratio {result['delivery_ratio']:.3f} < "
+            f"{args.min_delivery_ratio}")
+    return failures
+
+
+def print_result(result: dict) -> None:
+    print(
+        f"{result['scenario']:>7} {result['engine']:>8} "
+        f"clients={result['clients']} sent={result['sent']} "
+        f"delivered={result['delivered']} "
+        f"({result['delivery_ratio']:.1%}) "
+        f"{result['delivered_per_sec']:.0f} msg/s out, "
+        f"{result['received_mb']:.1f}MB received, "
+        f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms "
+        f"p999={result['p999_ms']:.2f}ms "
+        f"rss={result['rss_mb']:.1f}MB (idle {result['idle_rss_mb']:.1f}MB, "
+        f"peak {result['peak_rss_mb']:.1f}MB)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chatroom Load Generator")
+    parser.add_argument(
+        "-s", "--scenario", dest="scenario", type=str, default="smoke",
+        choices=SCENARIOS,
+        help="Load shape to run (Default: smoke)"
+    )
+    parser.add_argument(
+        "-e", "--engine", dest="engines", action="append",
+        choices=("threaded", "asyncio", "reactor"),
+        help="Server engine to bench, repeatable (Default: all of them)"
+    )
+    parser.add_argument(
+        "-a", "--addr", dest="addr", type=str, default="127.0.0.1",
+        help="Address of the server (Default: localhost)"
+    )
+    parser.add_argument(
+        "-p", "--port", dest="port", type=int, default=None,
+        help="Bench an already running server on this port instead of"
+        " starting one"
+    )
+    parser.add_argument(
+        "-w", "--server-workers", dest="server_workers", type=int, default=1,
+        help="--workers passed to the spawned server (Default: 1)"
+    )
+    parser.add_argument(
+        "--relay", dest="relay", action="store_true",
+        help="Run the spawned server in relay mode"
+    )
+    parser.add_argument(
+        "--compress", dest="compress", action="store_true",
+        help="Have the clients ask for compressed chat"
+    )
+    parser.add_argument(
+        "--procs", dest="procs", type=int, default=1,
+        help="Load generator processes (Default: 1)"
+    )
+    for key in ("clients", "senders", "rate", "size", "duration"):
+        parser.add_argument(
+            f"--{key}", dest=key, type=type(SCENARIOS["smoke"][key]),
+            default=None, help=f"Override the scenario's {key}"
+        )
+    parser.add_argument(
+        "--max-p99-ms", dest="max_p99_ms", type=float, default=None,
+        help="Fail if p99 fan-out latency is above this"
+    )
+    parser.add_argument(
+        "--min-delivered", dest="min_delivered", type=float, default=None,
+        help="Fail if fewer messages per second are delivered"
+    )
+    parser.add_argument(
+        "--max-rss-mb", dest="max_rss_mb", type=float, default=None,
+        help="Fail if the server's peak RSS is above this"
+    )
+    parser.add_argument(
+        "--min-delivery-ratio", dest="min_delivery_ratio", type=float,
+        default=None, help="Fail if less of the expected fan-out arrives"
+    )
+    parser.add_argument(
+        "--json", dest="json", action="store_true",
+        help="Print one JSON object per result instead of a summary line"
+    )
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    failed = False
+    for engine in args.engines or ["threaded", "asyncio", "reactor"]:
+        opts = dict(SCENARIOS[args.scenario])
+        for key in opts:
+            if getattr(args, key) is not None:
+                opts[key] = getattr(args, key)
+        opts.update(
+            scenario=args.scenario, engine=engine, host=args.addr,
+            port=args.port or free_port(), spawn=args.port is None,
+            server_workers=args.server_workers, relay=args.relay,
+            compress=args.compress,
+            procs=max(1, min(args.procs, opts["clients"]))
+        )
+        result = run_scenario(opts)
+        failures = check_gates(result, args)
+        result["gate_failures"] = failures
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_result(result)
+            for failure in failures:
+                print(f"  GATE FAILED: {failure}")
+        failed = failed or bool(failures)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
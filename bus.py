@@ -0,0 +1,197 @@
+import selectors
+import socket
+import struct
+
+from collections import deque
+
+#Largest packet a worker publishes, a framed chat line fits comfortably
+MAX_PACKET = 128 * 1024
+
+#Every packet is a kind byte and a room name length, then the room name
+#and the body. An empty room name means every room.
+HEADER = struct.Struct("!BB")
+
+#Packet kinds
+MESSAGE = 0
+ROOM_CREATED = 1
+#A chat line, delivered like MESSAGE and also kept in the room's history
+CHAT = 2
+#The room emptied out on the publishing worker
+ROOM_REMOVED = 3
+#A user took or gave up a name on the publishing worker. These carry the
+#name's key in place of a room name and the worker's index as the body.
+NAME_CLAIMED = 4
+NAME_RELEASED = 5
+#Sent by the hub when a worker's end closes, the body is its index
+WORKER_EXITED = 6
+#Kinds that change what the workers know about each other. Chat can be
+#dropped when a worker falls behind, these can't.
+CONTROL = frozenset(
+    (ROOM_CREATED, ROOM_REMOVED, NAME_CLAIMED, NAME_RELEASED, WORKER_EXITED)
+)
+
+
+class Bus():
+    """Worker end of the inter-process broadcast bus"""
+
+    def __init__(self, sock: socket.socket, index: int=0):
+        self.sock = sock
+        self.sock.setblocking(False)
+        #Which worker this is, the lower one wins a name claimed twice
+        self.index = index
+        #Packets the hub was too backed up to take, on the metrics endpoint
+        self.dropped = 0
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def publish(self, data: bytes, room: str="", kind: int=MESSAGE) -> None:
+        """Hand a packet to the hub, chat is dropped if the hub is backed up"""
+        name = room.encode()
+        packet = [HEADER.pack(kind, len(name)), name, data]
+        while True:
+            try:
+                self.sock.sendmsg(packet)
+                return
+            except BlockingIOError:
+                if kind not in CONTROL:
+                    self.dropped += 1
+                    return
+            #The hub never waits on a worker, it drains this soon
+            self.wait(selectors.EVENT_WRITE)
+
+    def receive(self) -> list[tuple[int, str, bytes]]:
+        """Every (kind, room, body) waiting right now, empty once drained"""
+        packets = []
+        while True:
+            try:
+                data = self.sock.recv(MAX_PACKET)
+            except BlockingIOError:
+                return packets
+            if not data:
+                raise ConnectionError("Bus hub has gone away")
+            kind, name_size = HEADER.unpack_from(data)
+            body_start = HEADER.size + name_size
+            room = data[HEADER.size:body_start].decode()
+            packets.append((kind, room, data[body_start:]))
+
+    def wait(self, events: int=selectors.EVENT_READ) -> None:
+        """Block until the hub has something for this worker, or room"""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, events)
+            selector.select()
+
+
+class BusHub():
+    """Relays every packet one worker publishes to all the other workers"""
+
+    def __init__(self, workers: int):
+        #SOCK_SEQPACKET keeps message boundaries, no framing needed
+        self.pairs = [
+            socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            for _ in range(workers)
+        ]
+        self.dropped = 0
+        #Hub end of every worker still running -> that worker's index
+        self.live: dict[socket.socket, int] = {}
+        #Control packets a worker wasn't ready for, sent when it is
+        self.backlog: dict[socket.socket, deque[bytes]] = {}
+        #Made by run_forever, after the workers have forked
+        self.selector: selectors.BaseSelector | None = None
+
+    def close_worker_ends(self) -> None:
+        """Parent side, the workers own their ends after the fork"""
+        for _, worker_end in self.pairs:
+            worker_end.close()
+
+    def drop(self) -> None:
+        self.dropped += 1
+        #Reported at doubling totals, a stuck worker would otherwise flood
+        #the output
+        if self.dropped & (self.dropped - 1) == 0:
+            print(f"Bus hub has dropped {self.dropped} packets")
+
+    def flush(self, hub_end: socket.socket) -> None:
+        """Send the control packets hub_end's worker is owed, in order"""
+        backlog = self.backlog[hub_end]
+        while backlog:
+            try:
+                hub_end.send(backlog[0])
+            except BlockingIOError:
+                return
+            except ConnectionError:
+                #Exiting, its end closing is handled on the read side
+                backlog.clear()
+                break
+            backlog.popleft()
+        self.selector.modify(hub_end, selectors.EVENT_READ)
+
+    def forward(self, data: bytes, source: socket.socket | None) -> None:
+        """Send data to every worker but source"""
+        control = data[0] in CONTROL
+        for hub_end in self.live:
+            if hub_end is source:
+                continue
+            backlog = self.backlog[hub_end]
+            #Nothing overtakes a control packet that's still waiting
+            if backlog:
+                if control:
+                    backlog.append(data)
+                else:
+                    self.drop()
+                continue
+            try:
+                hub_end.send(data)
+            except BlockingIOError:
+                if not control:
+                    self.drop()
+                    continue
+                backlog.append(data)
+                self.selector.modify(
+                    hub_end, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            except ConnectionError:
+                self.drop()
+
+    def run_forever(self) -> None:
+        """Relay packets between workers until interrupted"""
+        self.selector = selectors.DefaultSelector()
+        for index, (hub_end, _) in enumerate(self.pairs):
+            hub_end.setblocking(False)
+            self.live[hub_end] = index
+            self.backlog[hub_end] = deque()
+            self.selector.register(hub_end, selectors.EVENT_READ)
+        while True:
+            for key, events in self.selector.select():
+                if events & selectors.EVENT_WRITE:
+                    self.flush(key.fileobj)
+                if events & selectors.EVENT_READ:
+                    self.relay(key.fileobj)
+
+    def relay(self, source: socket.socket) -> None:
+        """Forward everything source has published to the other workers"""
+        while source in self.live:
+            try:
+                data = source.recv(MAX_PACKET)
+            except BlockingIOError:
+                return
+            if data:
+                self.forward(data, source)
+                continue
+            #Worker exited, the others forget the names it held
+            self.selector.unregister(source)
+            index = self.live.pop(source)
+            del self.backlog[source]
+            source.close()
+            body = str(index).encode()
+            self.forward(HEADER.pack(WORKER_EXITED, 0) + body, None)
+
+    def worker_bus(self, index: int) -> Bus:
+        """Child side, keep only this worker's end of the bus"""
+        for i, (hub_end, worker_end) in enumerate(self.pairs):
+            hub_end.close()
+            if i != index:
+                worker_end.close()
+        return Bus(self.pairs[index][1], index)
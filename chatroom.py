@@ -1,66 +1,114 @@
 import argparse
+import multiprocessing
+import os
+import selectors
+import signal
 import socket
+import ssl
 import sys
 import threading
+import time
+import async_engine
+import bus
+import handoff
+import metrics
+import outbound
+import protocol
+import ratelimit
+import reactor_engine
 import server
+import tls
 
-CLIENTS_LOCK = threading.Lock()
+ENGINES = ("threaded", "asyncio", "reactor")
+WORKER_GRACE_PERIOD = 0.5
+WORKER_JOIN_TIMEOUT = 5
 
-def handle_client(client: socket.socket, serv: server.Server) -> None:
-    serv.ask_for_username(client)
-    username = serv.process_username(client)
-
-    with CLIENTS_LOCK:
-        client_added = serv.add_client(client=client, username=username)
+def handle_client(client: socket.socket, serv: server.Server,
+                  limiter: ratelimit.Limiter) -> None:
+    #Set once there's a session for disconnect_client to end, before that
+    #a failed TLS handshake has already given the slot back
+    session = None
+    reason = metrics.CLOSED
+    try:
+        #The handshake happens on this client's thread, a slow one only
+        #ever holds up itself
+        if serv.tls is not None:
+            client = serv.start_tls(client, limiter)
+            if client is None:
+                return
+        #Writes to this client go through its own bounded queue and writer
+        client = outbound.QueuedConnection(
+            client, serv.new_outbound_queue(), serv.new_decoder(),
+            serv.write_budget
+        )
+        session = serv.attach(client, limiter)
+        try:
+            serv.ask_for_username(client)
+            username = serv.process_username(client)
+        except (OSError, protocol.FrameError) as e:
+            print(f"{serv.time_now()} Error reading username: {e}")
+            return
 
-    if client_added:
+        #The server guards its own registry, readers work off snapshots
+        if not serv.add_client(client=client, username=username):
+            return
         try:
-            with CLIENTS_LOCK:
-                serv.new_user_notification(client)
-                serv.send_welcome_msg(client, username)
+            serv.new_user_notification(client)
+            serv.send_welcome_msg(client, username)
         except Exception as e:
-            with CLIENTS_LOCK:
-                serv.disconnect_client(client)
-    else:
-        with CLIENTS_LOCK:
-            serv.disconnect_client(client)
-        return
-    
-    try:
+            return
+
         while True:
             try:
-                data = client.recv(serv.DATASIZE)
+                received = client.decoder.recv_into(client)
             except ConnectionError as e:
                 print(f"{serv.time_now()} {username} - Connection Error: {e}")
+                reason = metrics.ERROR
                 break
             except OSError as e:
                 print(f"{serv.time_now()} {username} - OS Error: {e}")
+                reason = metrics.ERROR
                 break
 
-            if not data:
+            if not received:
                 print(f"{serv.time_now()} {username}: Connection closed.")
                 break
+            session.last_seen = time.monotonic()
 
             try:
-                msg = data.decode(serv.ENCODING)
-            except OSError as e:
-                print(f"{serv.time_now()} {username} - Error decoding: {e}")
-            print(f"{serv.time_now()} {username}: {msg}") #Logging here maybe?
-
-            #Now we must broadcast to other clients
-            with CLIENTS_LOCK:
-                targets = dict(serv.client_map)
-            for conn, u_name in targets.items():
-                if conn is not client:
-                    try:
-                        data = f"{serv.time_now()} {username}: {msg}".encode(
-                            serv.ENCODING)
-                        conn.sendall(data)
-                    except OSError as e:
-                        print(f"{serv.time_now()} {u_name} - Error sending: {e}")
-                        serv.disconnect_client(conn)
+                for kind, payload in client.decoder.frames():
+                    #Disconnected by the heartbeat or the bus meanwhile, the
+                    #rest of what it sent goes with it
+                    if serv.session(client) is not session:
+                        break
+                    if kind != protocol.TEXT:
+                        serv.handle_control(client, kind, payload)
+                        continue
+                    verdict, wait = serv.limit(client, len(payload))
+                    if verdict == ratelimit.DELAY:
+                        time.sleep(wait)
+                    elif verdict != ratelimit.ALLOW:
+                        continue
+                    if serv.relay(client, payload):
+                        continue
+                    msg = client.decoder.decode_text(payload)
+                    print(f"{serv.time_now()} {username}: {msg}")
+
+                    #Now we must broadcast to other clients
+                    serv.handle_msg(client, username, msg, len(payload))
+            except protocol.FrameError as e:
+                print(f"{serv.time_now()} {username} - Frame Error: {e}")
+                reason = metrics.FRAME_ERROR
+                break
+            except ratelimit.Flooding as e:
+                print(f"{serv.time_now()} {username} - Flooding: {e}")
+                reason = metrics.RATE_LIMITED
+                break
+            if serv.session(client) is not session:
+                break
     finally:
-        serv.disconnect_client(client)
+        if session is not None:
+            serv.disconnect_client(client, reason)
 
 def main():
     parser = argparse.ArgumentParser(description="Chatroom Server")
@@ -75,48 +123,388 @@ def main():
         help="Port to listen for client connections (Default: 8080)"
     )
 
-    
+    parser.add_argument(
+        "-e", "--engine", dest="engine", type=str, default="threaded",
+        choices=ENGINES,
+        help="Server engine to run the chatroom on (Default: threaded)"
+    )
+
+    parser.add_argument(
+        "--max-clients", dest="max_clients", type=int,
+        default=server.Server.MAX_CLIENTS,
+        help="Most clients connected at once, also the capacity of the lobby"
+        f" every client joins first (Default: {server.Server.MAX_CLIENTS})"
+    )
+
+    parser.add_argument(
+        "--max-host-clients", dest="max_host_clients", type=int,
+        default=server.Server.MAX_HOST_CLIENTS,
+        help="Most clients connected at once from one address, 0 for no"
+        f" limit (Default: {server.Server.MAX_HOST_CLIENTS})"
+    )
+
+    parser.add_argument(
+        "--backlog", dest="backlog", type=int,
+        default=server.Server.BACKLOG,
+        help="Connections the kernel queues before they're accepted, capped"
+        f" by net.core.somaxconn (Default: {server.Server.BACKLOG})"
+    )
+
+    parser.add_argument(
+        "--heartbeat-interval", dest="heartbeat_interval", type=float,
+        default=server.Server.HEARTBEAT_INTERVAL,
+        help="Seconds of silence before a framed client is pinged, 0 turns"
+        f" pings off (Default: {server.Server.HEARTBEAT_INTERVAL:g})"
+    )
+
+    parser.add_argument(
+        "--heartbeat-timeout", dest="heartbeat_timeout", type=float,
+        default=server.Server.HEARTBEAT_TIMEOUT,
+        help="Seconds of silence, pongs included, before a framed client is"
+        " dropped as dead, 0 for never"
+        f" (Default: {server.Server.HEARTBEAT_TIMEOUT:g})"
+    )
+
+    parser.add_argument(
+        "--idle-timeout", dest="idle_timeout", type=float,
+        default=server.Server.IDLE_TIMEOUT,
+        help="Seconds of silence before a raw client, which can't be pinged,"
+        f" is dropped, 0 for never (Default: {server.Server.IDLE_TIMEOUT:g})"
+    )
+
+    parser.add_argument(
+        "--history-size", dest="history_size", type=int,
+        default=server.Server.HISTORY_SIZE,
+        help="Recent messages each room replays to new members, 0 turns"
+        f" history off (Default: {server.Server.HISTORY_SIZE})"
+    )
+
+    parser.add_argument(
+        "--queue-size", dest="queue_size", type=int,
+        default=server.Server.OUTBOUND_QUEUE_SIZE,
+        help="Messages buffered per client before the overflow policy applies"
+        f" (Default: {server.Server.OUTBOUND_QUEUE_SIZE})"
+    )
+
+    parser.add_argument(
+        "--overflow-policy", dest="overflow_policy", type=str,
+        default=server.Server.OVERFLOW_POLICY,
+        choices=outbound.OVERFLOW_POLICIES,
+        help="What to do when a client's outbound queue is full"
+        f" (Default: {server.Server.OVERFLOW_POLICY})"
+    )
+
+    parser.add_argument(
+        "--write-budget-ms", dest="write_budget_ms", type=float,
+        default=server.Server.WRITE_LATENCY_BUDGET * 1000,
+        help="Milliseconds a message may wait for others to share its write"
+        f" (Default: {server.Server.WRITE_LATENCY_BUDGET * 1000:g})"
+    )
+
+    parser.add_argument(
+        "--rate-limit", dest="message_rate", type=float,
+        default=server.Server.MESSAGE_RATE,
+        help="Messages a second each client may send, 0 for no limit"
+        f" (Default: {server.Server.MESSAGE_RATE:g})"
+    )
+
+    parser.add_argument(
+        "--byte-limit", dest="byte_rate", type=float,
+        default=server.Server.BYTE_RATE,
+        help="Message bytes a second each client may send, 0 for no limit"
+        f" (Default: {server.Server.BYTE_RATE})"
+    )
+
+    parser.add_argument(
+        "--host-rate-limit", dest="host_message_rate", type=float,
+        default=server.Server.HOST_MESSAGE_RATE,
+        help="Messages a second all clients from one address may send"
+        " together, 0 for no limit"
+        f" (Default: {server.Server.HOST_MESSAGE_RATE:g})"
+    )
+
+    parser.add_argument(
+        "--host-byte-limit", dest="host_byte_rate", type=float,
+        default=server.Server.HOST_BYTE_RATE,
+        help="Message bytes a second all clients from one address may send"
+        f" together, 0 for no limit (Default: {server.Server.HOST_BYTE_RATE})"
+    )
+
+    parser.add_argument(
+        "--rate-action", dest="rate_action", type=str,
+        default=server.Server.RATE_ACTION, choices=ratelimit.RATE_ACTIONS,
+        help="What happens to a client over a rate limit"
+        f" (Default: {server.Server.RATE_ACTION})"
+    )
+
+    parser.add_argument(
+        "--relay", dest="relay", action="store_true",
+        help="Forward chat lines from UTF-8 clients without decoding them,"
+        " the server log no longer shows their text"
+    )
+
+    parser.add_argument(
+        "--compression-level", dest="compression_level", type=int,
+        default=server.Server.COMPRESSION_LEVEL,
+        help="zlib level (0-9) lines to clients that ask for compression are"
+        " deflated at, each once per room, 0 sends them uncompressed"
+        f" (Default: {server.Server.COMPRESSION_LEVEL})"
+    )
+
+    parser.add_argument(
+        "--log-sample-rate", dest="log_sample_rate", type=float,
+        default=server.Server.LOG_SAMPLE_RATE,
+        help="Fraction (0.0-1.0) of per-recipient \"Sent\" lines to log"
+        f" (Default: {server.Server.LOG_SAMPLE_RATE})"
+    )
+
+    parser.add_argument(
+        "--log-max-bytes", dest="log_max_bytes", type=int,
+        default=server.Server.LOG_MAX_BYTES,
+        help="Size at which server.log is rotated"
+        f" (Default: {server.Server.LOG_MAX_BYTES})"
+    )
+
+    parser.add_argument(
+        "--store-dir", dest="store_dir", type=str, default=None,
+        help="Keep every chat line in an append-only log in this directory,"
+        " each worker uses its own subdirectory (Default: off)"
+    )
+
+    parser.add_argument(
+        "--metrics-port", dest="metrics_port", type=int, default=None,
+        help="Serve Prometheus metrics on http://addr:port/metrics, each"
+        " worker uses port + its index (Default: off)"
+    )
+
+    parser.add_argument(
+        "-w", "--workers", dest="workers", type=int, default=1,
+        help="Server processes sharing the port through SO_REUSEPORT"
+        " (Default: 1)"
+    )
+
+    parser.add_argument(
+        "--tls-cert", dest="tls_cert", type=str, default=None,
+        help="PEM certificate chain, clients connect over TLS when given"
+        " (Default: off)"
+    )
+
+    parser.add_argument(
+        "--tls-key", dest="tls_key", type=str, default=None,
+        help="PEM private key of --tls-cert (Default: read from --tls-cert)"
+    )
+
+    parser.add_argument(
+        "--handoff", dest="handoff", type=str, default=None,
+        help="Unix socket a restarted server takes this one's port and"
+        " connected clients over through, start the new one with the same"
+        " path. Needs the asyncio or reactor engine (Default: off)"
+    )
+
     args = parser.parse_args()
+
+    #Threaded readers sit in recv and can't be stopped without closing
+    #their connections, so they have no consistent state to hand over
+    if args.handoff is not None and args.engine == "threaded":
+        parser.error("--handoff needs the asyncio or reactor engine")
+    if args.handoff is not None and args.workers > 1:
+        parser.error("--handoff can't be used with --workers")
+    #Connections' TLS state stays inside this process's OpenSSL
+    if args.handoff is not None and args.tls_cert is not None:
+        parser.error("--handoff can't be used with --tls-cert")
+    if args.tls_key is not None and args.tls_cert is None:
+        parser.error("--tls-key needs --tls-cert")
+
+    #Made before the workers fork so they share its session ticket keys,
+    #a reconnect resumes on whichever worker it lands on
+    tls_context = None
+    if args.tls_cert is not None:
+        try:
+            tls_context = tls.server_context(args.tls_cert, args.tls_key)
+        except OSError as e:
+            parser.error(f"Unable to load the TLS certificate: {e}")
+
+    if args.workers > 1:
+        run_workers(args, tls_context)
+    else:
+        serve(args, metrics_port=args.metrics_port,
+              store_dir=args.store_dir, tls_context=tls_context)
+
+def serve(args: argparse.Namespace, worker_bus: bus.Bus | None=None,
+          log_file: str | None=None, metrics_port: int | None=None,
+          store_dir: str | None=None,
+          tls_context: ssl.SSLContext | None=None) -> None:
+    """Create the server and run the chosen engine on it"""
     HOST = args.addr
     PORT = args.port
 
+    #A server already running with the same --handoff path passes over its
+    #port and clients, nobody has to reconnect
+    listener, state, inherited = None, None, []
+    if args.handoff is not None:
+        try:
+            taken_over = handoff.take_over(args.handoff)
+        except Exception as e:
+            print(f"Unable to take over from the running server: {e}")
+            sys.exit(1)
+        if taken_over is not None:
+            listener, state, inherited = taken_over
+
     try:
-        serv = server.Server(host=HOST, port=PORT)
+        serv = server.Server(
+            host=HOST, port=PORT,
+            max_clients=args.max_clients,
+            max_host_clients=args.max_host_clients,
+            backlog=args.backlog,
+            history_size=args.history_size,
+            queue_size=args.queue_size,
+            overflow_policy=args.overflow_policy,
+            log_sample_rate=args.log_sample_rate,
+            log_max_bytes=args.log_max_bytes,
+            log_file=log_file,
+            store_dir=store_dir,
+            write_budget=args.write_budget_ms / 1000,
+            message_rate=args.message_rate,
+            byte_rate=args.byte_rate,
+            host_message_rate=args.host_message_rate,
+            host_byte_rate=args.host_byte_rate,
+            rate_action=args.rate_action,
+            heartbeat_interval=args.heartbeat_interval,
+            heartbeat_timeout=args.heartbeat_timeout,
+            idle_timeout=args.idle_timeout,
+            relay=args.relay,
+            compression_level=args.compression_level,
+            reuse_port=worker_bus is not None,
+            bus=worker_bus,
+            sock=listener,
+            handoff_path=args.handoff,
+            tls=tls_context
+        )
     except Exception as e:
         print(f"Unable to create the server: {e}")
         sys.exit(1)
+    if state is not None:
+        serv.restore(state)
+        print(f"{serv.time_now()} Took over {len(inherited)} clients")
 
     serv.listen_for_connections()
-    
-    #Create separate threads for each client that connects
+    metrics_server = None
+    if metrics_port is not None:
+        try:
+            metrics_server = metrics.serve(serv.metrics, HOST, metrics_port)
+        except OSError as e:
+            print(f"{serv.time_now()} Unable to serve metrics: {e}")
+
+    try:
+        if args.engine == "asyncio":
+            async_engine.run(serv, inherited)
+        elif args.engine == "reactor":
+            reactor_engine.run(serv, inherited)
+        else:
+            run_threaded(serv)
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        serv.sock.close()
+        serv.close_store()
+        serv.close_logger()
+
+def run_worker(args: argparse.Namespace, hub: bus.BusHub, index: int,
+               tls_context: ssl.SSLContext | None=None) -> None:
+    """Entry point of one worker process"""
+    serve(args, worker_bus=hub.worker_bus(index),
+          log_file=f"server-{index}.log",
+          metrics_port=(
+              args.metrics_port + index if args.metrics_port is not None
+              else None
+          ),
+          store_dir=(
+              os.path.join(args.store_dir, f"worker-{index}")
+              if args.store_dir is not None else None
+          ),
+          tls_context=tls_context)
+
+def run_workers(args: argparse.Namespace,
+                tls_context: ssl.SSLContext | None=None) -> None:
+    """Fork the workers and relay broadcasts between them"""
+    hub = bus.BusHub(args.workers)
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=run_worker,
+                        args=(args, hub, index, tls_context))
+        for index in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    hub.close_worker_ends()
+
+    try:
+        hub.run_forever()
+    except KeyboardInterrupt as e:
+        pass
+    finally:
+        #A terminal Ctrl-C reaches the workers too, anyone still running
+        #after the grace period gets its own SIGINT, then SIGTERM
+        for worker in workers:
+            worker.join(timeout=WORKER_GRACE_PERIOD)
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+                worker.join(timeout=WORKER_JOIN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
+def relay_bus(serv: server.Server) -> None:
+    """Deliver broadcasts published by the other workers"""
     try:
         while True:
-            client, _, _ = serv.accept_connection()
-            with CLIENTS_LOCK:
-                server_has_room = serv.is_there_room()
-            if server_has_room:
-                #If client added, we need to create a thread to handle the work
+            serv.bus.wait()
+            for packet in serv.bus.receive():
+                serv.deliver_remote(packet)
+    except OSError as e:
+        print(f"{serv.time_now()} Worker bus closed: {e}")
+
+def run_threaded(serv: server.Server) -> None:
+    """Accept loop for the thread-per-client engine"""
+    if serv.bus is not None:
+        threading.Thread(target=relay_bus, args=(serv,), daemon=True).start()
+    threading.Thread(target=watch_liveness, args=(serv,), daemon=True).start()
+
+    #Every wake-up drains whatever queued up, admitted clients get a thread
+    #each and refused ones are answered right here without one
+    selector = selectors.DefaultSelector()
+    selector.register(serv.sock, selectors.EVENT_READ)
+    try:
+        while True:
+            selector.select()
+            for client, host in serv.accept_pending():
+                try:
+                    limiter = serv.admit(host)
+                except ratelimit.Refused as e:
+                    #A TLS client can't read a plaintext notice, and a
+                    #handshake just to turn it away is what a flood wants
+                    serv.reject(client, e.reason, notify=serv.tls is None)
+                    continue
+                client.setblocking(True)
                 thread = threading.Thread(
                     target=handle_client,
-                    args=(client, serv),
+                    args=(client, serv, limiter),
                     daemon=True
                 )
                 thread.start()
-            else:
-                try:
-                    serv.max_capacity_notification(client)
-                except OSError as e:
-                    print(f"{serv.time_now()} Error max capacity message: {e}")
-                finally:
-                    serv.disconnect_client(client)
     except KeyboardInterrupt as e:
         print("\nServer has been terminated.")
         try:
             serv.close_all_connections()
         except Exception as e:
             print(f"{serv.time_now()} Unable to close all connections: {e}")
-    finally:
-        serv.sock.close()
+
+def watch_liveness(serv: server.Server) -> None:
+    """Heartbeat thread, pings quiet clients and drops dead ones"""
+    #Readers block in recv, they can't notice a peer that went silent
+    while True:
+        time.sleep(serv.timers.tick)
+        serv.check_liveness()
 
 
 if __name__ == '__main__':
@@ -3,20 +3,56 @@ import errno
 import socket
 import sys
 import threading
+import time
 
 from contextlib import suppress
 
-ENCODING = "ISO-8859-1"
+import heartbeat
+import protocol
+import tls
+
+ENCODING = "utf-8"
 DATA_SIZE = 4096
 TIMEOUT = 1
+#Seconds of silence before the server is pinged, and before it's given up
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 90
 
 stop_thread = threading.Event()
+#Set once the raw username prompt is read, whatever the server sends after
+#the username is framed and must not arrive in the same recv as the prompt
+prompt_read = threading.Event()
+#Set once the username went out, the server only understands pings after
+handshake_done = threading.Event()
+#Both threads write, frames must not interleave
+send_lock = threading.Lock()
+
+def send_frame(sock, frame):
+    with send_lock:
+        sock.sendall(frame)
 
 def receive_messages(sock):
+    #Only the username prompt arrives before the handshake, it is raw text
+    decoder = protocol.FrameDecoder(framed=False)
+    last_seen = time.monotonic()
     try:
         while stop_thread.is_set() == False:
             try:
-                data = sock.recv(DATA_SIZE)
+                received = decoder.recv_into(sock)
+            except TimeoutError:
+                #Quiet for a heartbeat interval, see if the server is there
+                if not handshake_done.is_set():
+                    continue
+                if time.monotonic() - last_seen >= HEARTBEAT_TIMEOUT:
+                    print("\n[Server] not responding")
+                    break
+                try:
+                    send_frame(sock, protocol.encode_frame(b"",
+                                                           protocol.PING))
+                except OSError as e:
+                    print(f"OS Error: {e}")
+                    break
+                continue
             except ConnectionResetError as e:
                 print(f"Connection Reset Error: {e}")
                 break
@@ -24,24 +60,49 @@ def receive_messages(sock):
                 print(f"OS Error: {e}")
                 break
 
-            if not data:
+            if not received:
                 print("\n[Server] disconnected")
                 break
+            last_seen = time.monotonic()
 
             try:
-                print(data.decode(ENCODING))
-            except Exception as e:
+                for kind, payload in decoder.frames():
+                    if kind == protocol.PING:
+                        send_frame(sock, protocol.encode_frame(
+                            payload, protocol.PONG))
+                    elif kind == protocol.TEXT:
+                        print(decoder.decode_text(payload))
+                    elif kind == protocol.ZTEXT:
+                        print(decoder.decode_text(
+                            protocol.decompress(payload)))
+            except protocol.FrameError as e:
                 print(f"Error decoding: {e}")
+                break
+            #Everything after the prompt is UTF-8 frames
+            if decoder.version == protocol.RAW:
+                decoder.set_version(protocol.FRAMED_UTF8)
+                prompt_read.set()
     finally:
         stop_thread.set()
+        prompt_read.set()
 
-def send_messages(sock):
+def send_messages(sock, preamble):
+    #The first thing sent is the username, the protocol is announced in
+    #front of it
     try:
         while stop_thread.is_set() == False:
             data = input()
+            if preamble:
+                prompt_read.wait()
             if data == "":
                 data = '\n'
-            sock.sendall(data.encode(ENCODING))
+            payload = data.encode(ENCODING)
+            for i in range(0, len(payload), protocol.MAX_MESSAGE):
+                frame = protocol.encode_frame(
+                    payload[i:i + protocol.MAX_MESSAGE])
+                send_frame(sock, preamble + frame)
+                preamble = b""
+                handshake_done.set()
     except Exception as e:
         print(f"Error sending data to server: {e}")
     finally:
@@ -57,6 +118,20 @@ def main():
         "-a", "--addr", dest="addr", type=str, default="127.0.0.1",
          help="Address that clients are connecting to (Default: localhost)"
     )
+    parser.add_argument(
+        "-z", "--compress", dest="compress", action="store_true",
+        help="Ask the server to send chat compressed (Default: off)"
+    )
+    parser.add_argument(
+        "--tls", dest="tls", action="store_true",
+        help="Connect over TLS and verify the server's certificate"
+        " (Default: off)"
+    )
+    parser.add_argument(
+        "--ca", dest="cafile", type=str, default=None,
+        help="PEM certificate to trust on top of the system ones, the"
+        " server's own if it's self-signed (Default: none)"
+    )
     
     args = parser.parse_args()
     PORT = args.port
@@ -72,6 +147,18 @@ def main():
     except ConnectionRefusedError as e:
         print(f"Unable to connect to {SERVER_ADDR}: {e}")
         sys.exit(1)
+    if args.tls:
+        try:
+            sock = tls.client_context(args.cafile).wrap_socket(
+                sock, server_hostname=ADDR)
+        except OSError as e:
+            print(f"Unable to connect securely to {SERVER_ADDR}: {e}")
+            sys.exit(1)
+    heartbeat.set_keepalive(sock)
+    #UTF-8 frames, and deflated ones too if asked for
+    preamble = protocol.MAGIC_ZLIB if args.compress else protocol.MAGIC_UTF8
+    #recv gives up every interval so a quiet server gets pinged
+    sock.settimeout(HEARTBEAT_INTERVAL)
     
     try:
         thread_recv = threading.Thread(
@@ -82,7 +169,7 @@ def main():
 
         thread_send = threading.Thread(
             target=send_messages, 
-            args=(sock,), 
+            args=(sock, preamble), 
             daemon=True
         )
     
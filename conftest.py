@@ -0,0 +1,2 @@
+#Here so pytest puts the checkout on sys.path, the tests import the
+#top-level modules directly
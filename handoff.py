@@ -0,0 +1,139 @@
+import base64
+import json
+import os
+import socket
+import struct
+
+from contextlib import suppress
+
+#Every message is the number of descriptors riding on it and the length of
+#the JSON body that follows
+HEADER = struct.Struct("!II")
+#Linux takes at most SCM_MAX_FD (253) descriptors per message
+MAX_FDS = 250
+#Sent by the successor once it holds every socket
+READY = b"\x01"
+#Seconds either side waits on the other before giving up
+TIMEOUT = 10.0
+PEERCRED = struct.Struct("3i")
+
+
+class HandoffError(Exception):
+    """Raised when passing the sockets to a successor doesn't work out"""
+
+
+def decode_bytes(text: str) -> bytes:
+    return base64.b64decode(text)
+
+
+def encode_bytes(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def hand_off(conn: socket.socket, listener: socket.socket, state: dict,
+             clients: list[tuple[int, dict]]) -> None:
+    """Send listener, the clients' sockets and state, wait for READY"""
+    conn.settimeout(TIMEOUT)
+    send_message(conn, {"state": state, "clients": len(clients)},
+                 [listener.fileno()])
+    for start in range(0, len(clients), MAX_FDS):
+        batch = clients[start:start + MAX_FDS]
+        send_message(conn, {"clients": [info for _, info in batch]},
+                     [fd for fd, _ in batch])
+    if conn.recv(len(READY)) != READY:
+        raise HandoffError("The new process didn't take over")
+
+
+def listen(path: str) -> socket.socket:
+    """Wait for a successor at path, only the same user may connect"""
+    with suppress(FileNotFoundError):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    #Whoever connects gets every client, the socket is private from the
+    #start rather than chmod-ed after the fact
+    umask = os.umask(0o177)
+    try:
+        listener.bind(path)
+    finally:
+        os.umask(umask)
+    listener.listen(1)
+    listener.setblocking(False)
+    return listener
+
+
+def receive_message(conn: socket.socket) -> tuple[dict, list[int]]:
+    """Next message and the descriptors that came with it"""
+    header, fds, flags, _ = socket.recv_fds(conn, HEADER.size, MAX_FDS,
+                                            socket.MSG_WAITALL)
+    if flags & socket.MSG_CTRUNC or len(header) < HEADER.size:
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError("The old process hung up mid-handoff")
+    count, size = HEADER.unpack(header)
+    body = bytearray()
+    while len(body) < size:
+        data = conn.recv(size - len(body))
+        if not data:
+            break
+        body += data
+    if len(fds) != count or len(body) < size:
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError("Truncated handoff message")
+    return json.loads(body), fds
+
+
+def same_user(conn: socket.socket) -> bool:
+    """True if the process at the other end of conn runs as this user"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    _, uid, _ = PEERCRED.unpack(conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size))
+    return uid == os.getuid()
+
+
+def send_message(conn: socket.socket, body: dict, fds: list[int]) -> None:
+    data = json.dumps(body).encode()
+    #The descriptors ride on the header, the body follows as plain bytes
+    socket.send_fds(conn, [HEADER.pack(len(fds), len(data))], fds)
+    conn.sendall(data)
+
+
+def take_over(path: str) -> tuple[socket.socket, dict,
+                                  list[tuple[socket.socket, dict]]] | None:
+    """Inherit the sockets of the server waiting at path, None if none is"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    listener = None
+    clients = []
+    with conn:
+        conn.settimeout(TIMEOUT)
+        try:
+            if not same_user(conn):
+                raise HandoffError(f"{path} belongs to another user")
+            body, fds = receive_message(conn)
+            listener = socket.socket(fileno=fds[0])
+            while len(clients) < body["clients"]:
+                batch, fds = receive_message(conn)
+                clients += [
+                    (socket.socket(fileno=fd), info)
+                    for fd, info in zip(fds, batch["clients"])
+                ]
+            conn.sendall(READY)
+        except Exception:
+            #Closing without a shutdown leaves the connections to the old
+            #process, which goes on serving them
+            for sock, _ in clients:
+                sock.close()
+            if listener is not None:
+                listener.close()
+            raise
+        #The old process exits once it has READY, after that its store,
+        #log and metrics port are free
+        with suppress(OSError):
+            conn.recv(1)
+    return listener, body["state"], clients
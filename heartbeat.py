@@ -0,0 +1,82 @@
+import math
+import socket
+import threading
+
+from collections.abc import Hashable
+
+#TCP keepalive, seconds of silence before the kernel starts probing, seconds
+#between probes and unanswered probes before the connection is dropped
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+#Timer wheel resolution, a timer fires up to one tick late
+TICK = 1.0
+WHEEL_SLOTS = 512
+
+
+def set_keepalive(sock: socket.socket, idle: int=KEEPALIVE_IDLE,
+                  interval: int=KEEPALIVE_INTERVAL,
+                  count: int=KEEPALIVE_COUNT) -> None:
+    """Have the kernel probe sock when it's been silent for idle seconds"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    #Only the switch is portable, the timings are Linux and BSD options
+    for option, value in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", interval),
+                          ("TCP_KEEPCNT", count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option),
+                            value)
+
+
+class TimerWheel():
+    """Hashed timing wheel, scheduling, cancelling and expiring are O(1)"""
+
+    #A deadline further out than the wheel is long just stays in its slot
+    #for more turns, each slot remembers the tick its timers are due on
+    def __init__(self, now: float, tick: float=TICK,
+                 slots: int=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots: list[dict[Hashable, int]] = [{} for _ in range(slots)]
+        #Key -> index of the slot its timer is in
+        self.where: dict[Hashable, int] = {}
+        self.current = int(now / tick)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def advance(self, now: float) -> list[Hashable]:
+        """Move the wheel up to now, returns the keys whose timers fired"""
+        expired = []
+        target = int(now / self.tick)
+        with self.lock:
+            #After a long stall one turn already visits every slot
+            steps = min(target - self.current, len(self.slots))
+            for step in range(1, steps + 1):
+                slot = self.slots[(self.current + step) % len(self.slots)]
+                due = [key for key, deadline in slot.items()
+                       if deadline <= target]
+                for key in due:
+                    del slot[key]
+                    del self.where[key]
+                expired += due
+            self.current = max(self.current, target)
+        return expired
+
+    def cancel(self, key: Hashable) -> None:
+        with self.lock:
+            index = self.where.pop(key, None)
+            if index is not None:
+                del self.slots[index][key]
+
+    def schedule(self, key: Hashable, when: float) -> None:
+        """Fire key's timer at when, replacing any it already had"""
+        with self.lock:
+            index = self.where.pop(key, None)
+            if index is not None:
+                del self.slots[index][key]
+            #Never in the slot being worked on, so it can't be missed
+            deadline = max(math.ceil(when / self.tick), self.current + 1)
+            index = deadline % len(self.slots)
+            self.slots[index][key] = deadline
+            self.where[key] = index
@@ -0,0 +1,67 @@
+import threading
+
+from collections import deque
+
+import protocol
+
+
+class HistoryRing():
+    """The last few frames said in a room, kept in one preallocated buffer"""
+
+    def __init__(self, max_messages: int, max_bytes: int):
+        if max_messages < 1:
+            raise ValueError(
+                f"History must hold at least 1 message: {max_messages}")
+        self.max_messages = max_messages
+        self.buffer = bytearray(max_bytes)
+        #(start, length) of every frame still in the buffer, oldest first
+        self.entries: deque[tuple[int, int]] = deque()
+        self.write_pos = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def append(self, frame: bytes) -> None:
+        """Remember frame, evicting whatever it overwrites"""
+        size = len(frame)
+        if size > len(self.buffer):
+            return
+        with self.lock:
+            #Frames never wrap, one that doesn't fit starts over at the front.
+            #What's left past write_pos is from the last time round and
+            #older than everything before it, so it goes first.
+            if self.write_pos + size > len(self.buffer):
+                while self.entries and self.entries[0][0] >= self.write_pos:
+                    self.entries.popleft()
+                self.write_pos = 0
+            start, end = self.write_pos, self.write_pos + size
+            while self.entries and (
+                    len(self.entries) >= self.max_messages
+                    or self.overlaps(self.entries[0], start, end)):
+                self.entries.popleft()
+            self.buffer[start:end] = frame
+            self.entries.append((start, size))
+            self.write_pos = end
+
+    @staticmethod
+    def overlaps(entry: tuple[int, int], start: int, end: int) -> bool:
+        entry_start, entry_size = entry
+        return entry_start < end and start < entry_start + entry_size
+
+    def payloads(self) -> list[bytes]:
+        """Copies of the remembered payloads, for clients needing them redone"""
+        with self.lock:
+            view = memoryview(self.buffer)
+            return [
+                bytes(view[start + protocol.HEADER_SIZE:start + size])
+                for start, size in self.entries
+            ]
+
+    def replay(self) -> bytes:
+        """Every remembered frame as one buffer, ready for a single write"""
+        with self.lock:
+            view = memoryview(self.buffer)
+            return b"".join(
+                view[start:start + size] for start, size in self.entries
+            )
@@ -0,0 +1,76 @@
+import logging
+import queue
+import random
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """Size-rotated log file that flushes once per batch, not once per line"""
+
+    def __init__(self, filename: str, records: queue.SimpleQueue,
+                 max_bytes: int, backup_count: int, batch_size: int):
+        super().__init__(filename, maxBytes=max_bytes,
+                         backupCount=backup_count, delay=True)
+        self.records = records
+        self.batch_size = batch_size
+        self.pending = 0
+
+    def close(self) -> None:
+        self.pending = 0
+        super().flush()
+        super().close()
+
+    def flush(self) -> None:
+        #StreamHandler.emit flushes after every record, hold off until the
+        #listener has drained the queue or the batch is full
+        self.pending += 1
+        if self.pending >= self.batch_size or self.records.empty():
+            self.pending = 0
+            super().flush()
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue handler that leaves formatting the line to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        #Exceptions still need rendering here, the traceback won't survive
+        if record.exc_info:
+            return super().prepare(record)
+        #The message is resolved now, its arguments are often sockets that
+        #are closed by the time the listener gets to them. Only records
+        #that got past the filters pay for it.
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """Keep roughly rate (0.0-1.0) of the records passing through"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError(f"Sample rate must be within 0.0-1.0: {rate}")
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.rate >= 1.0 or random.random() < self.rate
+
+
+def create_pipeline(logger: logging.Logger, filename: str, log_format: str,
+                    max_bytes: int, backup_count: int,
+                    batch_size: int) -> QueueListener:
+    """Route logger through a queue to a batched, rotating file writer"""
+    records = queue.SimpleQueue()
+    file_handler = BatchedRotatingFileHandler(
+        filename, records, max_bytes, backup_count, batch_size
+    )
+    file_handler.setFormatter(logging.Formatter(log_format))
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(DeferredQueueHandler(records))
+    listener = QueueListener(records, file_handler)
+    listener.start()
+    return listener
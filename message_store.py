@@ -0,0 +1,224 @@
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+
+#Every record is its total length, a CRC32 of the room name and message,
+#the time it was said and the room name length, then the room name and
+#the encoded chat line
+RECORD = struct.Struct("!IIdB")
+#A segment's index holds where each of its records starts, the nth entry
+#is the record at offset base + n
+INDEX_ENTRY = struct.Struct("!Q")
+
+#A segment is rolled once a commit takes it past this
+SEGMENT_BYTES = 64 * 1024 * 1024
+#Most records written and fsynced together
+GROUP_COMMIT_SIZE = 1024
+
+
+class StoreError(ValueError):
+    """A record on disk failed its checksum or can't be read"""
+
+
+class Segment():
+    """One append-only log file of records plus its offset index"""
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        path = os.path.join(directory, f"{base:020d}")
+        self.log_path = path + ".log"
+        self.index_path = path + ".idx"
+        self.log = open(self.log_path, "ab")
+        self.index = open(self.index_path, "ab")
+        self.size, self.count = self.recover()
+        #What readers may map, only moves forward after an fsync
+        self.committed_size = self.size
+        self.committed_count = self.count
+
+    def append(self, records: list[tuple[float, str, bytes]]) -> None:
+        """Write records and fsync them, one group commit"""
+        chunks = []
+        positions = []
+        position = self.size
+        for said_at, room, data in records:
+            name = room.encode()
+            length = RECORD.size + len(name) + len(data)
+            crc = zlib.crc32(data, zlib.crc32(name))
+            chunks += [RECORD.pack(length, crc, said_at, len(name)), name,
+                       data]
+            positions.append(INDEX_ENTRY.pack(position))
+            position += length
+        #Data before index, a crash in between leaves a tail recover() drops
+        self.log.write(b"".join(chunks))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.index.write(b"".join(positions))
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.size = position
+        self.count += len(records)
+        #Size first, a reader that sees the new count also sees its bytes
+        self.committed_size = self.size
+        self.committed_count = self.count
+
+    def close(self) -> None:
+        self.log.close()
+        self.index.close()
+
+    @contextmanager
+    def mapped(self):
+        """Read-only maps of the committed log and index"""
+        count = self.committed_count
+        size = self.committed_size
+        if not count:
+            yield b"", b"", 0
+            return
+        with open(self.log_path, "rb") as log, \
+                open(self.index_path, "rb") as index:
+            with mmap.mmap(log.fileno(), size, access=mmap.ACCESS_READ) \
+                    as log_map, \
+                    mmap.mmap(index.fileno(), count * INDEX_ENTRY.size,
+                              access=mmap.ACCESS_READ) as index_map:
+                yield log_map, index_map, count
+
+    def recover(self) -> tuple[int, int]:
+        """Drop whatever the last run didn't finish writing"""
+        count = os.path.getsize(self.index_path) // INDEX_ENTRY.size
+        log_size = os.path.getsize(self.log_path)
+        end = 0
+        with open(self.log_path, "rb") as log, \
+                open(self.index_path, "rb") as index:
+            while count:
+                index.seek((count - 1) * INDEX_ENTRY.size)
+                (last,) = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))
+                log.seek(last)
+                header = log.read(RECORD.size)
+                if len(header) == RECORD.size:
+                    end = last + RECORD.unpack(header)[0]
+                    if end <= log_size:
+                        break
+                count -= 1
+                end = 0
+        self.index.truncate(count * INDEX_ENTRY.size)
+        self.log.truncate(end)
+        return end, count
+
+    @staticmethod
+    def read_record(log_map, position: int) -> tuple[float, str, bytes]:
+        length, crc, said_at, name_size = RECORD.unpack_from(log_map,
+                                                            position)
+        body = log_map[position + RECORD.size:position + length]
+        if zlib.crc32(body) != crc:
+            raise StoreError(f"Corrupt record at byte {position}")
+        return said_at, body[:name_size].decode(), body[name_size:]
+
+
+class MessageStore():
+    """Durable chat log, appends never wait on the disk"""
+
+    def __init__(self, directory: str, segment_bytes: int=SEGMENT_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        bases = sorted(
+            int(name[:-len(".log")]) for name in os.listdir(directory)
+            if name.endswith(".log")
+        )
+        #Replaced, never changed in place, so readers can iterate freely
+        self.segments = [Segment(directory, base) for base in bases] or [
+            Segment(directory, 0)
+        ]
+        self.pending: queue.SimpleQueue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    @property
+    def committed(self) -> int:
+        """Offset the next durable record will get"""
+        active = self.segments[-1]
+        return active.base + active.committed_count
+
+    def append(self, room: str, data: bytes) -> None:
+        """Hand a chat line to the writer thread"""
+        self.pending.put((time.time(), room, data))
+
+    def close(self) -> None:
+        """Commit everything appended so far and stop the writer"""
+        self.pending.put(None)
+        self.writer.join()
+        for segment in self.segments:
+            segment.close()
+
+    def read(self, offset: int,
+             limit: int) -> list[tuple[int, float, str, bytes]]:
+        """Up to limit (offset, time, room, data) records from offset on"""
+        records = []
+        for segment in self.segments:
+            with segment.mapped() as (log_map, index_map, count):
+                first = max(offset, segment.base) - segment.base
+                for n in range(first, count):
+                    if len(records) >= limit:
+                        return records
+                    (position,) = INDEX_ENTRY.unpack_from(
+                        index_map, n * INDEX_ENTRY.size)
+                    records.append((segment.base + n,
+                                    *Segment.read_record(log_map, position)))
+        return records
+
+    def run(self) -> None:
+        """Writer thread, commits whatever piled up while it was syncing"""
+        while True:
+            record = self.pending.get()
+            if record is None:
+                return
+            batch = [record]
+            stopping = False
+            while len(batch) < GROUP_COMMIT_SIZE:
+                try:
+                    record = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                self.segments[-1].append(batch)
+            except OSError as e:
+                print(f"Message store write failed, lost {len(batch)}: {e}")
+            if self.segments[-1].size >= self.segment_bytes:
+                self.roll()
+            if stopping:
+                return
+
+    def roll(self) -> None:
+        """Seal the active segment and start a new one after it"""
+        active = self.segments[-1]
+        self.segments = self.segments + [
+            Segment(self.directory, active.base + active.count)
+        ]
+
+    def tail(self, room: str, count: int,
+             scan_limit: int=10000) -> list[tuple[float, bytes]]:
+        """The last count (time, data) lines said in room, oldest first"""
+        found = []
+        scanned = 0
+        for segment in reversed(self.segments):
+            with segment.mapped() as (log_map, index_map, records):
+                for n in range(records - 1, -1, -1):
+                    if len(found) >= count or scanned >= scan_limit:
+                        return found[::-1]
+                    scanned += 1
+                    (position,) = INDEX_ENTRY.unpack_from(
+                        index_map, n * INDEX_ENTRY.size)
+                    said_at, said_in, data = Segment.read_record(log_map,
+                                                                 position)
+                    if said_in == room:
+                        found.append((said_at, data))
+        return found[::-1]
@@ -0,0 +1,276 @@
+import bisect
+import threading
+import time
+
+from collections.abc import Callable, Iterable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+#Seconds, fanning out to a room is normally well under a millisecond
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 1.0
+)
+#Messages waiting in one connection's outbound queue
+DEPTH_BUCKETS = (0, 1, 4, 16, 64, 256, 1024)
+
+#Disconnect reasons
+CLOSED = "closed"
+ERROR = "error"
+FRAME_ERROR = "frame_error"
+HOST_FULL = "host_full"
+RATE_LIMITED = "rate_limited"
+SEND_ERROR = "send_error"
+SERVER_FULL = "server_full"
+SHUTDOWN = "shutdown"
+SLOW_CONSUMER = "slow_consumer"
+TIMED_OUT = "timed_out"
+TLS_ERROR = "tls_error"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """Monotonic total, optionally split by the values of one label"""
+
+    def __init__(self, name: str, help_text: str, label: str | None=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values: dict[str, int | float] = {} if label else {"": 0}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: int | float=1, value: str="") -> None:
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for value, total in values:
+            labels = f'{{{self.label}="{value}"}}' if self.label else ""
+            lines.append(f"{self.name}{labels} {format_value(total)}")
+        return lines
+
+
+class CounterReading():
+    """Totals other objects keep, split by one label and read when scraped"""
+
+    def __init__(self, name: str, help_text: str, label: str,
+                 read: Callable[[], dict[str, int]]):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.read = read
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} counter"]
+        for value, total in sorted(self.read().items()):
+            lines.append(f'{self.name}{{{self.label}="{value}"}} '
+                         f"{format_value(total)}")
+        return lines
+
+
+class Gauge():
+    """Current value, read from the server only when scraped"""
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}",
+                f"# TYPE {self.name} gauge",
+                f"{self.name} {format_value(self.read())}"]
+
+
+class Histogram():
+    """Cumulative buckets, sum and count of observed values"""
+
+    def __init__(self, name: str, help_text: str,
+                 buckets: tuple[float, ...]=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        #One extra slot for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self) -> list[str]:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} '
+                         f"{cumulative}")
+        lines.append(f"{self.name}_sum {total!r}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class DepthSnapshot():
+    """Distribution of a per-connection gauge, computed at scrape time"""
+
+    def __init__(self, name: str, help_text: str,
+                 read: Callable[[], Iterable[int]],
+                 buckets: tuple[int, ...]=DEPTH_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.buckets = buckets
+
+    def render(self) -> list[str]:
+        counts = [0] * (len(self.buckets) + 1)
+        deepest = 0
+        for depth in self.read():
+            counts[bisect.bisect_left(self.buckets, depth)] += 1
+            deepest = max(deepest, depth)
+        #A snapshot goes up and down, so gauges rather than a histogram
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} gauge"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f'{self.name}{{le="{format_value(bound)}"}} '
+                         f"{cumulative}")
+        lines += [f"# HELP {self.name}_max Deepest queue right now",
+                  f"# TYPE {self.name}_max gauge",
+                  f"{self.name}_max {deepest}"]
+        return lines
+
+
+class TimedLock():
+    """Lock wrapper that records how long every acquire waited"""
+
+    def __init__(self, lock: threading.RLock, waits: Histogram):
+        self.lock = lock
+        self.waits = waits
+
+    def __enter__(self) -> "TimedLock":
+        #Uncontended is the common case, skip the clock for it
+        if self.lock.acquire(blocking=False):
+            self.waits.observe(0.0)
+            return self
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.waits.observe(time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.lock.release()
+
+
+class ChatMetrics():
+    """Everything the chat server exports on its metrics endpoint"""
+
+    def __init__(self, clients: Callable[[], Iterable],
+                 rooms: Callable[[], int],
+                 dropped: Callable[[], dict[str, int]]=dict):
+        self.clients = clients
+        self.accepted = Counter(
+            "chatroom_accepted_connections_total",
+            "Connections accepted, rate() of it is the accept rate")
+        self.messages_in = Counter(
+            "chatroom_messages_in_total", "Chat lines and commands received")
+        self.messages_out = Counter(
+            "chatroom_messages_out_total",
+            "Messages queued to recipients, one per recipient")
+        self.bytes_in = Counter(
+            "chatroom_bytes_in_total", "Message payload bytes received")
+        self.bytes_out = Counter(
+            "chatroom_bytes_out_total",
+            "Bytes queued to recipients, framing included")
+        self.fanout_seconds = Histogram(
+            "chatroom_fanout_seconds",
+            "Time to hand one message to every recipient in its room")
+        self.lock_wait_seconds = Histogram(
+            "chatroom_registry_lock_wait_seconds",
+            "Time spent waiting for the client registry lock")
+        self.disconnects = Counter(
+            "chatroom_disconnects_total", "Users disconnected, by reason",
+            label="reason")
+        self.rate_limited = Counter(
+            "chatroom_rate_limited_total",
+            "Messages over a rate limit, by the action taken", label="action")
+        self.rate_limit_delay = Counter(
+            "chatroom_rate_limit_delay_seconds_total",
+            "Time readers were held back under the delay action")
+        self.tls_handshakes = Counter(
+            "chatroom_tls_handshakes_total",
+            "TLS handshakes completed, by whether the session was resumed",
+            label="session")
+        self.metrics = [
+            Gauge("chatroom_connected_clients", "Users currently connected",
+                  lambda: len(self.clients())),
+            Gauge("chatroom_rooms", "Rooms that currently exist", rooms),
+            self.accepted, self.messages_in, self.messages_out,
+            self.bytes_in, self.bytes_out, self.fanout_seconds,
+            DepthSnapshot(
+                "chatroom_outbound_queue_depth",
+                "Connections whose outbound queue holds at most le messages",
+                self.queue_depths),
+            self.lock_wait_seconds, self.disconnects, self.rate_limited,
+            self.rate_limit_delay, self.tls_handshakes,
+            CounterReading(
+                "chatroom_dropped_messages_total",
+                "Messages dropped because a queue was full, by the queue",
+                "queue", dropped),
+        ]
+
+    def queue_depths(self) -> Iterable[int]:
+        return (len(client.queue) for client in self.clients())
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return ("\n".join(lines) + "\n").encode()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics in the Prometheus text format"""
+
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.chat_metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        #Scrapes every few seconds would drown out the chat on stdout
+        pass
+
+
+def serve(chat_metrics: ChatMetrics, host: str,
+          port: int) -> ThreadingHTTPServer:
+    """Serve chat_metrics over HTTP from a background thread"""
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    http_server.chat_metrics = chat_metrics
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server
@@ -0,0 +1,201 @@
+import socket
+import ssl
+import threading
+
+from collections import deque
+from contextlib import suppress
+
+import protocol
+
+#Overflow policies
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+#Most messages coalesced into one write, well under the usual IOV_MAX
+MAX_BATCH = 64
+#Seconds a closing connection may spend sending what's still queued
+FLUSH_TIMEOUT = 0.5
+
+
+def send_batch(sock: socket.socket,
+               buffers: list[bytes | memoryview]) -> list[memoryview]:
+    """One sendmsg for all of buffers, returns what didn't fit"""
+    if isinstance(sock, ssl.SSLSocket):
+        #TLS has no sendmsg, the batch is joined into one write instead.
+        #A write that has to wait is retried with the same bytes.
+        sent = sock.send(b"".join(buffers))
+    else:
+        sent = sock.sendmsg(buffers)
+    for i, buffer in enumerate(buffers):
+        if sent < len(buffer):
+            return [memoryview(buffer)[sent:]] + buffers[i + 1:]
+        sent -= len(buffer)
+    return []
+
+
+class OutboundQueue():
+    """Bounded queue of messages waiting to be written to one recipient"""
+
+    def __init__(self, maxsize: int, policy: str = DROP_OLDEST):
+        if maxsize < 1:
+            raise ValueError(f"Queue size must be at least 1: {maxsize}")
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items: deque[bytes] = deque()
+        self.dropped = 0
+        #Set once push() has asked for the consumer to be disconnected
+        self.overflowed = False
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def clear(self) -> None:
+        self.items.clear()
+
+    def pop(self) -> bytes:
+        """Next message to write, oldest first"""
+        return self.items.popleft()
+
+    def pop_batch(self, limit: int=MAX_BATCH) -> list[bytes]:
+        """Up to limit messages to write together, oldest first"""
+        items = self.items
+        return [items.popleft() for _ in range(min(limit, len(items)))]
+
+    def push(self, data: bytes) -> bool:
+        """Queue data, False means the consumer has to be disconnected"""
+        if len(self.items) < self.maxsize:
+            self.items.append(data)
+            return True
+        if self.policy == DROP_OLDEST:
+            self.items.popleft()
+            self.items.append(data)
+            self.dropped += 1
+            return True
+        if self.policy == DROP_NEWEST:
+            self.dropped += 1
+            return True
+        self.overflowed = True
+        return False
+
+
+class QueuedConnection():
+    """Blocking socket whose writes are drained by its own writer thread"""
+
+    def __init__(self, sock: socket.socket, queue: OutboundQueue,
+                 decoder: protocol.FrameDecoder, latency_budget: float=0.0):
+        self.sock = sock
+        #Kept, the server still finds the session by it after closing
+        self.fd = sock.fileno()
+        self.queue = queue
+        self.decoder = decoder
+        #Seconds a message may wait for more to share its write
+        self.latency_budget = latency_budget
+        self.closed = False
+        #Set while the writer thread is in the middle of a write
+        self.sending = False
+        self.cond = threading.Condition()
+        self.writer = threading.Thread(target=self.drain, daemon=True)
+        self.writer.start()
+
+    def __repr__(self) -> str:
+        return f"<QueuedConnection {self.sock}>"
+
+    def close(self) -> None:
+        self.stop()
+        self.sock.close()
+
+    def drain(self) -> None:
+        """Writer thread, sends queued messages in order until closed"""
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                #Give a burst the latency budget to build up into one write
+                if self.latency_budget and len(self.queue) < MAX_BATCH:
+                    self.cond.wait_for(
+                        lambda: self.closed or len(self.queue) >= MAX_BATCH,
+                        self.latency_budget
+                    )
+                    if self.closed:
+                        return
+                batch = self.queue.pop_batch()
+                self.sending = True
+            try:
+                while batch:
+                    batch = send_batch(self.sock, batch)
+            except OSError:
+                self.kick()
+                return
+            finally:
+                with self.cond:
+                    self.sending = False
+                    #shutdown() may be waiting for this write to finish
+                    self.cond.notify_all()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    @property
+    def framed(self) -> bool:
+        return self.decoder.framed is True
+
+    @property
+    def version(self) -> int | None:
+        return self.decoder.version
+
+    def getpeername(self) -> tuple:
+        return self.sock.getpeername()
+
+    def kick(self) -> None:
+        """Shut the socket down so the reader thread sees EOF and cleans up"""
+        self.stop()
+        with suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+
+    def recv(self, bufsize: int) -> bytes:
+        return self.sock.recv(bufsize)
+
+    def recv_into(self, buffer: memoryview) -> int:
+        return self.sock.recv_into(buffer)
+
+    def sendall(self, data: bytes) -> None:
+        """Queue data for the writer thread, never blocks on the network"""
+        with self.cond:
+            if self.closed:
+                return
+            if self.queue.push(data):
+                self.cond.notify()
+                return
+        #Slow consumer under the disconnect policy
+        self.kick()
+
+    def shutdown(self, how: int) -> None:
+        """Send what's queued, a parting notice say, then shut down"""
+        with self.cond:
+            #A write under way goes out first, it may be the notice. If
+            #the writer is stuck on a peer that stopped reading, the rest
+            #is dropped rather than waited on.
+            self.cond.wait_for(lambda: not self.sending, FLUSH_TIMEOUT)
+            leftover = [] if self.sending else self.queue.pop_batch()
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify()
+        if leftover:
+            with suppress(OSError):
+                self.sock.settimeout(FLUSH_TIMEOUT)
+                while leftover:
+                    leftover = send_batch(self.sock, leftover)
+        self.sock.shutdown(how)
+
+    def stop(self) -> None:
+        """Stop the writer thread and discard anything still queued"""
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify()
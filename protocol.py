@@ -0,0 +1,234 @@
+import codecs
+import socket
+import struct
+import zlib
+
+from collections.abc import Iterator
+
+#Framed clients send one of these right before their username frame,
+#anything else is treated as a legacy raw-text client
+MAGIC = b"\x00LNK1"
+MAGIC_UTF8 = b"\x00LNK2"
+MAGIC_ZLIB = b"\x00LNK3"
+MAGIC_SIZE = len(MAGIC)
+
+#Protocol versions, what a connection's bytes look like on the wire
+RAW = 0
+FRAMED = 1
+FRAMED_UTF8 = 2
+#FRAMED_UTF8 that may also be sent ZTEXT frames
+FRAMED_ZLIB = 3
+VERSIONS = {MAGIC: FRAMED, MAGIC_UTF8: FRAMED_UTF8, MAGIC_ZLIB: FRAMED_ZLIB}
+UTF8_VERSIONS = (FRAMED_UTF8, FRAMED_ZLIB)
+#Text encoding of every other version
+LEGACY_ENCODING = "ISO-8859-1"
+
+#Every frame is a kind byte and a payload length followed by the payload
+HEADER = struct.Struct("!BI")
+HEADER_SIZE = HEADER.size
+MAX_MESSAGE = 16 * 1024
+MAX_PAYLOAD = 64 * 1024
+INITIAL_BUFFER = 4096
+
+#Frame kinds, pings are answered with a pong carrying the same payload
+TEXT = 0
+PING = 1
+PONG = 2
+#Text deflated on its own against ZDICT, only ever sent to clients
+ZTEXT = 3
+
+#Every ZTEXT payload starts from this dictionary instead of from nothing,
+#so even a short line has the timestamps and notices it repeats to point
+#back to. Deflate finds matches at the end cheapest, the most common
+#strings go last. Changing it takes a new protocol version.
+ZDICT = (
+    b"Username is  is already taken. Welcome to Link's Chatroom! "
+    b"You are muted for You are sending too fast Disconnected for "
+    b"Last  in  has entered the chat. has disconnected.  has left "
+    b" has joined  You are now in  (private): To  the and you that "
+    b"[Jan [Feb [Mar [Apr [May [Jun [Jul [Aug [Sep [Oct [Nov [Dec "
+    b"01, 02, 03, 04, 05, 06, 07, 08, 09, 10, 11, 12, 13, 14, 15, 16, "
+    b"17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 20"
+)
+#A 4 KiB window and small hash tables, compressors are made per message
+ZLIB_WBITS = -12
+ZLIB_MEMLEVEL = 5
+
+
+class FrameError(ValueError):
+    """Raised when a peer sends a malformed or oversized frame"""
+
+
+def compress(data: bytes, level: int) -> bytes:
+    """Raw deflate of one message against ZDICT, inflates on its own"""
+    deflate = zlib.compressobj(level, zlib.DEFLATED, ZLIB_WBITS,
+                               ZLIB_MEMLEVEL, zdict=ZDICT)
+    return deflate.compress(data) + deflate.flush()
+
+
+def decompress(payload: bytes, max_size: int=MAX_PAYLOAD) -> bytes:
+    """Inflate a ZTEXT payload, refusing to grow it past max_size"""
+    inflate = zlib.decompressobj(ZLIB_WBITS, zdict=ZDICT)
+    try:
+        data = inflate.decompress(payload, max_size)
+    except zlib.error as e:
+        raise FrameError(f"Bad compressed frame: {e}")
+    if inflate.unconsumed_tail or not inflate.eof:
+        raise FrameError("Compressed frame is truncated or too large")
+    return data
+
+
+def encode_frame(payload: bytes, kind: int=TEXT) -> bytes:
+    """Prefix payload with its frame header"""
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def text_encoding(version: int | None) -> str:
+    """Encoding text is sent in under version, legacy until negotiated"""
+    return "utf-8" if version in UTF8_VERSIONS else LEGACY_ENCODING
+
+
+class FrameDecoder():
+    """Incremental decoder working in place on a reusable receive buffer
+
+    Frames come out as memoryview slices of the buffer, so nothing is copied
+    on the way in. A slice is only valid until the next recv_into or feed.
+    version starts as None and is settled by the first bytes the peer sends,
+    unless the caller already knows which side of the protocol it is on.
+    """
+
+    def __init__(self, max_payload: int=MAX_PAYLOAD,
+                 framed: bool | None=None, size: int=INITIAL_BUFFER,
+                 version: int | None=None):
+        self.max_payload = max_payload
+        #framed=True is the original Latin-1 framed protocol
+        if version is None and framed is not None:
+            version = FRAMED if framed else RAW
+        self.version: int | None = None
+        self.text: codecs.IncrementalDecoder | None = None
+        if version is not None:
+            self.set_version(version)
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def compact(self) -> None:
+        """Move the unread bytes to the front of the buffer"""
+        pending = self.end - self.start
+        if self.start:
+            if pending:
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+    def decode_text(self, payload: bytes, final: bool=False) -> str:
+        """Decode a text payload, carrying a split character to the next"""
+        if self.text is None:
+            return str(payload, LEGACY_ENCODING)
+        return self.text.decode(payload, final)
+
+    def ends_whole(self, payload: bytes) -> bool:
+        """True if payload holds whole characters and none are carried in"""
+        if self.text is None or self.text.getstate()[0]:
+            return False
+        #Walk back over continuation bytes to the last character's lead
+        for back, byte in enumerate(reversed(payload[-4:]), 1):
+            if byte < 0x80:
+                return True
+            if byte >= 0xC0:
+                return back >= (2 if byte < 0xE0 else 3 if byte < 0xF0 else 4)
+        return True
+
+    def feed(self, data: bytes) -> None:
+        """Copy data in, for transports that hand over bytes objects"""
+        self.rewind()
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    @property
+    def framed(self) -> bool | None:
+        return None if self.version is None else self.version != RAW
+
+    def frames(self) -> Iterator[tuple[int, memoryview]]:
+        """Yield every complete (kind, payload) currently buffered"""
+        if self.version is None and not self.negotiate():
+            return
+        if not self.framed:
+            #Legacy clients, whatever one recv returned is one message
+            if self.end > self.start:
+                payload = self.view[self.start:self.end]
+                self.start = self.end
+                yield TEXT, payload
+            return
+        while self.end - self.start >= HEADER_SIZE:
+            kind, length = HEADER.unpack_from(self.buf, self.start)
+            if length > self.max_payload:
+                raise FrameError(f"Frame of {length} bytes is too large")
+            frame_end = self.start + HEADER_SIZE + length
+            if frame_end > self.end:
+                self.reserve_frame(HEADER_SIZE + length)
+                return
+            payload = self.view[self.start + HEADER_SIZE:frame_end]
+            self.start = frame_end
+            yield kind, payload
+
+    def negotiate(self) -> bool:
+        """Settle version from the first bytes, False if more are needed"""
+        stop = min(self.end, self.start + MAGIC_SIZE)
+        pending = bytes(self.view[self.start:stop])
+        if not pending or (len(pending) < MAGIC_SIZE and any(
+                magic.startswith(pending) for magic in VERSIONS)):
+            return False
+        self.set_version(VERSIONS.get(pending, RAW))
+        if self.version != RAW:
+            self.start += MAGIC_SIZE
+        return True
+
+    def recv_into(self, sock: socket.socket) -> int:
+        """Receive straight into the free end of the buffer, 0 means EOF"""
+        self.rewind()
+        self.reserve(1)
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def reserve(self, size: int) -> None:
+        """Make room for size more bytes after the unread ones"""
+        if len(self.buf) - self.end >= size:
+            return
+        self.compact()
+        needed = self.end + size
+        if needed > len(self.buf):
+            #Swap in a new buffer rather than resizing, views handed out
+            #earlier keep the old one alive
+            buf = bytearray(max(needed, len(self.buf) * 2))
+            buf[:self.end] = self.view[:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+
+    def rewind(self) -> None:
+        """Cheaply reclaim space before the unread bytes"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > len(self.buf) // 2:
+            self.compact()
+
+    def unread(self) -> bytes:
+        """Copy of what was received but isn't a whole frame yet"""
+        return bytes(self.view[self.start:self.end])
+
+    def set_version(self, version: int) -> None:
+        self.version = version
+        #Characters split across frames or recvs decode once they're whole
+        self.text = codecs.getincrementaldecoder(text_encoding(version))(
+            errors="replace")
+
+    def reserve_frame(self, size: int) -> None:
+        """Grow so a partially received frame of size bytes fits"""
+        if self.start + size > len(self.buf):
+            self.reserve(size - (self.end - self.start))
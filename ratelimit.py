@@ -0,0 +1,97 @@
+import time
+
+#What happens to a message over the limit
+DELAY = "delay"
+DROP = "drop"
+MUTE = "mute"
+DISCONNECT = "disconnect"
+RATE_ACTIONS = (DELAY, DROP, MUTE, DISCONNECT)
+#Verdict for a message within the limits
+ALLOW = "allow"
+
+
+class Flooding(Exception):
+    """Raised for a client that has to be disconnected for flooding"""
+
+
+class Refused(Exception):
+    """Raised for a new connection that's over a connection limit"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class TokenBucket():
+    """Refills at rate tokens a second, holds at most burst"""
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0 or burst <= 0:
+            raise ValueError(
+                f"Rate and burst must be positive: {rate} {burst}")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def shortfall(self, amount: float, now: float) -> float:
+        """Seconds until amount tokens are there, 0.0 if they already are"""
+        self.refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        #Can go negative, a delayed message pays for itself in advance
+        self.tokens -= amount
+
+
+class HostLimits():
+    """Buckets shared by every connection from one address"""
+
+    def __init__(self, host: str, messages: TokenBucket | None,
+                 data: TokenBucket | None):
+        self.host = host
+        self.messages = messages
+        self.data = data
+        self.connections = 0
+
+
+class Limiter():
+    """Message and byte buckets of one connection and of its host"""
+
+    #Each connection is only ever checked from its own reader, so nothing
+    #here takes a lock. Host buckets are shared between readers, a rare
+    #lost update there just lets one message through early.
+    def __init__(self, messages: TokenBucket | None,
+                 data: TokenBucket | None, host: HostLimits):
+        self.buckets = [
+            (bucket, size_based) for bucket, size_based in (
+                (messages, False), (data, True),
+                (host.messages, False), (host.data, True),
+            ) if bucket is not None
+        ]
+        self.host = host
+        self.muted_until = 0.0
+        #When the client was last told it's over the limit
+        self.warned_at = float("-inf")
+
+    def check(self, size: int, delay: bool=False) -> float:
+        """Seconds the message is over the limit by, 0.0 to let it through"""
+        #With delay the message is charged either way and the caller waits
+        #out the returned time, otherwise only messages let through are
+        now = time.monotonic()
+        if now < self.muted_until:
+            return self.muted_until - now
+        wait = 0.0
+        for bucket, size_based in self.buckets:
+            wait = max(wait, bucket.shortfall(size if size_based else 1, now))
+        if wait == 0.0 or delay:
+            for bucket, size_based in self.buckets:
+                bucket.take(size if size_based else 1)
+        return wait
@@ -0,0 +1,443 @@
+import selectors
+import socket
+import ssl
+import time
+
+from contextlib import suppress
+
+import metrics
+import outbound
+import protocol
+import ratelimit
+import server
+import sessions
+
+
+class ReactorClient():
+    """Non-blocking connection with its own input and output buffers"""
+
+    def __init__(self, sock: socket.socket, selector: selectors.BaseSelector,
+                 queue: outbound.OutboundQueue,
+                 decoder: protocol.FrameDecoder,
+                 dirty: set["ReactorClient"]):
+        self.sock = sock
+        #Kept, the server still finds the session by it after closing
+        self.fd = sock.fileno()
+        self.selector = selector
+        self.decoder = decoder
+        self.queue = queue
+        #The part of the last batch the socket hasn't taken yet
+        self.pending: list[memoryview] = []
+        #Clients with fresh output, the reactor flushes them together
+        self.dirty = dirty
+        #Everything the server tracks about it, set once it's admitted
+        self.session: sessions.Session | None = None
+        self.closed = False
+        #Off while the client is held back by the rate limiter
+        self.reading = True
+        #TLS connections handshake first, waiting on whatever it needs
+        self.tls = isinstance(sock, ssl.SSLSocket)
+        self.handshaking = self.tls
+        self.handshake_events = selectors.EVENT_READ
+        self.events = selectors.EVENT_READ
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, self.events, self)
+
+    def __repr__(self) -> str:
+        return f"<ReactorClient {self.sock}>"
+
+    def close(self) -> None:
+        """Unregister from the selector and close the socket"""
+        if not self.closed:
+            self.closed = True
+            if self.events:
+                self.selector.unregister(self.sock)
+            self.dirty.discard(self)
+        self.sock.close()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def flush(self) -> None:
+        """Write queued messages until the socket stops accepting data"""
+        #Whatever was queued meanwhile goes out once the handshake is done
+        if self.handshaking:
+            return
+        while True:
+            if not self.pending:
+                if not self.queue:
+                    break
+                self.pending = self.queue.pop_batch()
+            try:
+                self.pending = outbound.send_batch(self.sock, self.pending)
+            except (BlockingIOError, ssl.SSLWantWriteError):
+                break
+            if self.pending:
+                break
+        self.update_events()
+
+    @property
+    def framed(self) -> bool:
+        return self.decoder.framed is True
+
+    @property
+    def version(self) -> int | None:
+        return self.decoder.version
+
+    def getpeername(self) -> tuple:
+        return self.sock.getpeername()
+
+    def handshake(self) -> bool:
+        """Take the TLS handshake as far as it goes, True once it's done"""
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshake_events = selectors.EVENT_READ
+        except ssl.SSLWantWriteError:
+            self.handshake_events = selectors.EVENT_WRITE
+        else:
+            self.handshaking = False
+        self.update_events()
+        return not self.handshaking
+
+    def kick(self) -> None:
+        """Shut the socket down, the next read event disconnects it"""
+        self.queue.clear()
+        self.pending = []
+        with suppress(OSError):
+            self.sock.shutdown(socket.SHUT_RDWR)
+
+    def sendall(self, data: bytes) -> None:
+        """Queue data, the selector writes it out when the socket is ready"""
+        if self.closed:
+            return
+        was_idle = not self.pending and not self.queue
+        if not self.queue.push(data):
+            #Slow consumer under the disconnect policy
+            self.kick()
+            return
+        #The reactor flushes idle clients once the current round of events
+        #is handled, so everything queued meanwhile goes out in one write.
+        #Otherwise EVENT_WRITE is already armed and keeps draining in order.
+        if was_idle:
+            self.dirty.add(self)
+
+    def update_events(self) -> None:
+        """Tell the selector what this client is waiting for now"""
+        if self.handshaking:
+            events = self.handshake_events
+        else:
+            events = selectors.EVENT_READ if self.reading else 0
+            if self.pending or self.queue:
+                events |= selectors.EVENT_WRITE
+        if events == self.events:
+            return
+        #A paused client with nothing to write isn't waiting on anything
+        if not self.events:
+            self.selector.register(self.sock, events, self)
+        elif not events:
+            self.selector.unregister(self.sock)
+        else:
+            self.selector.modify(self.sock, events, self)
+        self.events = events
+
+    def unsent(self) -> bytes:
+        """Everything queued that the socket hasn't taken yet"""
+        return b"".join([*self.pending, *self.queue.items])
+
+    def shutdown(self, how: int) -> None:
+        #Last words like the server full notice are still waiting on the
+        #end of the round, give them one try before the socket goes
+        if not self.closed:
+            with suppress(OSError):
+                self.flush()
+        self.sock.shutdown(how)
+
+
+class Reactor():
+    """Single-threaded selectors loop serving the chatroom protocol"""
+
+    def __init__(self, serv: server.Server):
+        self.serv = serv
+        self.selector = selectors.DefaultSelector()
+        #Clients with output queued this round, and when to write it out
+        self.dirty: set[ReactorClient] = set()
+        self.flush_at: float | None = None
+        #Clients whose reads are paused by the rate limiter, until when
+        self.paused: dict[ReactorClient, float] = {}
+        self.serv.sock.setblocking(False)
+        self.selector.register(self.serv.sock, selectors.EVENT_READ, None)
+        #Broadcasts from the other workers when running with --workers
+        if self.serv.bus is not None:
+            self.selector.register(self.serv.bus.sock, selectors.EVENT_READ,
+                                   self.serv.bus)
+        #A new process asking to take over
+        if self.serv.handoff_sock is not None:
+            self.selector.register(self.serv.handoff_sock,
+                                   selectors.EVENT_READ, self.serv.handoff_sock)
+
+    def accept(self) -> None:
+        """Accept pending connections and ask each for its username"""
+        serv = self.serv
+        for sock, host in serv.accept_pending():
+            try:
+                limiter = serv.admit(host)
+            except ratelimit.Refused as e:
+                #Still blocking, the notice goes out before it's registered.
+                #Not to TLS clients, they couldn't read it.
+                serv.reject(sock, e.reason, notify=serv.tls is None)
+                continue
+            if serv.tls is not None:
+                #The handshake is driven by socket events like the rest
+                sock = serv.tls.wrap_socket(sock, server_side=True,
+                                            do_handshake_on_connect=False)
+            client = ReactorClient(sock, self.selector,
+                                   serv.new_outbound_queue(),
+                                   serv.new_decoder(), self.dirty)
+            client.session = serv.attach(client, limiter)
+            try:
+                serv.ask_for_username(client)
+            except OSError as e:
+                serv.disconnect_client(client)
+
+    def flush_dirty(self) -> None:
+        """Write out every client that had output queued since last time"""
+        clients = list(self.dirty)
+        self.dirty.clear()
+        for client in clients:
+            if not client.closed:
+                self.on_writable(client)
+
+    def on_bus(self) -> None:
+        """Deliver broadcasts published by the other workers"""
+        try:
+            for packet in self.serv.bus.receive():
+                self.serv.deliver_remote(packet)
+        except OSError as e:
+            print(f"{self.serv.time_now()} Worker bus closed: {e}")
+            self.selector.unregister(self.serv.bus.sock)
+
+    def on_handshake(self, client: ReactorClient) -> None:
+        """Carry on with a TLS handshake, then send what waited for it"""
+        serv = self.serv
+        try:
+            if not client.handshake():
+                return
+        except (OSError, ValueError) as e:
+            serv.tls_failed(e)
+            serv.disconnect_client(client, metrics.TLS_ERROR)
+            return
+        serv.tls_established(client.sock)
+        #Off the handshake deadline, onto the username one
+        serv.watch(client.session, time.monotonic())
+        self.on_writable(client)
+        #What the client sent right behind its handshake won't wake the
+        #selector if the SSL object already took it off the socket
+        if not client.closed:
+            self.on_readable(client)
+
+    def on_readable(self, client: ReactorClient) -> None:
+        """Read and process what the socket has"""
+        self.read(client)
+        #TLS decrypts whole records, what didn't fit in the buffer waits in
+        #the SSL object and the socket won't show as readable for it
+        while client.tls and client.reading and not client.closed \
+                and client.sock.pending():
+            self.read(client)
+
+    def read(self, client: ReactorClient) -> None:
+        """Pull what the socket has into the input buffer and process it"""
+        serv = self.serv
+        try:
+            received = client.decoder.recv_into(client.sock)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return
+        except OSError as e:
+            print(f"{serv.time_now()} {client.session.username} - "
+                  f"OS Error: {e}")
+            serv.disconnect_client(client, metrics.ERROR)
+            return
+
+        session = client.session
+        if not received:
+            if session.username is not None:
+                print(f"{serv.time_now()} {session.username}: "
+                      "Connection closed.")
+            serv.disconnect_client(client)
+            return
+        session.last_seen = time.monotonic()
+        self.process(client)
+
+    def process(self, client: ReactorClient) -> None:
+        """Handle the whole frames in the input buffer until it's paused"""
+        serv = self.serv
+        session = client.session
+        try:
+            #One frame at a time, a pause leaves the rest in the buffer
+            while client.reading:
+                frame = next(client.decoder.frames(), None)
+                if frame is None:
+                    break
+                kind, payload = frame
+                if session.username is None:
+                    self.register(client, payload)
+                    if client.closed:
+                        return
+                    continue
+                if kind != protocol.TEXT:
+                    serv.handle_control(client, kind, payload)
+                    continue
+                verdict, wait = serv.limit(client, len(payload))
+                if verdict == ratelimit.DELAY:
+                    #The loop can't sleep, this message goes out and the
+                    #client is left alone until it has paid off what it
+                    #overdrew
+                    self.pause(client, wait)
+                elif verdict != ratelimit.ALLOW:
+                    continue
+                if serv.relay(client, payload):
+                    continue
+                msg = client.decoder.decode_text(payload)
+                print(f"{serv.time_now()} {session.username}: {msg}")
+                serv.handle_msg(client, session.username, msg, len(payload))
+        except protocol.FrameError as e:
+            print(f"{serv.time_now()} {session.username} - Frame Error: {e}")
+            serv.disconnect_client(client, metrics.FRAME_ERROR)
+        except ratelimit.Flooding as e:
+            print(f"{serv.time_now()} {session.username} - Flooding: {e}")
+            serv.disconnect_client(client, metrics.RATE_LIMITED)
+
+    def on_writable(self, client: ReactorClient) -> None:
+        """Drain the output buffer now that the socket has room"""
+        try:
+            client.flush()
+        except OSError as e:
+            print(f"{self.serv.time_now()} {client.session.username} - "
+                  f"Error sending: {e}")
+            self.serv.disconnect_client(client, metrics.SEND_ERROR)
+
+    def pause(self, client: ReactorClient, wait: float) -> None:
+        """Stop reading from client for wait seconds"""
+        resume_at = time.monotonic() + wait
+        self.paused[client] = max(resume_at, self.paused.get(client, 0.0))
+        client.reading = False
+        client.update_events()
+
+    def on_successor(self) -> None:
+        """Hand everything to a new process, returns only if that fails"""
+        conn = self.serv.accept_successor()
+        if conn is not None:
+            #Nothing else runs meanwhile, the snapshot is exact
+            self.serv.hand_off(conn)
+
+    def register(self, client: ReactorClient, data: bytes) -> None:
+        """Finish the username handshake for a new client"""
+        serv = self.serv
+        username = serv.parse_username(client, data)
+        if not serv.add_client(client=client, username=username):
+            serv.disconnect_client(client)
+            return
+        try:
+            serv.new_user_notification(client)
+            serv.send_welcome_msg(client, username)
+        except Exception as e:
+            serv.disconnect_client(client)
+
+    def resume(self, sock: socket.socket, state: dict) -> None:
+        """Pick up a client the previous process handed over"""
+        serv = self.serv
+        try:
+            limiter = serv.admit(sock.getpeername()[0])
+        except ratelimit.Refused as e:
+            serv.reject(sock, e.reason)
+            return
+        except OSError as e:
+            sock.close()
+            return
+        client = ReactorClient(sock, self.selector, serv.new_outbound_queue(),
+                               serv.new_decoder(), self.dirty)
+        client.session = serv.attach(client, limiter)
+        serv.resume(client, state)
+
+    def resume_due(self) -> None:
+        """Start reading again from clients whose pause is over"""
+        now = time.monotonic()
+        for client, resume_at in list(self.paused.items()):
+            if resume_at > now:
+                continue
+            del self.paused[client]
+            if not client.closed:
+                client.reading = True
+                #What came in with the message that paused it goes first
+                self.process(client)
+                if client.closed or not client.reading:
+                    continue
+                client.update_events()
+                #Input already decrypted won't wake the selector
+                if client.tls and client.sock.pending():
+                    self.on_readable(client)
+
+    def run_forever(self) -> None:
+        """Dispatch socket events until interrupted"""
+        budget = self.serv.write_budget
+        tick = self.serv.timers.tick
+        check_at = time.monotonic() + tick
+        while True:
+            #Wake up for the next heartbeat tick at the latest
+            timeout = check_at - time.monotonic()
+            #Output waits out the latency budget so bursts share writes
+            if self.dirty:
+                if self.flush_at is None:
+                    self.flush_at = time.monotonic() + budget
+                timeout = min(timeout, self.flush_at - time.monotonic())
+            if self.paused:
+                timeout = min(timeout,
+                              min(self.paused.values()) - time.monotonic())
+            for key, events in self.selector.select(max(0.0, timeout)):
+                client = key.data
+                if client is None:
+                    self.accept()
+                    continue
+                if client is self.serv.bus:
+                    self.on_bus()
+                    continue
+                if client is self.serv.handoff_sock:
+                    self.on_successor()
+                    continue
+                if client.handshaking:
+                    self.on_handshake(client)
+                    continue
+                if events & selectors.EVENT_WRITE and not client.closed:
+                    self.on_writable(client)
+                if events & selectors.EVENT_READ and not client.closed:
+                    self.on_readable(client)
+            if self.dirty:
+                if self.flush_at is None:
+                    self.flush_at = time.monotonic() + budget
+                if time.monotonic() >= self.flush_at:
+                    self.flush_at = None
+                    self.flush_dirty()
+            if self.paused:
+                self.resume_due()
+            if time.monotonic() >= check_at:
+                check_at = time.monotonic() + tick
+                self.serv.check_liveness()
+
+
+def run(serv: server.Server,
+        inherited: list[tuple[socket.socket, dict]]=()) -> None:
+    """Run the selectors reactor engine until interrupted"""
+    reactor = Reactor(serv)
+    #Clients handed over by the process this one replaced
+    for sock, state in inherited:
+        reactor.resume(sock, state)
+    try:
+        reactor.run_forever()
+    except KeyboardInterrupt as e:
+        print("\nServer has been terminated.")
+        try:
+            serv.close_all_connections()
+        except Exception as e:
+            print(f"{serv.time_now()} Unable to close all connections: {e}")
+    finally:
+        reactor.selector.close()
@@ -0,0 +1,51 @@
+import history as history_module
+import sessions
+
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME_SIZE = 20
+
+
+class Room():
+    """A named chat room and the set of sessions in it"""
+
+    def __init__(self, name: str, capacity: int,
+                 history: history_module.HistoryRing | None=None):
+        self.name = self.validate_name(name)
+        if capacity < 1:
+            raise ValueError(f"Room capacity must be at least 1: {capacity}")
+        self.capacity = capacity
+        #Recent chat replayed to whoever joins, None keeps no history
+        self.history = history
+        #Copy-on-write, readers iterate whatever frozenset they grabbed
+        #while joins and leaves swap in a new one
+        self.members: frozenset[sessions.Session] = frozenset()
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __repr__(self) -> str:
+        return f"<Room {self.name} {len(self.members)}/{self.capacity}>"
+
+    def add(self, session: sessions.Session) -> None:
+        self.members = self.members | {session}
+
+    def clear(self) -> None:
+        self.members = frozenset()
+
+    def discard(self, session: sessions.Session) -> None:
+        if session in self.members:
+            self.members = self.members - {session}
+
+    def has_room(self) -> bool:
+        """Let's you know if the room can take another member"""
+        return len(self.members) < self.capacity
+
+    @staticmethod
+    def validate_name(name: str) -> str:
+        """Room names are short single words"""
+        if not name or len(name) > MAX_ROOM_NAME_SIZE:
+            raise ValueError(
+                f"Room names are 1-{MAX_ROOM_NAME_SIZE} characters: {name!r}")
+        if not name.isprintable() or any(c.isspace() for c in name):
+            raise ValueError(f"Room names can't contain spaces: {name!r}")
+        return name
@@ -1,39 +1,279 @@
 import errno
-import datetime
 import ipaddress
 import logging
+import os
 import socket
+import ssl
+import sys
+import threading
+import time
 
 from contextlib import suppress
-from zoneinfo import ZoneInfo
+
+import bus as bus_module
+import handoff
+import heartbeat
+import history
+import log_pipeline
+import message_store
+import metrics
+import outbound
+import protocol
+import ratelimit
+import rooms
+import sessions
+import timestamps
+import tls as tls_module
 
 
 
 class Server():
     #Class Constants
-    BACKLOG = 10
+    #Most connections accept_pending takes per wake-up
+    ACCEPT_BATCH = 64
+    BACKLOG = 128
+    BYTE_RATE = 32 * 1024
+    COMMAND_PREFIX = '/'
+    #zlib level lines to clients that asked for compression are deflated
+    #at, 0 sends them uncompressed
+    COMPRESSION_LEVEL = 6
     DATASIZE = 4096
-    ENCODING = 'ISO-8859-1'
+    DEFAULT_ROOM = rooms.DEFAULT_ROOM
+    #Text is kept, stored and passed between workers in this, each client
+    #gets it in the encoding of its protocol version
+    ENCODING = 'utf-8'
+    #Seconds of silence before a framed client is pinged, and before one
+    #that hasn't answered is taken for dead
+    HEARTBEAT_INTERVAL = 30.0
+    HEARTBEAT_TIMEOUT = 90.0
+    HELP_MSG = (
+    "Commands: /rooms, /create <room> [capacity], /join <room>, /leave,"
+    " /history [count], /msg <user> <message>"
+    )
+    HISTORY_BYTES = 64 * 1024
+    HISTORY_QUERY_MAX = 200
+    HISTORY_QUERY_SIZE = 20
+    HISTORY_SIZE = 50
+    HOST_BYTE_RATE = 128 * 1024
+    HOST_MESSAGE_RATE = 40.0
+    #Seconds of silence before a client that can't be pinged is dropped
+    IDLE_TIMEOUT = 600.0
+    LOG_BACKUP_COUNT = 5
+    LOG_BATCH_SIZE = 256
+    LOG_FILE = 'server.log'
     LOG_FORMAT = '%(filename)s:%(name)s:%(message)s'
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_SAMPLE_RATE = 1.0
     MAX_CLIENTS = 100
     MAX_CLIENTS_REACHED_MSG = (
     "Server has reached the maximum amount of clients."
     "Please try again later."
     )
+    MAX_HOST_CLIENTS = 32
+    MAX_HOST_CLIENTS_REACHED_MSG = (
+    "Too many connections from your address. "
+    "Please try again later."
+    )
+    MAX_MESSAGE_SIZE = protocol.MAX_MESSAGE
+    MAX_ROOMS = 50
     MAX_USERNAME_SIZE = 20
+    MESSAGE_RATE = 10.0
+    MUTE_TIME = 30.0
+    OUTBOUND_QUEUE_SIZE = 256
+    OVERFLOW_POLICY = outbound.DROP_OLDEST
+    #Private messages are logged under this and the recipient's name, the
+    #space keeps /history in any room from finding them
+    PRIVATE_LOG_PREFIX = "@ "
+    RATE_ACTION = ratelimit.DROP
+    #Seconds of a rate a client may spend at once
+    RATE_BURST = 2.0
+    #Seconds between "sending too fast" notices to the same client
+    RATE_NOTICE_INTERVAL = 5.0
+    #Forward UTF-8 chat lines as received instead of decoding them
+    RELAY = False
+    ROOM_CAPACITY = 25
     TIME_FORMAT = '[%b %d, %Y - %H:%M:%S]'
     TIME_ZONE = 'US/Eastern'
+    WRITE_LATENCY_BUDGET = 0.0
     WELCOME_MSG = "Welcome to Link's Chatroom!"
     
     #Constructor
     def __init__(self, host: str, port: int, 
-                 client_map:dict[socket.socket, str] | None=None):
+                 max_clients: int | None=None,
+                 max_host_clients: int | None=None,
+                 backlog: int | None=None,
+                 history_size: int | None=None,
+                 queue_size: int | None=None,
+                 overflow_policy: str | None=None,
+                 log_sample_rate: float | None=None,
+                 log_max_bytes: int | None=None,
+                 log_file: str | None=None,
+                 store_dir: str | None=None,
+                 write_budget: float | None=None,
+                 message_rate: float | None=None,
+                 byte_rate: float | None=None,
+                 host_message_rate: float | None=None,
+                 host_byte_rate: float | None=None,
+                 rate_action: str | None=None,
+                 heartbeat_interval: float | None=None,
+                 heartbeat_timeout: float | None=None,
+                 idle_timeout: float | None=None,
+                 relay: bool | None=None,
+                 compression_level: int | None=None,
+                 reuse_port: bool=False,
+                 bus: bus_module.Bus | None=None,
+                 sock: socket.socket | None=None,
+                 handoff_path: str | None=None,
+                 tls: ssl.SSLContext | None=None):
         """Constructor for server class"""
+        self.clock = timestamps.Clock(self.TIME_ZONE, self.TIME_FORMAT)
         self.host = self.validate_host(host)
         self.port = self.validate_port(port)
         self.addr = (self.host, self.port)
-        self.client_map = dict(client_map) if client_map is not None else {}
-        self.sock = self.setup_socket()
+        #client_map, rooms and each Room's members are copy-on-write
+        #snapshots. Readers use whatever they grab without locking, only
+        #joins, leaves and room changes take the lock to swap in a new one.
+        self.metrics = metrics.ChatMetrics(
+            clients=lambda: self.client_map.values(),
+            rooms=lambda: len(self.rooms), dropped=self.dropped_messages
+        )
+        self.registry_lock = metrics.TimedLock(
+            threading.RLock(), self.metrics.lock_wait_seconds
+        )
+        #Every admitted connection's Session by file descriptor, and the
+        #ones that finished the handshake, which client_map snapshots
+        self.sessions: dict[int, sessions.Session] = {}
+        self.client_map: dict[int, sessions.Session] = {}
+        #Messages the outbound queues of connections since closed dropped
+        self.outbound_dropped = 0
+        #Username -> Session, names are unique regardless of case
+        self.usernames: dict[str, sessions.Session] = {}
+        #Username key -> index of the worker a user with that name is on,
+        #names are unique across workers too
+        self.remote_users: dict[str, int] = {}
+        self.max_clients = (
+            max_clients if max_clients is not None else self.MAX_CLIENTS
+        )
+        #Connections one address may hold open at once, 0 is no limit
+        self.max_host_clients = (
+            max_host_clients if max_host_clients is not None
+            else self.MAX_HOST_CLIENTS
+        )
+        self.backlog = backlog if backlog is not None else self.BACKLOG
+        if self.max_clients < 1 or self.max_host_clients < 0 \
+                or self.backlog < 1:
+            raise ValueError(
+                f"Invalid connection limits: {self.max_clients} clients, "
+                f"{self.max_host_clients} per address, backlog {self.backlog}")
+        #Messages each room replays to new members, 0 turns history off
+        self.history_size = (
+            history_size if history_size is not None else self.HISTORY_SIZE
+        )
+        #Room name -> Room, and each client's current Room. The lobby
+        #takes over the old global MAX_CLIENTS limit.
+        self.rooms = {
+            self.DEFAULT_ROOM: self.new_room(self.DEFAULT_ROOM,
+                                             self.max_clients)
+        }
+        self.queue_size = (
+            queue_size if queue_size is not None else self.OUTBOUND_QUEUE_SIZE
+        )
+        self.overflow_policy = (
+            overflow_policy if overflow_policy is not None
+            else self.OVERFLOW_POLICY
+        )
+        self.log_sample_rate = (
+            log_sample_rate if log_sample_rate is not None
+            else self.LOG_SAMPLE_RATE
+        )
+        self.log_max_bytes = (
+            log_max_bytes if log_max_bytes is not None else self.LOG_MAX_BYTES
+        )
+        self.log_file = log_file if log_file is not None else self.LOG_FILE
+        #Seconds queued output may wait for more to share its write, with
+        #no budget whatever queued up in the meantime still goes together
+        self.write_budget = (
+            write_budget if write_budget is not None
+            else self.WRITE_LATENCY_BUDGET
+        )
+        if self.write_budget < 0:
+            raise ValueError(
+                f"Write budget can't be negative: {self.write_budget}")
+        #Per connection and per address limits, a rate of 0 is no limit
+        self.message_rate = (
+            message_rate if message_rate is not None else self.MESSAGE_RATE
+        )
+        self.byte_rate = byte_rate if byte_rate is not None else self.BYTE_RATE
+        self.host_message_rate = (
+            host_message_rate if host_message_rate is not None
+            else self.HOST_MESSAGE_RATE
+        )
+        self.host_byte_rate = (
+            host_byte_rate if host_byte_rate is not None
+            else self.HOST_BYTE_RATE
+        )
+        self.rate_action = (
+            rate_action if rate_action is not None else self.RATE_ACTION
+        )
+        if self.rate_action not in ratelimit.RATE_ACTIONS:
+            raise ValueError(f"Unknown rate limit action: {self.rate_action}")
+        #Address buckets admitted clients share, an admitted connection
+        #holds its slot until it's disconnected
+        self.hosts: dict[str, ratelimit.HostLimits] = {}
+        self.admitted = 0
+        #Liveness, 0 turns any of these off
+        self.heartbeat_interval = (
+            heartbeat_interval if heartbeat_interval is not None
+            else self.HEARTBEAT_INTERVAL
+        )
+        self.heartbeat_timeout = (
+            heartbeat_timeout if heartbeat_timeout is not None
+            else self.HEARTBEAT_TIMEOUT
+        )
+        self.idle_timeout = (
+            idle_timeout if idle_timeout is not None else self.IDLE_TIMEOUT
+        )
+        if min(self.heartbeat_interval, self.heartbeat_timeout,
+               self.idle_timeout) < 0:
+            raise ValueError("Heartbeat times can't be negative")
+        if self.heartbeat_interval and self.heartbeat_timeout \
+                and self.heartbeat_timeout <= self.heartbeat_interval:
+            raise ValueError(
+                f"Heartbeat timeout {self.heartbeat_timeout} has to be "
+                f"longer than the interval {self.heartbeat_interval}")
+        #Every admitted client has one timer keyed by its descriptor, when
+        #it fires the client is pinged, dropped or just checked again later
+        self.timers = heartbeat.TimerWheel(time.monotonic())
+        #In relay mode each sender's "time username: " prefix is encoded
+        #once a second and chat bodies are never decoded
+        self.relay_mode = relay if relay is not None else self.RELAY
+        self.compression_level = (
+            compression_level if compression_level is not None
+            else self.COMPRESSION_LEVEL
+        )
+        if not 0 <= self.compression_level <= 9:
+            raise ValueError(
+                f"Compression level must be 0-9: {self.compression_level}")
+        #Set when running as one of several workers sharing the port
+        self.reuse_port = reuse_port
+        self.bus = bus
+        #Fail fast on a bad queue configuration
+        self.new_outbound_queue()
+        #Durable record of every chat line said on this server, if kept
+        self.store = (
+            message_store.MessageStore(store_dir) if store_dir is not None
+            else None
+        )
+        #A listening socket handed over by the process this one replaces
+        self.sock = sock if sock is not None else self.setup_socket()
+        #Clients speak TLS when set. The listening socket stays plain, each
+        #engine does the handshakes where they can't hold up accepting.
+        self.tls = tls
+        #Where a process replacing this one asks for its sockets
+        self.handoff_sock = (
+            handoff.listen(handoff_path) if handoff_path is not None
+            else None
+        )
         self.logger = self.create_logger()
 
     #Methods
@@ -41,63 +281,292 @@ class Server():
         """Accept connections, essentially a wrapper for socket.accept()"""
         client, addr = self.sock.accept()
         host, port = addr
-        log_msg = f"{self.time_now()} Accepted: {client}"
-        self.logger.info(log_msg)
+        #Half-open connections the heartbeat can't reach still get reaped
+        with suppress(OSError):
+            heartbeat.set_keepalive(client)
+        self.metrics.accepted.inc()
+        self.logger.info("%s Accepted: %s", self.time_now(), client)
         return client, host, port
 
 
+    def accept_pending(self) -> list[tuple[socket.socket, str]]:
+        """Accept up to ACCEPT_BATCH queued connections without blocking"""
+        #One wake-up drains a reconnect storm instead of one connection
+        accepted = []
+        while len(accepted) < self.ACCEPT_BATCH:
+            try:
+                client, host, _ = self.accept_connection()
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionAbortedError:
+                continue
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE):
+                    raise
+                print(f"{self.time_now()} Unable to accept: {e}")
+                break
+            accepted.append((client, host))
+        return accepted
+
+
+    def accept_successor(self) -> socket.socket | None:
+        """Accept a process asking to take over, None if it may not"""
+        try:
+            conn, _ = self.handoff_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return None
+        if not handoff.same_user(conn):
+            print(f"{self.time_now()} Refused a handoff to another user")
+            conn.close()
+            return None
+        return conn
+
+
     def add_client(self, client: socket.socket, username: str) -> bool:
         #Lock this section to ensure proper count of clients
-        if len(self.client_map) < self.MAX_CLIENTS:
-            self.client_map[client] = username
-            log_msg = f"{self.time_now()} Added: {username} {client}"
-            self.logger.info(log_msg)
-            return True
-        log_msg = f"{self.time_now()} Not Added: {username} {client}"
-        self.logger.info(log_msg)
+        with self.registry_lock:
+            session = self.session(client)
+            taken = self.name_taken(username)
+            lobby = self.rooms[self.DEFAULT_ROOM]
+            if session is not None and not taken and lobby.has_room():
+                self.register(session, username)
+                self.logger.info("%s Added: %s %s", self.time_now(),
+                                 username, client)
+                #Out of the handshake, its framing now decides its timeouts
+                self.watch(session, time.monotonic())
+                return True
+        self.logger.info("%s Not Added: %s %s", self.time_now(), username,
+                         client)
+        if taken:
+            with suppress(OSError):
+                self.send_msg(client, f"{self.time_now()} Username "
+                                      f"{username} is already taken.")
         return False
 
 
+    def admit(self, host: str) -> ratelimit.Limiter:
+        """Reserve a connection slot for host, raises Refused if there's none"""
+        #Checked before the connection gets a thread or buffers, so a
+        #reconnect storm is turned away for the price of an accept
+        with self.registry_lock:
+            if self.admitted >= self.max_clients or not self.is_there_room():
+                raise ratelimit.Refused(metrics.SERVER_FULL)
+            limits = self.hosts.get(host)
+            if limits is None:
+                limits = ratelimit.HostLimits(
+                    host, self.new_bucket(self.host_message_rate),
+                    self.new_bucket(self.host_byte_rate)
+                )
+                self.hosts[host] = limits
+            elif (self.max_host_clients
+                    and limits.connections >= self.max_host_clients):
+                raise ratelimit.Refused(metrics.HOST_FULL)
+            limits.connections += 1
+            self.admitted += 1
+            return self.new_limiter(limits)
+
+
     def ask_for_username(self, client: socket.socket) -> None:
         """Ask the client to send their desire username for the chat"""
         msg = f"{self.time_now()} Please enter your username:"
-        client.sendall(msg.encode(self.ENCODING))
-        log_msg = f"{self.time_now()} Sent: {msg} to {client}"
-        self.logger.info(log_msg)
+        #Nothing is negotiated yet, so the prompt goes out as legacy text
+        client.sendall(msg.encode(protocol.LEGACY_ENCODING))
+        self.logger.info("%s Sent: %s to %s", self.time_now(), msg, client)
+
+
+    def attach(self, client: socket.socket,
+               limiter: ratelimit.Limiter) -> sessions.Session:
+        """Open client's Session in the slot admit() reserved and watch it"""
+        #Disconnecting frees the slot and stops the timer
+        session = sessions.Session(client, client.fd, limiter)
+        with self.registry_lock:
+            self.sessions[session.fd] = session
+        self.watch(session, time.monotonic())
+        return session
+
+
+    def broadcast_chat(self, client: socket.socket, username: str,
+                       msg: str) -> bytes:
+        """Send a chat line from client to everyone else in their room"""
+        session = self.session(client)
+        room = session.room if session is not None else None
+        if room is None:
+            return b""
+        return self.fanout(
+            f"{self.time_now()} {username}: {msg}", exclude=client, log=False,
+            room=room.name, chat=True
+        )
 
 
     def broadcast_msg(self, msg: str) -> None:
-        """Send a broadcast message to all clients in the chatroom"""
-        for connection in self.client_map.keys():
-            connection.sendall(msg.encode(self.ENCODING))
-            log_msg = f"{self.time_now()} Sent: {msg} to {connection}"
-            self.logger.info(log_msg)
+        """Send a broadcast message to all clients in every room"""
+        self.fanout(msg)
+
+
+    def change_room(self, client: socket.socket, room: rooms.Room) -> None:
+        """Move a client into room and let both rooms know"""
+        session = self.session(client)
+        if session is None:
+            raise ValueError("You are no longer connected.")
+        with self.registry_lock:
+            if session.room is room:
+                raise ValueError(f"You are already in {room.name}.")
+            #Emptied out and dropped since the caller looked it up
+            if self.rooms.get(room.name) is not room:
+                raise ValueError(f"There is no room named {room.name}.")
+            if not room.has_room():
+                raise ValueError(f"Room {room.name} is full.")
+            username = session.username
+            old_room = self.leave_room(session)
+            self.enter_room(session, room)
+
+        now = self.time_now()
+        if old_room is not None:
+            self.fanout(f"{now} {username} has left {old_room.name}.",
+                        room=old_room.name)
+        self.fanout(f"{now} {username} has joined {room.name}.",
+                    exclude=client, room=room.name)
+        self.send_msg(client, f"{now} You are now in {room.name}.")
+        self.replay_history(client, room)
+
+
+    def check_liveness(self) -> None:
+        """Ping or drop clients whose timers fired, engines call it per tick"""
+        now = time.monotonic()
+        for fd in self.timers.advance(now):
+            #Already gone, its timer fired before disconnecting cancelled it
+            session = self.sessions.get(fd)
+            if session is None:
+                continue
+            client = session.client
+            interval, timeout = self.silence_limits(session)
+            silent = now - session.last_seen
+            if timeout and silent >= timeout and self.handshaking(client):
+                self.tls_failed(TimeoutError(
+                    f"Timed out after {silent:.0f}s"))
+                self.disconnect_client(client, metrics.TLS_ERROR)
+                continue
+            if timeout and silent >= timeout:
+                print(f"{self.time_now()} {session.username} - "
+                      f"Timed out after {silent:.0f}s of silence")
+                self.disconnect_client(client, metrics.TIMED_OUT)
+                continue
+            if interval and silent >= interval:
+                try:
+                    client.sendall(protocol.encode_frame(b"", protocol.PING))
+                except OSError as e:
+                    self.disconnect_client(client, metrics.SEND_ERROR)
+                    continue
+            self.watch(session, now)
 
 
     def close_all_connections(self) -> None:
         """Close all the connections"""
-        connections_to_close = dict(self.client_map)
-        self.client_map.clear()
-        for connection in connections_to_close.keys():
+        with self.registry_lock:
+            connections_to_close = self.client_map
+            self.client_map = {}
+            self.usernames = {}
+            for room in self.rooms.values():
+                room.clear()
+        self.metrics.disconnects.inc(len(connections_to_close),
+                                     metrics.SHUTDOWN)
+        for session in connections_to_close.values():
+            session.room = None
+            connection = session.client
+            #Logged first, a closed socket no longer shows its peer
+            self.logger.info("%s Closed: %s", self.time_now(), connection)
             connection.shutdown(socket.SHUT_RDWR)
             connection.close()
-            log_msg = f"{self.time_now()} Closed: {connection}"
-            self.logger.info(log_msg)
+
+    def close_store(self) -> None:
+        """Commit every chat line still on its way to disk"""
+        if self.store is not None:
+            self.store.close()
+
+
+    def close_logger(self) -> None:
+        """Write out everything still queued and stop the log writer"""
+        self.log_listener.stop()
+        for handler in self.log_listener.handlers:
+            handler.close()
+
 
     def create_logger(self) -> logging.Logger:
-        """Creates the logger for the server"""
+        """Creates the logger for the server, file I/O runs off-thread"""
         logger = logging.getLogger(__name__)
         logger.setLevel(logging.INFO)
-        file_handler = logging.FileHandler('server.log')
-        formatter = logging.Formatter(self.LOG_FORMAT)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        self.log_listener = log_pipeline.create_pipeline(
+            logger, self.log_file, self.LOG_FORMAT, self.log_max_bytes,
+            self.LOG_BACKUP_COUNT, self.LOG_BATCH_SIZE
+        )
+        #Per-recipient "Sent" lines, sampled so big rooms don't flood the log.
+        #The child logger is process-wide, so this server's filter replaces
+        #whatever an earlier one installed.
+        self.sent_logger = logger.getChild('sent')
+        for old in list(self.sent_logger.filters):
+            if isinstance(old, log_pipeline.SampleFilter):
+                self.sent_logger.removeFilter(old)
+        self.sent_logger.addFilter(
+            log_pipeline.SampleFilter(self.log_sample_rate))
+        self.sent_logger.disabled = self.log_sample_rate == 0
         return logger
 
 
-    def disconnect_client(self, client: socket.socket) -> None:
-        """Remove the client from the chatroom and notify the chat"""
-        username = self.client_map.pop(client, None)
+    def create_room(self, name: str, capacity: int | None=None) -> rooms.Room:
+        """Create a room, ValueError explains why it couldn't be"""
+        capacity = capacity if capacity is not None else self.ROOM_CAPACITY
+        if capacity > self.max_clients:
+            raise ValueError(f"Room capacity is limited to {self.max_clients}.")
+        room = self.new_room(name, capacity)
+        with self.registry_lock:
+            if name in self.rooms:
+                raise ValueError(f"Room {name} already exists.")
+            if len(self.rooms) >= self.MAX_ROOMS:
+                raise ValueError(
+                    "Server has reached the maximum amount of rooms.")
+            self.rooms = {**self.rooms, name: room}
+        self.logger.info("%s Created room: %r", self.time_now(), room)
+        #Other workers learn about the room so their users can join it too
+        if self.bus is not None:
+            self.bus.publish(str(capacity).encode(), room=name,
+                             kind=bus_module.ROOM_CREATED)
+        return room
+
+
+    def disconnect_client(self, client: socket.socket,
+                          reason: str=metrics.CLOSED) -> None:
+        """Remove the client from the chatroom and notify the room"""
+        with self.registry_lock:
+            #None when it never got this far, or when it's already been
+            #disconnected and a new connection reuses its descriptor
+            session = self.session(client)
+            username = room = None
+            if session is not None:
+                del self.sessions[session.fd]
+                room = self.leave_room(session)
+                if session.limiter is not None:
+                    self.release(session.limiter)
+                #Shutting down already cleared the registry
+                if self.client_map.get(session.fd) is session:
+                    username = session.username
+            if username is not None:
+                client_map = dict(self.client_map)
+                del client_map[session.fd]
+                self.client_map = client_map
+                self.outbound_dropped += client.queue.dropped
+                key = self.user_key(username)
+                if self.usernames.get(key) is session:
+                    usernames = dict(self.usernames)
+                    del usernames[key]
+                    self.usernames = usernames
+                    if self.bus is not None:
+                        self.bus.publish(str(self.bus.index).encode(),
+                                         room=key,
+                                         kind=bus_module.NAME_RELEASED)
+        if session is not None:
+            self.timers.cancel(session.fd)
+        #Logged first, a closed socket no longer shows its peer
+        self.logger.info("%s Closed: %s", self.time_now(), client)
         try:
             client.shutdown(socket.SHUT_RDWR)
         except OSError as e:
@@ -106,92 +575,765 @@ class Server():
         finally:
             with suppress(OSError):
                 client.close()
-                log_msg = f"{self.time_now()} Closed: {client}"
-                self.logger.info(log_msg)
 
         #Never had the user registered, so nothing to broadcast
         if not username:
             return
         
+        #Whatever the reader saw, a full queue is why the socket went away
+        queue = getattr(client, "queue", None)
+        if queue is not None and queue.overflowed:
+            reason = metrics.SLOW_CONSUMER
+        self.metrics.disconnects.inc(value=reason)
         remove_user_msg = f"{self.time_now()} {username} has disconnected."
-        
-        for connection in self.client_map.keys():
-            connection.sendall(remove_user_msg.encode(self.ENCODING))
-            log_msg = f"{self.time_now()} Sent: {remove_user_msg} to {client}"
-            self.logger.info(log_msg)
+        self.fanout(remove_user_msg,
+                    room=room.name if room is not None else None)
+
+
+    def deliver(self, data: bytes, exclude: socket.socket | None=None,
+                msg: str | None=None, room: str | None=None,
+                frame: bytes | None=None) -> None:
+        """Hand the same encoded bytes to every local member of room"""
+        #Snapshots, joins and leaves during the loop swap in new ones
+        #instead of changing these under us. No room means every local
+        #connection.
+        if room is None:
+            targets = self.client_map.values()
+        elif room in self.rooms:
+            targets = self.rooms[room].members
+        else:
+            return
+        start = self.clock.monotonic_ns()
+        now = self.time_now()
+        log = msg is not None and self.sent_logger.isEnabledFor(logging.INFO)
+        #Encoded, framed and compressed once per protocol version, every
+        #recipient speaking it shares the same bytes
+        wire = {}
+        if frame is not None:
+            wire[protocol.FRAMED_UTF8] = frame
+        failed = []
+        sent = sent_bytes = 0
+        for session in targets:
+            connection = session.client
+            if connection is exclude:
+                continue
+            version = connection.version
+            out = wire.get(version)
+            if out is None:
+                out = wire[version] = self.wire_bytes(version, data)
+            try:
+                connection.sendall(out)
+                sent_bytes += len(out)
+                sent += 1
+            except OSError as e:
+                print(f"{now} {session.username} - Error sending: {e}")
+                failed.append(connection)
+                continue
+            if log:
+                self.sent_logger.info("%s Sent: %s to %s", now, msg,
+                                      connection)
+
+        self.metrics.messages_out.inc(sent)
+        self.metrics.bytes_out.inc(sent_bytes)
+        self.metrics.fanout_seconds.observe(
+            (self.clock.monotonic_ns() - start) / 1e9)
+
+        #Drop dead peers only after the loop, each one fans out a notice
+        for connection in failed:
+            self.disconnect_client(connection, metrics.SEND_ERROR)
+
+
+    def deliver_remote(self, packet: tuple[int, str, bytes]) -> None:
+        """Apply a packet another worker published on the bus"""
+        kind, room, body = packet
+        if kind == bus_module.ROOM_CREATED:
+            with self.registry_lock:
+                if room not in self.rooms:
+                    new_room = self.new_room(room, int(body))
+                    self.rooms = {**self.rooms, room: new_room}
+        elif kind == bus_module.ROOM_REMOVED:
+            with self.registry_lock:
+                local = self.rooms.get(room)
+                if local is None:
+                    return
+                if len(local):
+                    #Still in use here, have the other workers put it back
+                    self.bus.publish(str(local.capacity).encode(), room=room,
+                                     kind=bus_module.ROOM_CREATED)
+                    return
+                rooms = dict(self.rooms)
+                del rooms[room]
+                self.rooms = rooms
+        elif kind == bus_module.NAME_CLAIMED:
+            self.remote_claim(room, int(body))
+        elif kind == bus_module.NAME_RELEASED:
+            with self.registry_lock:
+                if self.remote_users.get(room) == int(body):
+                    del self.remote_users[room]
+        elif kind == bus_module.WORKER_EXITED:
+            worker = int(body)
+            with self.registry_lock:
+                self.remote_users = {
+                    key: index for key, index in self.remote_users.items()
+                    if index != worker
+                }
+        elif kind == bus_module.CHAT:
+            self.deliver(body, room=room, frame=self.remember(room, body))
+        elif kind == bus_module.MESSAGE:
+            self.deliver(body, room=room or None)
+
+
+    def direct_msg(self, client: socket.socket, to: str, text: str) -> str:
+        """Send text to one user only, returns the sender's copy of it"""
+        #One index lookup, no other connection is looked at
+        target = self.find_user(to)
+        if target is None and self.user_key(to) in self.remote_users:
+            raise ValueError(f"{to} is on another worker, private messages "
+                             "only reach users on this one.")
+        if target is None:
+            raise ValueError(f"There is no user named {to}.")
+        if target.client is client:
+            raise ValueError("You can't message yourself.")
+        session = self.session(client)
+        if session is None:
+            raise ValueError("You are no longer connected.")
+        now = self.time_now()
+        sender = session.username
+        username = target.username
+        line = f"{now} {sender} (private): {text}"
+        try:
+            self.send_msg(target.client, line)
+        except OSError as e:
+            self.disconnect_client(target.client, metrics.SEND_ERROR)
+            raise ValueError(f"Your message to {username} was not delivered.")
+        if self.store is not None:
+            self.store.append(self.PRIVATE_LOG_PREFIX + username,
+                              line.encode(self.ENCODING))
+        return f"To {username} (private): {text}"
+
+
+    def dropped_messages(self) -> dict[str, int]:
+        """Messages dropped so far, by the queue that had no room for them"""
+        dropped = {"outbound": self.outbound_dropped + sum(
+            session.client.queue.dropped
+            for session in self.client_map.values()
+        )}
+        if self.bus is not None:
+            dropped["bus"] = self.bus.dropped
+        return dropped
+
+
+    def enter_room(self, session: sessions.Session,
+                   room: rooms.Room) -> None:
+        """Index session as a member of room"""
+        with self.registry_lock:
+            room.add(session)
+            session.room = room
+
+
+    def fanout(self, msg: str, exclude: socket.socket | None=None,
+               log: bool=True, room: str | None=None,
+               chat: bool=False) -> bytes:
+        """Encode msg once and send it to room on every worker"""
+        data = msg.encode(self.ENCODING)
+        self.fanout_data(data, exclude=exclude, msg=msg if log else None,
+                         room=room, chat=chat)
+        return data
+
+
+    def fanout_data(self, data: bytes, exclude: socket.socket | None=None,
+                    msg: str | None=None, room: str | None=None,
+                    chat: bool=False, frame: bytes | None=None) -> None:
+        """Send data already in ENCODING to room on every worker"""
+        #Chat lines go into the room's history, notices don't
+        if chat:
+            frame = self.remember(room, data, frame)
+            #Only lines said here, every worker keeps its own store
+            if self.store is not None:
+                self.store.append(room or "", data)
+        if self.bus is not None:
+            kind = bus_module.CHAT if chat else bus_module.MESSAGE
+            self.bus.publish(data, room=room or "", kind=kind)
+        self.deliver(data, exclude=exclude, msg=msg, room=room, frame=frame)
+
+
+    def find_user(self, username: str) -> sessions.Session | None:
+        """Session of the user called username, None if there's none"""
+        return self.usernames.get(self.user_key(username))
+
+
+    def hand_off(self, conn: socket.socket) -> None:
+        """Pass the port and every user to the process on conn and exit"""
+        state, clients = self.snapshot()
+        try:
+            handoff.hand_off(conn, self.sock, state, clients)
+        except (OSError, handoff.HandoffError) as e:
+            print(f"{self.time_now()} Handoff failed, still serving: {e}")
+            conn.close()
+            return
+        msg = f"{self.time_now()} Handed {len(clients)} clients over"
+        print(msg)
+        self.logger.info("%s", msg)
+        self.close_store()
+        self.close_logger()
+        sys.stdout.flush()
+        #A normal exit says goodbye on connections that now belong to the
+        #new process. conn closes with the process, which tells the new
+        #one the store and the log are free.
+        os._exit(0)
+
+
+    def handle_control(self, client: socket.socket, kind: int,
+                       payload: bytes) -> None:
+        """Answer a heartbeat frame, any other kind is a protocol error"""
+        if kind == protocol.PING:
+            client.sendall(protocol.encode_frame(payload, protocol.PONG))
+        elif kind != protocol.PONG:
+            raise protocol.FrameError(f"Unknown frame kind {kind}")
+
+
+    def handle_msg(self, client: socket.socket, username: str,
+                   msg: str, size: int) -> None:
+        """Run a /command or send a chat line to the client's room"""
+        #Another thread, the heartbeat or the bus, can disconnect it while
+        #its reader is still working through what it already received
+        session = self.session(client)
+        if session is None:
+            return
+        self.metrics.messages_in.inc()
+        self.metrics.bytes_in.inc(size)
+        session.messages_in += 1
+        session.bytes_in += size
+        if msg.lstrip().startswith(self.COMMAND_PREFIX):
+            self.run_command(client, msg)
+        else:
+            self.broadcast_chat(client, username, msg)
 
 
     def is_there_room(self) -> bool:
-        """Let's you know if server is full"""
-        if len(self.client_map) < self.MAX_CLIENTS:
-            return True
-        return False
+        """Let's you know if the lobby new clients land in is full"""
+        return self.rooms[self.DEFAULT_ROOM].has_room()
+
+
+    def leave_room(self, session: sessions.Session) -> rooms.Room | None:
+        """Drop session from its room's index, returns the room it was in"""
+        with self.registry_lock:
+            room = session.room
+            session.room = None
+            if room is not None:
+                room.discard(session)
+                self.remove_room(room)
+        return room
+
+
+    def limit(self, client: socket.socket, size: int) -> tuple[str, float]:
+        """Rate limit verdict and delay for a size byte message from client"""
+        session = self.session(client)
+        limiter = session.limiter if session is not None else None
+        if limiter is None:
+            return ratelimit.ALLOW, 0.0
+        action = self.rate_action
+        now = time.monotonic()
+        muted = limiter.muted_until > now
+        wait = limiter.check(size, delay=action == ratelimit.DELAY)
+        if not wait:
+            return ratelimit.ALLOW, 0.0
+
+        self.metrics.rate_limited.inc(value=action)
+        if action == ratelimit.DELAY:
+            self.metrics.rate_limit_delay.inc(wait)
+            return ratelimit.DELAY, wait
+        if action == ratelimit.DISCONNECT:
+            self.send_msg(client, f"{self.time_now()} Disconnected for "
+                                  "sending too fast.")
+            raise ratelimit.Flooding(f"over the rate limit by {wait:.2f}s")
+        if action == ratelimit.MUTE and not muted:
+            limiter.muted_until = now + self.MUTE_TIME
+            self.send_msg(client, f"{self.time_now()} You are muted for "
+                                  f"{self.MUTE_TIME:g} seconds for flooding.")
+        elif (action == ratelimit.DROP
+                and now - limiter.warned_at >= self.RATE_NOTICE_INTERVAL):
+            limiter.warned_at = now
+            self.send_msg(client, f"{self.time_now()} You are sending too "
+                                  "fast, messages are being dropped.")
+        return ratelimit.DROP, wait
+
 
     def listen_for_connections(self) -> None:
         """Listens for connections, provides msg and log input"""
         ### NEED TO IMPLEMENT LOGGING CAPE ###
         msg = f"{self.time_now()} Listening for connections on {self.addr}"
         print(msg)
-        self.logger.info(msg)
-        self.sock.listen(self.BACKLOG)
+        self.logger.info("%s", msg)
+        self.sock.listen(self.backlog)
+        #Engines wait for readiness and drain the queue with accept_pending
+        self.sock.setblocking(False)
 
 
-    def max_capacity_notification(self, client: socket.socket) -> None:
-        """Let client know the server is maxed out, try again later"""
-        client.sendall(self.MAX_CLIENTS_REACHED_MSG.encode(self.ENCODING))
-        log_msg = (
-            f"{self.time_now()} Sent {self.MAX_CLIENTS_REACHED_MSG} to "
-            f"{client}"
-        )
-        self.logger.info(log_msg)
+    def name_taken(self, username: str) -> bool:
+        """Whether a user here or on another worker is called username"""
+        key = self.user_key(username)
+        return key in self.usernames or key in self.remote_users
 
 
     def new_user_notification(self, client: socket.socket) -> None:
         """Notify chatroom that a new user has enter the chat"""
-        new_user_msg = f"{self.time_now()} {self.client_map[client]} "
+        session = self.session(client)
+        if session is None or session.room is None:
+            return
+        new_user_msg = f"{self.time_now()} {session.username} "
         new_user_msg += "has entered the chat."
-        for connection in self.client_map.keys():
-            if connection is not client:
-                connection.sendall(new_user_msg.encode(self.ENCODING))
-                log_msg = f"{self.time_now()} Sent {new_user_msg} to {connection}"
-                self.logger.info(log_msg)
+        self.fanout(new_user_msg, exclude=client, room=session.room.name)
 
 
-    def process_username(self, client: socket.socket) -> str:
-        """Process the client's username"""
-        data = client.recv(self.DATASIZE)
-        username = data.decode(self.ENCODING).strip()
+    def new_decoder(self) -> protocol.FrameDecoder:
+        """Create the frame decoder for a new connection"""
+        return protocol.FrameDecoder(max_payload=self.MAX_MESSAGE_SIZE)
+
+
+    def new_bucket(self, rate: float) -> ratelimit.TokenBucket | None:
+        """Bucket for rate a second, None when rate is 0 (unlimited)"""
+        if not rate:
+            return None
+        return ratelimit.TokenBucket(rate, rate * self.RATE_BURST)
+
+
+    def new_limiter(self, limits: ratelimit.HostLimits) -> ratelimit.Limiter:
+        """Create the rate limiter of a client, sharing its host's buckets"""
+        return ratelimit.Limiter(self.new_bucket(self.message_rate),
+                                 self.new_bucket(self.byte_rate), limits)
+
+
+    def new_outbound_queue(self) -> outbound.OutboundQueue:
+        """Create the bounded outbound queue for a new connection"""
+        return outbound.OutboundQueue(self.queue_size, self.overflow_policy)
+
+
+    def new_room(self, name: str, capacity: int) -> rooms.Room:
+        """Create a room with its own bounded history"""
+        ring = None
+        if self.history_size > 0:
+            ring = history.HistoryRing(self.history_size, self.HISTORY_BYTES)
+        return rooms.Room(name, capacity, ring)
+
+
+    def parse_username(self, client: socket.socket, data: bytes) -> str:
+        """Turn the raw username bytes sent by a client into a username"""
+        username = client.decoder.decode_text(data, final=True).strip()
 
         if len(username) > self.MAX_USERNAME_SIZE:
-            return username[:self.MAX_USERNAME_SIZE]
+            username = username[:self.MAX_USERNAME_SIZE]
         elif not username:
-            username = f"User_{len(self.client_map)}"
+            #Skip past names someone already picked themselves
+            number = len(self.client_map)
+            while self.name_taken(f"User_{number}"):
+                number += 1
+            username = f"User_{number}"
         
-        log_msg = f"{self.time_now()} Recv: {username} from {client}"
-        self.logger.info(log_msg)
+        self.logger.info("%s Recv: %s from %s", self.time_now(), username,
+                         client)
         return username
+
+
+    def process_username(self, client: socket.socket) -> str:
+        """Process the client's username, negotiating framing on the way"""
+        decoder = client.decoder
+        while True:
+            for _, payload in decoder.frames():
+                return self.parse_username(client, payload)
+            if not decoder.recv_into(client):
+                return self.parse_username(client, b"")
     
 
+    def query_history(self, client: socket.socket, count: str | None) -> str:
+        """Look up the last chat lines of client's room in the store"""
+        if self.store is None:
+            raise ValueError("This server doesn't keep a message log.")
+        if count is not None and not count.isdigit():
+            raise ValueError("History count must be a number.")
+        count = int(count) if count is not None else self.HISTORY_QUERY_SIZE
+        count = min(count, self.HISTORY_QUERY_MAX)
+        session = self.session(client)
+        if session is None or session.room is None:
+            raise ValueError("You are no longer connected.")
+        room = session.room.name
+        try:
+            lines = self.store.tail(room, count)
+        except message_store.StoreError as e:
+            self.logger.error("%s History query failed: %s", self.time_now(), e)
+            raise ValueError("The message log can't be read right now.")
+        if not lines:
+            return f"Nothing has been said in {room} yet."
+        return f"Last {len(lines)} in {room}:\n" + "\n".join(
+            str(data, self.ENCODING, "replace") for _, data in lines
+        )
+
+
+    def register(self, session: sessions.Session, username: str) -> None:
+        """Add a session that finished the handshake to every index"""
+        with self.registry_lock:
+            session.username = username
+            session.prefix = f" {username}: ".encode(self.ENCODING)
+            self.client_map = {**self.client_map, session.fd: session}
+            self.usernames = {**self.usernames,
+                              self.user_key(username): session}
+            self.enter_room(session, self.rooms[self.DEFAULT_ROOM])
+        if self.bus is not None:
+            self.bus.publish(str(self.bus.index).encode(),
+                             room=self.user_key(username),
+                             kind=bus_module.NAME_CLAIMED)
+
+
+    def reject(self, client: socket.socket, reason: str,
+               notify: bool=True) -> None:
+        """Tell a refused connection why, unless notify is off, and close it"""
+        msg = (
+            self.MAX_HOST_CLIENTS_REACHED_MSG if reason == metrics.HOST_FULL
+            else self.MAX_CLIENTS_REACHED_MSG
+        )
+        self.metrics.disconnects.inc(value=reason)
+        try:
+            if notify:
+                client.sendall(msg.encode(protocol.LEGACY_ENCODING))
+                self.logger.info("%s Sent %s to %s", self.time_now(), msg,
+                                 client)
+        except OSError as e:
+            print(f"{self.time_now()} Error refusal message: {e}")
+        finally:
+            with suppress(OSError):
+                client.close()
+
+
+    def release(self, limiter: ratelimit.Limiter) -> None:
+        """Give back the connection slot admit() reserved"""
+        with self.registry_lock:
+            limits = limiter.host
+            limits.connections -= 1
+            self.admitted -= 1
+            if not limits.connections:
+                del self.hosts[limits.host]
+
+
+    def relay(self, client: socket.socket, payload: memoryview) -> bool:
+        """Forward a chat line as received, False if it needs decoding"""
+        #Only UTF-8 bodies are already in ENCODING, and commands are parsed
+        if not self.relay_mode \
+                or client.version not in protocol.UTF8_VERSIONS:
+            return False
+        session = self.session(client)
+        #Disconnected meanwhile, there's nobody to relay it for
+        if session is None:
+            return True
+        #A character split across frames has to be put back together first
+        if not client.decoder.ends_whole(payload):
+            return False
+        for byte in payload:
+            if not chr(byte).isspace():
+                if byte == ord(self.COMMAND_PREFIX):
+                    return False
+                break
+        self.metrics.messages_in.inc()
+        self.metrics.bytes_in.inc(len(payload))
+        session.messages_in += 1
+        session.bytes_in += len(payload)
+        header = self.relay_header(session)
+        #The one copy the body gets, the receive buffer is reused by the
+        #next read while recipients' queues still hold the frame
+        frame = b"".join((
+            protocol.HEADER.pack(protocol.TEXT, len(header) + len(payload)),
+            header, payload
+        ))
+        self.fanout_data(memoryview(frame)[protocol.HEADER_SIZE:],
+                         exclude=client, room=session.room.name, chat=True,
+                         frame=frame)
+        return True
+
+
+    def relay_header(self, session: sessions.Session) -> bytes:
+        """session's encoded "time username: " header for this second"""
+        now = self.time_now()
+        if session.header_time != now:
+            session.header = now.encode(self.ENCODING) + session.prefix
+            session.header_time = now
+        return session.header
+
+
+    def remember(self, room: str | None, data: bytes,
+                 frame: bytes | None=None) -> bytes:
+        """Frame a chat line once and keep it in room's history"""
+        if frame is None:
+            frame = protocol.encode_frame(data)
+        target = self.rooms.get(room)
+        if target is not None and target.history is not None:
+            target.history.append(frame)
+        return frame
+
+
+    def remote_claim(self, key: str, worker: int) -> None:
+        """Note a name taken on another worker, settling a double claim"""
+        with self.registry_lock:
+            local = self.usernames.get(key)
+            if local is None or worker < self.bus.index:
+                #Both claims can be out at once, the lower worker keeps it
+                held = self.remote_users.get(key)
+                self.remote_users[key] = (
+                    worker if held is None else min(held, worker)
+                )
+        if local is None or worker > self.bus.index:
+            return
+        #Lost the name to a user who picked it on another worker meanwhile
+        self.logger.info("%s Name taken on worker %d: %s", self.time_now(),
+                         worker, local.username)
+        with suppress(OSError):
+            self.send_msg(local.client, f"{self.time_now()} Username "
+                                        f"{local.username} is already taken.")
+        self.disconnect_client(local.client)
+
+
+    def remove_room(self, room: rooms.Room) -> None:
+        """Drop room once its last member leaves, the lobby always stays"""
+        #Otherwise rooms pile up until nobody can create another one
+        with self.registry_lock:
+            if (len(room) or room.name == self.DEFAULT_ROOM
+                    or self.rooms.get(room.name) is not room):
+                return
+            rooms = dict(self.rooms)
+            del rooms[room.name]
+            self.rooms = rooms
+        self.logger.info("%s Removed room: %r", self.time_now(), room)
+        #Workers where it still has members announce it again
+        if self.bus is not None:
+            self.bus.publish(b"", room=room.name,
+                             kind=bus_module.ROOM_REMOVED)
+
+
+    def replay_history(self, client: socket.socket, room: rooms.Room) -> None:
+        """Catch a new member of room up on its history in one write"""
+        if room.history is None:
+            return
+        #History is kept framed for UTF-8 clients, the rest get it redone.
+        #Compressing clients get it as is too, deflating the replay would
+        #be done again for every join.
+        if client.version in protocol.UTF8_VERSIONS:
+            data = room.history.replay()
+        else:
+            data = b"".join(
+                self.wire_bytes(client.version, payload)
+                for payload in room.history.payloads()
+            )
+        if data:
+            client.sendall(data)
+            self.metrics.bytes_out.inc(len(data))
+
+
+    def restore(self, state: dict) -> None:
+        """Recreate the rooms and history the previous process handed over"""
+        for saved in state["rooms"]:
+            name = saved["name"]
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.new_room(name, saved["capacity"])
+                with self.registry_lock:
+                    self.rooms = {**self.rooms, name: room}
+            if room.history is not None:
+                for payload in saved["history"]:
+                    room.history.append(protocol.encode_frame(
+                        handoff.decode_bytes(payload)))
+
+
+    def resume(self, client: socket.socket, state: dict) -> str:
+        """Carry on with a handed over client where its old process left it"""
+        session = self.session(client)
+        decoder = client.decoder
+        decoder.set_version(state["version"])
+        decoder.feed(handoff.decode_bytes(state["input"]))
+        decoder.text.setstate((handoff.decode_bytes(state["text"]), 0))
+        username = state["username"]
+        with self.registry_lock:
+            self.register(session, username)
+            room = self.rooms.get(state["room"])
+            if room is not None and room is not session.room:
+                self.leave_room(session)
+                self.enter_room(session, room)
+        output = handoff.decode_bytes(state["output"])
+        if output:
+            client.sendall(output)
+        self.watch(session, time.monotonic())
+        self.logger.info("%s Resumed: %s %s", self.time_now(), username,
+                         client)
+        return username
+
+
+    def run_command(self, client: socket.socket, msg: str) -> None:
+        """Carry out a /command and reply to the client that sent it"""
+        command, *args = msg.split()
+        try:
+            if command == "/rooms":
+                reply = "Rooms: " + ", ".join(
+                    f"{room.name} ({len(room)}/{room.capacity})"
+                    for room in self.rooms.values()
+                )
+            elif command == "/create" and 1 <= len(args) <= 2:
+                if len(args) == 2 and not args[1].isdigit():
+                    raise ValueError("Room capacity must be a number.")
+                capacity = int(args[1]) if len(args) == 2 else None
+                self.change_room(client, self.create_room(args[0], capacity))
+                return
+            elif command == "/join" and len(args) == 1:
+                if args[0] not in self.rooms:
+                    raise ValueError(f"There is no room named {args[0]}.")
+                self.change_room(client, self.rooms[args[0]])
+                return
+            elif command == "/leave" and not args:
+                self.change_room(client, self.rooms[self.DEFAULT_ROOM])
+                return
+            elif command == "/history" and len(args) <= 1:
+                reply = self.query_history(client, args[0] if args else None)
+            elif command == "/msg" and len(args) >= 2:
+                #The message keeps its own spacing, only the name is split off
+                text = msg.lstrip().split(None, 2)[2]
+                reply = self.direct_msg(client, args[0], text)
+            else:
+                reply = self.HELP_MSG
+        except ValueError as e:
+            reply = str(e)
+        self.send_msg(client, f"{self.time_now()} {reply}")
+
+
     def send_welcome_msg(self, client: socket.socket, username: str) -> None:
         """Welcome the new user to the chatroom"""
         msg = f"{self.time_now()} {self.WELCOME_MSG}\nUsername is {username}"
-        client.sendall(msg.encode(self.ENCODING))
-        log_msg = f"{self.time_now()} Sent {msg} to {client}"
-        self.logger.info(log_msg)
+        msg += f"\nYou are in {self.DEFAULT_ROOM}, type /help for commands."
+        self.send_msg(client, msg)
+        self.replay_history(client, self.rooms[self.DEFAULT_ROOM])
+
+
+    def send_msg(self, client: socket.socket, msg: str) -> None:
+        """Send msg to one client that has finished the handshake"""
+        data = self.wire_bytes(client.version, msg.encode(self.ENCODING))
+        client.sendall(data)
+        self.metrics.messages_out.inc()
+        self.metrics.bytes_out.inc(len(data))
+        self.sent_logger.info("%s Sent %s to %s", self.time_now(), msg, client)
+
+
+    def session(self, client: socket.socket) -> sessions.Session | None:
+        """client's Session, None once it's been disconnected"""
+        session = self.sessions.get(client.fd)
+        #The descriptor may already belong to a newer connection
+        if session is None or session.client is not client:
+            return None
+        return session
+
+
+    def snapshot(self) -> tuple[dict, list[tuple[int, dict]]]:
+        """Rooms and users as a new process needs them to carry on"""
+        state = {"rooms": [
+            {"name": room.name, "capacity": room.capacity,
+             "history": [
+                 handoff.encode_bytes(payload)
+                 for payload in (room.history.payloads()
+                                 if room.history is not None else [])
+             ]}
+            for room in self.rooms.values()
+        ]}
+        #Connections still in the handshake aren't handed over, they're
+        #closed with this process and reconnect
+        clients = []
+        for session in self.client_map.values():
+            client = session.client
+            room = session.room or self.rooms[self.DEFAULT_ROOM]
+            clients.append((session.fd, {
+                "username": session.username,
+                "room": room.name,
+                "version": client.version,
+                "input": handoff.encode_bytes(client.decoder.unread()),
+                "text": handoff.encode_bytes(
+                    client.decoder.text.getstate()[0]),
+                "output": handoff.encode_bytes(client.unsent()),
+            }))
+        return state, clients
+
+
+    def silence_limits(self,
+                       session: sessions.Session) -> tuple[float, float]:
+        """Seconds of silence before it's pinged and before it's dropped"""
+        if self.handshaking(session.client):
+            return 0.0, tls_module.HANDSHAKE_TIMEOUT
+        #Only framed clients understand pings, a handshake gets as long as
+        #a missed heartbeat
+        if session.username is None:
+            return 0.0, self.heartbeat_timeout or self.idle_timeout
+        if session.client.framed:
+            return self.heartbeat_interval, self.heartbeat_timeout
+        return 0.0, self.idle_timeout
 
 
     def setup_socket(self) -> socket.socket:
         """This will setup the socket options and listen for connections"""
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            #Every worker binds the same port, the kernel spreads accepts
+            server_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind(self.addr)
         return server_socket
 
 
+    def start_tls(self, client: socket.socket,
+                  limiter: ratelimit.Limiter) -> ssl.SSLSocket | None:
+        """Blocking TLS handshake with an admitted client, None if it fails"""
+        client.settimeout(tls_module.HANDSHAKE_TIMEOUT)
+        try:
+            tls_client = self.tls.wrap_socket(client, server_side=True)
+        except (OSError, ValueError) as e:
+            #The failed handshake already closed the connection
+            self.tls_failed(e)
+            self.release(limiter)
+            return None
+        #A peer gone before the handshake leaves an unconnected socket
+        if tls_client.version() is None:
+            self.tls_failed(ConnectionError("Peer left before handshaking"))
+            self.release(limiter)
+            tls_client.close()
+            return None
+        tls_client.settimeout(None)
+        self.tls_established(tls_client)
+        return tls_client
+
+
     def time_now(self) -> str:
         """Gets the current time and date in specific format"""
-        return datetime.datetime.now(
-            tz=ZoneInfo(self.TIME_ZONE)).strftime(self.TIME_FORMAT)
+        return self.clock.now()
+
+
+    def tls_established(self, tls: ssl.SSLSocket | ssl.SSLObject) -> None:
+        """Count a finished TLS handshake, full or resumed"""
+        kind = tls_module.handshake_kind(tls)
+        self.metrics.tls_handshakes.inc(value=kind)
+        self.logger.info("%s TLS %s: %s", self.time_now(), kind,
+                         tls.version())
+
+
+    def tls_failed(self, error: Exception) -> None:
+        """Count a connection dropped because its TLS handshake failed"""
+        print(f"{self.time_now()} TLS handshake failed: {error}")
+        self.metrics.disconnects.inc(value=metrics.TLS_ERROR)
+
+
+    @staticmethod
+    def handshaking(client: socket.socket) -> bool:
+        """Whether client is in a TLS handshake an engine drives itself"""
+        #Blocking handshakes time out on their own, and asyncio's transport
+        #times its out
+        return getattr(client, "handshaking", False)
+
+
+    @staticmethod
+    def user_key(username: str) -> str:
+        """Index key of username, Anna and anna are the same user"""
+        return username.casefold()
     
 
     @staticmethod
@@ -211,3 +1353,40 @@ class Server():
         if 1 <= port <= 1023:
             raise ValueError(f"Ports 1–1023 are reserved: {port}")
         return port
+
+
+    def watch(self, session: sessions.Session, now: float) -> None:
+        """Set session's timer for when its silence next needs a look"""
+        interval, timeout = self.silence_limits(session)
+        last_seen = session.last_seen
+        due = []
+        if timeout:
+            due.append(last_seen + timeout)
+        if interval:
+            #Already pinged, the next one goes out an interval after it
+            pinged = now - last_seen >= interval
+            due.append((now if pinged else last_seen) + interval)
+        if due:
+            self.timers.schedule(session.fd, min(due))
+        else:
+            self.timers.cancel(session.fd)
+
+
+    def wire_bytes(self, version: int | None, data: bytes) -> bytes:
+        """Text kept in ENCODING as a client speaking version gets it"""
+        #Relayed lines come as a view into their frame
+        data = bytes(data)
+        #ASCII is the same in every encoding, only the rest is redone
+        if version not in protocol.UTF8_VERSIONS and not data.isascii():
+            #Legacy clients get ? for whatever Latin-1 can't show
+            data = data.decode(self.ENCODING, "replace").encode(
+                protocol.LEGACY_ENCODING, "replace")
+        if version == protocol.FRAMED_ZLIB and self.compression_level:
+            #Each line deflates on its own, so what one member of a room
+            #gets is good for all of them
+            packed = protocol.compress(data, self.compression_level)
+            if len(packed) < len(data):
+                return protocol.encode_frame(packed, protocol.ZTEXT)
+        if version in (protocol.FRAMED, *protocol.UTF8_VERSIONS):
+            return protocol.encode_frame(data)
+        return data
@@ -0,0 +1,43 @@
+import time
+
+import outbound
+import ratelimit
+
+
+class Session():
+    """Everything the server tracks about one admitted connection"""
+
+    #Slots instead of a __dict__, a server holds thousands of these and
+    #every message reads a few of their fields
+    __slots__ = (
+        "client", "fd", "queue", "limiter", "username", "prefix", "room",
+        "header", "header_time", "messages_in", "bytes_in", "connected_at",
+        "last_seen",
+    )
+
+    def __init__(self, client, fd: int,
+                 limiter: ratelimit.Limiter | None=None):
+        #The engine's connection object, and its descriptor, which stays
+        #the session's key after the connection is closed
+        self.client = client
+        self.fd = fd
+        self.queue: outbound.OutboundQueue | None = getattr(client, "queue",
+                                                            None)
+        self.limiter = limiter
+        #Set once the username handshake is done
+        self.username: str | None = None
+        #Encoded " username: " that goes after the time on each chat line
+        self.prefix = b""
+        #rooms imports this module, so the Room type is only named here
+        self.room: "rooms.Room | None" = None
+        #Encoded "time username: " header of relayed lines and its second
+        self.header = b""
+        self.header_time = ""
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.connected_at = time.monotonic()
+        #When the peer last sent anything, its heartbeat goes by this
+        self.last_seen = self.connected_at
+
+    def __repr__(self) -> str:
+        return f"<Session fd={self.fd} {self.username}>"
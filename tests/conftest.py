@@ -0,0 +1,109 @@
+import socket
+import ssl
+import threading
+
+import pytest
+
+import chatroom
+import protocol
+import ratelimit
+import server
+
+
+class Chatter():
+    """Test client on a socketpair served by handle_client, or on sock"""
+
+    def __init__(self, serv: server.Server, username: str,
+                 magic: bytes=protocol.MAGIC_UTF8,
+                 sock: socket.socket | None=None,
+                 tls: ssl.SSLContext | None=None,
+                 session: ssl.SSLSession | None=None):
+        self.thread = None
+        if sock is None:
+            ours, sock = socket.socketpair()
+            self.thread = threading.Thread(
+                target=chatroom.handle_client,
+                args=(ours, serv, serv.admit("127.0.0.1")), daemon=True)
+            self.thread.start()
+        sock.settimeout(5)
+        if tls is not None:
+            sock = tls.wrap_socket(sock, server_hostname="localhost",
+                                   session=session)
+        self.sock = sock
+        #The prompt is the only raw text, everything after it is framed
+        prompt = b""
+        while not prompt.endswith(b"username:"):
+            prompt += self.sock.recv(protocol.INITIAL_BUFFER)
+        self.decoder = protocol.FrameDecoder(
+            version=protocol.VERSIONS[magic])
+        #Received and not expected yet, and the kind of the last expected
+        self.frames: list[tuple[int, str]] = []
+        self.kind: int | None = None
+        self.sock.sendall(magic + protocol.encode_frame(username.encode()))
+
+    def close(self) -> None:
+        self.sock.close()
+        if self.thread is not None:
+            self.thread.join(5)
+
+    def expect(self, text: str) -> str:
+        """First line received holding text, the ones before it are gone"""
+        while True:
+            while self.frames:
+                self.kind, line = self.frames.pop(0)
+                if text in line:
+                    return line
+            if not self.decoder.recv_into(self.sock):
+                raise ConnectionError(f"Closed while waiting for {text!r}")
+            for kind, payload in self.decoder.frames():
+                if kind == protocol.ZTEXT:
+                    payload = protocol.decompress(payload)
+                self.frames.append((kind, self.decoder.decode_text(payload)))
+
+    def say(self, text: str) -> None:
+        self.sock.sendall(protocol.encode_frame(text.encode()))
+
+
+@pytest.fixture
+def connect(make_server):
+    """Log users in, over the threaded engine unless given a socket"""
+    chatters = []
+
+    def connect(serv: server.Server, username: str,
+                magic: bytes=protocol.MAGIC_UTF8,
+                reply: str="Username is", **options) -> Chatter:
+        chatter = Chatter(serv, username, magic, **options)
+        chatters.append(chatter)
+        chatter.expect(reply)
+        return chatter
+
+    yield connect
+    for chatter in chatters:
+        chatter.close()
+
+
+@pytest.fixture
+def make_server(tmp_path):
+    """Build Servers on free ports, each one is shut down after the test"""
+    made = []
+
+    def make(**options) -> server.Server:
+        options.setdefault("log_file",
+                           str(tmp_path / f"server-{len(made)}.log"))
+        serv = server.Server("127.0.0.1", 0, **options)
+        made.append(serv)
+        return serv
+
+    yield make
+    for serv in made:
+        serv.close_store()
+        serv.close_logger()
+        serv.sock.close()
+
+
+@pytest.fixture
+def serv(make_server):
+    return make_server(
+        message_rate=2.0, byte_rate=0, host_message_rate=0, host_byte_rate=0,
+        rate_action=ratelimit.DELAY
+    )
@@ -0,0 +1,69 @@
+import socket
+import struct
+
+import pytest
+
+import chatroom
+import metrics
+import protocol
+import ratelimit
+
+
+def test_slots_run_out_per_server_and_per_address(make_server):
+    serv = make_server(max_clients=3, max_host_clients=2)
+    first = serv.admit("10.0.0.1")
+    serv.admit("10.0.0.1")
+    with pytest.raises(ratelimit.Refused) as refused:
+        serv.admit("10.0.0.1")
+    assert refused.value.reason == metrics.HOST_FULL
+    serv.admit("10.0.0.2")
+    with pytest.raises(ratelimit.Refused) as refused:
+        serv.admit("10.0.0.3")
+    assert refused.value.reason == metrics.SERVER_FULL
+    serv.release(first)
+    serv.admit("10.0.0.1")
+    assert serv.admitted == 3
+
+
+def test_address_is_forgotten_with_its_last_connection(serv):
+    limiter = serv.admit("10.0.0.1")
+    assert "10.0.0.1" in serv.hosts
+    serv.release(limiter)
+    assert serv.hosts == {}
+    assert serv.admitted == 0
+
+
+def test_refused_connection_is_told_why(serv):
+    ours, theirs = socket.socketpair()
+    serv.reject(ours, metrics.HOST_FULL)
+    theirs.settimeout(5)
+    notice = theirs.recv(protocol.INITIAL_BUFFER)
+    assert notice == serv.MAX_HOST_CLIENTS_REACHED_MSG.encode()
+    assert theirs.recv(1) == b""
+    assert serv.metrics.disconnects.values == {metrics.HOST_FULL: 1}
+    theirs.close()
+
+
+def test_one_wakeup_accepts_everything_queued(serv):
+    serv.listen_for_connections()
+    peers = [socket.create_connection(serv.sock.getsockname())
+             for _ in range(3)]
+    accepted = serv.accept_pending()
+    assert [host for _, host in accepted] == ["127.0.0.1"] * 3
+    assert serv.accept_pending() == []
+    for sock, _ in accepted:
+        sock.close()
+    for peer in peers:
+        peer.close()
+
+
+def test_failed_handshake_gives_its_slot_back(serv):
+    ours, theirs = socket.socketpair()
+    limiter = serv.admit("127.0.0.1")
+    assert serv.admitted == 1
+    theirs.sendall(protocol.MAGIC + struct.pack("!BI", protocol.TEXT,
+                                                100_000_000))
+    chatroom.handle_client(ours, serv, limiter)
+    assert serv.admitted == 0
+    assert serv.sessions == {}
+    theirs.close()
@@ -0,0 +1,46 @@
+import threading
+import time
+
+import bus
+
+
+def receive_until(worker: bus.Bus, kind: int, count: int,
+                  timeout: float=5.0) -> list[tuple[int, str, bytes]]:
+    packets = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        packets += [packet for packet in worker.receive()
+                    if packet[0] == kind]
+        if len(packets) >= count:
+            break
+        time.sleep(0.01)
+    return packets
+
+
+def start_hub(workers: int) -> tuple[bus.BusHub, list[bus.Bus]]:
+    hub = bus.BusHub(workers)
+    ends = [bus.Bus(worker_end, index)
+            for index, (_, worker_end) in enumerate(hub.pairs)]
+    threading.Thread(target=hub.run_forever, daemon=True).start()
+    return hub, ends
+
+
+def test_control_packets_survive_a_backed_up_worker():
+    hub, (first, second) = start_hub(2)
+    #second isn't reading, the chat flood backs up the hub or first
+    for _ in range(2000):
+        first.publish(b"x" * 2000, room="lobby", kind=bus.CHAT)
+    for n in range(200):
+        first.publish(b"0", room=f"name{n}", kind=bus.NAME_CLAIMED)
+    claims = receive_until(second, bus.NAME_CLAIMED, 200)
+    assert [room for _, room, _ in claims] == [f"name{n}" for n in range(200)]
+    assert hub.dropped + first.dropped > 0
+
+
+def test_workers_hear_when_one_exits():
+    _, (first, second, third) = start_hub(3)
+    second.close()
+    for worker in (first, third):
+        assert receive_until(worker, bus.WORKER_EXITED, 1) == [
+            (bus.WORKER_EXITED, "", b"1")
+        ]
@@ -0,0 +1,32 @@
+import protocol
+
+LINE = "the quick brown fox jumps over the lazy dog, " * 4
+
+
+def test_chat_is_deflated_for_clients_that_asked(serv, connect):
+    zipped = connect(serv, "zed", magic=protocol.MAGIC_ZLIB)
+    plain = connect(serv, "pat")
+    bob = connect(serv, "bob")
+    bob.say(LINE)
+    assert zipped.expect("bob:").endswith(" bob: " + LINE)
+    assert plain.expect("bob:").endswith(" bob: " + LINE)
+    assert zipped.kind == protocol.ZTEXT
+    assert plain.kind == protocol.TEXT
+
+
+def test_level_zero_sends_plain_frames(make_server, connect):
+    serv = make_server(compression_level=0)
+    zipped = connect(serv, "zed", magic=protocol.MAGIC_ZLIB)
+    bob = connect(serv, "bob")
+    bob.say(LINE)
+    assert zipped.expect("bob:").endswith(" bob: " + LINE)
+    assert zipped.kind == protocol.TEXT
+
+
+def test_lines_that_dont_shrink_go_out_plain(serv):
+    assert serv.wire_bytes(protocol.FRAMED_ZLIB, b"hi") \
+        == protocol.encode_frame(b"hi")
+    packed = serv.wire_bytes(protocol.FRAMED_ZLIB, LINE.encode())
+    assert packed[0] == protocol.ZTEXT
+    assert protocol.decompress(packed[protocol.HEADER_SIZE:]) \
+        == LINE.encode()
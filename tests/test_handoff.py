@@ -0,0 +1,109 @@
+import json
+import os
+import socket
+import threading
+
+import handoff
+import protocol
+import reactor_engine
+
+
+def received_lines(sock: socket.socket) -> list[str]:
+    """Lines sent to sock so far, which must all be whole frames"""
+    decoder = protocol.FrameDecoder(version=protocol.FRAMED_UTF8)
+    sock.settimeout(0.5)
+    try:
+        while decoder.recv_into(sock):
+            pass
+    except TimeoutError:
+        pass
+    return [decoder.decode_text(payload) for _, payload in decoder.frames()]
+
+
+def tcp_pair() -> tuple[socket.socket, socket.socket]:
+    """Connected TCP sockets, resuming needs a peer address to admit"""
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        theirs = socket.create_connection(listener.getsockname())
+        ours, _ = listener.accept()
+    ours.setblocking(False)
+    return ours, theirs
+
+
+def test_state_survives_the_handoff(make_server):
+    old, new = make_server(), make_server()
+    old_reactor = reactor_engine.Reactor(old)
+    ours, theirs = tcp_pair()
+    client = reactor_engine.ReactorClient(
+        ours, old_reactor.selector, old.new_outbound_queue(),
+        old.new_decoder(), old_reactor.dirty)
+    client.session = old.attach(client, old.admit("127.0.0.1"))
+    #The old process stops with a character split across frames, half a
+    #frame unread and the replies to all of it still unsent
+    last = protocol.encode_frame("é".encode()[1:])
+    theirs.sendall(protocol.MAGIC_UTF8 + protocol.encode_frame(b"alice")
+                   + protocol.encode_frame(b"/create dev 5")
+                   + protocol.encode_frame(b"first")
+                   + protocol.encode_frame("caf".encode() + "é".encode()[:1])
+                   + last[:3])
+    old_reactor.on_readable(client)
+
+    state, clients = old.snapshot()
+    #It travels as JSON, nothing in it may need more than that
+    state, clients = json.loads(json.dumps([state, clients]))
+    new_reactor = reactor_engine.Reactor(new)
+    new.restore(state)
+    for fd, info in clients:
+        new_reactor.resume(socket.socket(fileno=os.dup(fd)), info)
+    old_reactor.selector.close()
+    ours.close()
+
+    room = new.rooms["dev"]
+    assert room.capacity == 5
+    assert room.history.payloads() == old.rooms["dev"].history.payloads()
+    session = new.find_user("alice")
+    assert session.room is room
+    new_reactor.flush_dirty()
+    lines = received_lines(theirs)
+    assert any(line.endswith(" You are now in dev.") for line in lines)
+
+    theirs.sendall(last[3:])
+    new_reactor.on_readable(session.client)
+    said = [payload.decode().split(" ", 5)[-1]
+            for payload in room.history.payloads()]
+    assert said == ["alice: first", "alice: caf", "alice: é"]
+    new_reactor.selector.close()
+    theirs.close()
+
+
+def test_sockets_pass_to_the_successor(tmp_path):
+    path = str(tmp_path / "handoff.sock")
+    assert handoff.take_over(path) is None
+    waiting = handoff.listen(path)
+    waiting.setblocking(True)
+    port = socket.create_server(("127.0.0.1", 0))
+    pairs = [tcp_pair() for _ in range(3)]
+    clients = [(ours.fileno(), {"username": f"user{n}"})
+               for n, (ours, _) in enumerate(pairs)]
+    taken = []
+    successor = threading.Thread(
+        target=lambda: taken.append(handoff.take_over(path)))
+    successor.start()
+    conn, _ = waiting.accept()
+    with conn:
+        handoff.hand_off(conn, port, {"rooms": []}, clients)
+    successor.join(5)
+    listener, state, inherited = taken[0]
+    assert state == {"rooms": []}
+    assert listener.getsockname() == port.getsockname()
+    assert [info for _, info in inherited] == [info for _, info in clients]
+    for (sock, _), (_, theirs) in zip(inherited, pairs):
+        theirs.sendall(b"still here")
+        sock.settimeout(5)
+        assert sock.recv(64) == b"still here"
+        sock.close()
+        theirs.close()
+    for ours, _ in pairs:
+        ours.close()
+    listener.close()
+    port.close()
+    waiting.close()
@@ -0,0 +1,50 @@
+import heartbeat
+
+
+def test_timer_fires_on_its_tick_and_only_once():
+    wheel = heartbeat.TimerWheel(100.0, tick=1.0, slots=8)
+    wheel.schedule("a", 102.5)
+    assert wheel.advance(102.0) == []
+    assert wheel.advance(103.0) == ["a"]
+    assert wheel.advance(104.0) == []
+    assert len(wheel) == 0
+
+
+def test_reschedule_replaces_the_old_timer():
+    wheel = heartbeat.TimerWheel(0.0, tick=1.0, slots=8)
+    wheel.schedule("a", 2.0)
+    wheel.schedule("a", 5.0)
+    assert len(wheel) == 1
+    assert wheel.advance(3.0) == []
+    assert wheel.advance(5.0) == ["a"]
+
+
+def test_cancel():
+    wheel = heartbeat.TimerWheel(0.0, tick=1.0, slots=8)
+    wheel.schedule("a", 2.0)
+    wheel.cancel("a")
+    wheel.cancel("never scheduled")
+    assert wheel.advance(10.0) == []
+
+
+def test_deadline_past_the_wheel_waits_for_later_turns():
+    wheel = heartbeat.TimerWheel(0.0, tick=1.0, slots=4)
+    wheel.schedule("far", 10.0)
+    for now in range(1, 10):
+        assert wheel.advance(float(now)) == []
+    assert wheel.advance(10.0) == ["far"]
+
+
+def test_past_deadline_fires_on_the_next_tick():
+    wheel = heartbeat.TimerWheel(50.0, tick=1.0, slots=8)
+    wheel.schedule("late", 10.0)
+    assert wheel.advance(51.0) == ["late"]
+
+
+def test_long_stall_expires_everything_due():
+    wheel = heartbeat.TimerWheel(0.0, tick=1.0, slots=4)
+    for key in range(3):
+        wheel.schedule(key, 1.0 + key)
+    wheel.schedule("later", 500.0)
+    assert sorted(wheel.advance(100.0)) == [0, 1, 2]
+    assert len(wheel) == 1
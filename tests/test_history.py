@@ -0,0 +1,67 @@
+import random
+
+from collections import deque
+
+import protocol
+
+from history import HistoryRing
+
+
+def frame(text: str) -> bytes:
+    return protocol.encode_frame(text.encode())
+
+
+def test_replay_is_the_frames_oldest_first():
+    ring = HistoryRing(10, 1024)
+    for text in ("one", "two", "three"):
+        ring.append(frame(text))
+    assert ring.replay() == frame("one") + frame("two") + frame("three")
+    assert ring.payloads() == [b"one", b"two", b"three"]
+
+
+def test_message_limit_evicts_the_oldest():
+    ring = HistoryRing(2, 1024)
+    for text in ("one", "two", "three"):
+        ring.append(frame(text))
+    assert len(ring) == 2
+    assert ring.payloads() == [b"two", b"three"]
+
+
+def test_wrapping_evicts_what_it_overwrites():
+    #Room for two of these frames, the third starts over at the front
+    size = len(frame("aaaa"))
+    ring = HistoryRing(10, size * 2 + 1)
+    for text in ("aaaa", "bbbb", "cccc"):
+        ring.append(frame(text))
+    assert ring.payloads() == [b"bbbb", b"cccc"]
+    ring.append(frame("dddd"))
+    assert ring.payloads() == [b"cccc", b"dddd"]
+
+
+def test_frame_bigger_than_the_buffer_is_skipped():
+    ring = HistoryRing(10, 8)
+    ring.append(frame("far too long for it"))
+    assert len(ring) == 0
+    assert ring.replay() == b""
+
+
+def test_wrapping_with_mixed_sizes_keeps_replay_decodable():
+    #The 20 byte frame wraps past an 8 byte tail from the round before,
+    #both that tail and the 85 byte frame under it have to go
+    ring = HistoryRing(10, 100)
+    for size in (90, 8, 85, 20):
+        ring.append(frame("x" * (size - protocol.HEADER_SIZE)))
+    assert ring.entries == deque([(0, 20)])
+    assert ring.payloads() == [b"x" * 15]
+
+
+def test_replay_always_decodes_to_the_payloads():
+    rng = random.Random(13)
+    ring = HistoryRing(50, 64 * 1024)
+    for _ in range(2000):
+        ring.append(frame("y" * rng.randrange(80, 16 * 1024)))
+        decoder = protocol.FrameDecoder(version=protocol.FRAMED_UTF8)
+        decoder.feed(ring.replay())
+        replayed = [bytes(payload) for _, payload in decoder.frames()]
+        assert replayed == ring.payloads()
+        assert len(decoder) == 0
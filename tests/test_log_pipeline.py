@@ -0,0 +1,45 @@
+import logging
+import socket
+
+import pytest
+
+import log_pipeline
+
+
+def test_sample_rate_must_be_a_fraction():
+    for rate in (-0.1, 1.5):
+        with pytest.raises(ValueError):
+            log_pipeline.SampleFilter(rate)
+    record = logging.makeLogRecord({"msg": "Sent"})
+    assert log_pipeline.SampleFilter(1.0).filter(record)
+    assert not log_pipeline.SampleFilter(0.0).filter(record)
+
+
+def test_lines_are_written_with_their_arguments_resolved(tmp_path):
+    logger = logging.getLogger("test_log_pipeline")
+    logger.setLevel(logging.INFO)
+    filename = str(tmp_path / "pipeline.log")
+    listener = log_pipeline.create_pipeline(logger, filename, "%(message)s",
+                                            1024 * 1024, 1, 4)
+    ours, theirs = socket.socketpair()
+    shown = repr(ours)
+    for n in range(10):
+        logger.info("line %d from %s", n, ours)
+    #Closed before the listener may have written it, the line still shows
+    #the socket as it was
+    ours.close()
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    theirs.close()
+    with open(filename) as log:
+        assert log.read().splitlines() == [
+            f"line {n} from {shown}" for n in range(10)]
+
+
+def test_sampling_is_reset_by_each_server(serv, make_server):
+    make_server(log_sample_rate=0)
+    filters = [f for f in serv.sent_logger.filters
+               if isinstance(f, log_pipeline.SampleFilter)]
+    assert [f.rate for f in filters] == [0]
+    assert serv.sent_logger.disabled
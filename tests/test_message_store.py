@@ -0,0 +1,73 @@
+import os
+
+import message_store
+
+from message_store import INDEX_ENTRY, Segment
+
+
+def write(directory: str, count: int) -> Segment:
+    segment = Segment(directory, 0)
+    segment.append([(1.0 + n, "lobby", f"line {n}".encode())
+                    for n in range(count)])
+    return segment
+
+
+def read_all(segment: Segment) -> list[bytes]:
+    with segment.mapped() as (log_map, index_map, count):
+        return [
+            Segment.read_record(log_map, INDEX_ENTRY.unpack_from(
+                index_map, n * INDEX_ENTRY.size)[0])[2]
+            for n in range(count)
+        ]
+
+
+def test_clean_segment_reopens_as_it_was(tmp_path):
+    segment = write(str(tmp_path), 3)
+    size = segment.size
+    segment.close()
+    reopened = Segment(str(tmp_path), 0)
+    assert (reopened.size, reopened.count) == (size, 3)
+    assert read_all(reopened) == [b"line 0", b"line 1", b"line 2"]
+    reopened.close()
+
+
+def test_records_the_index_never_got_are_dropped(tmp_path):
+    #A crash between the log and the index write
+    segment = write(str(tmp_path), 2)
+    size = segment.size
+    segment.log.write(b"\x00" * 40)
+    segment.close()
+    reopened = Segment(str(tmp_path), 0)
+    assert (reopened.size, reopened.count) == (size, 2)
+    assert os.path.getsize(reopened.log_path) == size
+    reopened.close()
+
+
+def test_index_entry_past_a_torn_record_is_dropped(tmp_path):
+    segment = write(str(tmp_path), 3)
+    with segment.mapped() as (_, index_map, _):
+        (last,) = INDEX_ENTRY.unpack_from(index_map, 2 * INDEX_ENTRY.size)
+    segment.close()
+    #The last record only got half written
+    with open(segment.log_path, "r+b") as log:
+        log.truncate(last + 5)
+    reopened = Segment(str(tmp_path), 0)
+    assert (reopened.size, reopened.count) == (last, 2)
+    assert os.path.getsize(reopened.index_path) == 2 * INDEX_ENTRY.size
+    assert read_all(reopened) == [b"line 0", b"line 1"]
+    reopened.close()
+
+
+def test_store_tail_finds_a_rooms_last_lines(tmp_path):
+    store = message_store.MessageStore(str(tmp_path))
+    for n in range(5):
+        store.append("lobby" if n % 2 else "games", f"line {n}".encode())
+    store.close()
+    reopened = message_store.MessageStore(str(tmp_path))
+    assert [data for _, data in reopened.tail("lobby", 10)] == [
+        b"line 1", b"line 3"
+    ]
+    assert [data for _, data in reopened.tail("games", 2)] == [
+        b"line 2", b"line 4"
+    ]
+    reopened.close()
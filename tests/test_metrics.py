@@ -0,0 +1,68 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+def test_counter_renders_each_label_value_in_order():
+    counter = metrics.Counter("drops_total", "Drops", label="reason")
+    counter.inc(2, "timed_out")
+    counter.inc(value="closed")
+    assert counter.render() == [
+        "# HELP drops_total Drops",
+        "# TYPE drops_total counter",
+        'drops_total{reason="closed"} 1',
+        'drops_total{reason="timed_out"} 2',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("wait_seconds", "Waits",
+                                  buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.render()[2:] == [
+        'wait_seconds_bucket{le="0.1"} 2',
+        'wait_seconds_bucket{le="1.0"} 3',
+        'wait_seconds_bucket{le="+Inf"} 4',
+        "wait_seconds_sum 2.65",
+        "wait_seconds_count 4",
+    ]
+
+
+def test_depth_snapshot_reads_the_queues_when_scraped():
+    depths = [0, 3, 3, 40]
+    snapshot = metrics.DepthSnapshot("depth", "Depths", lambda: depths,
+                                     buckets=(0, 4))
+    assert snapshot.render()[2:5] == [
+        'depth{le="0"} 1', 'depth{le="4"} 3', 'depth{le="+Inf"} 4']
+    assert snapshot.render()[-1] == "depth_max 40"
+    depths.clear()
+    assert snapshot.render()[-1] == "depth_max 0"
+
+
+def test_endpoint_serves_the_servers_metrics(serv, connect):
+    connect(serv, "alice")
+    bob = connect(serv, "bob")
+    bob.say("hello")
+    bob.say("/msg alice hi")
+    bob.expect("To alice (private): hi")
+    http_server = metrics.serve(serv.metrics, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{http_server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(url + "/metrics", timeout=5) as reply:
+            assert reply.headers["Content-Type"] == metrics.CONTENT_TYPE
+            lines = reply.read().decode().splitlines()
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + "/", timeout=5)
+        assert error.value.code == 404
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+    assert "chatroom_connected_clients 2" in lines
+    assert "chatroom_rooms 1" in lines
+    assert "chatroom_messages_in_total 2" in lines
+    assert "# TYPE chatroom_fanout_seconds histogram" in lines
+    assert 'chatroom_dropped_messages_total{queue="outbound"} 0' in lines
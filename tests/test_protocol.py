@@ -0,0 +1,83 @@
+import pytest
+
+import protocol
+
+
+def frames(decoder: protocol.FrameDecoder) -> list[tuple[int, bytes]]:
+    return [(kind, bytes(payload)) for kind, payload in decoder.frames()]
+
+
+def test_whole_frames_in_one_feed():
+    decoder = protocol.FrameDecoder()
+    decoder.feed(protocol.MAGIC_UTF8 + protocol.encode_frame(b"one")
+                 + protocol.encode_frame(b"", protocol.PING)
+                 + protocol.encode_frame(b"two"))
+    assert frames(decoder) == [
+        (protocol.TEXT, b"one"), (protocol.PING, b""), (protocol.TEXT, b"two")
+    ]
+    assert decoder.version == protocol.FRAMED_UTF8
+    assert len(decoder) == 0
+
+
+def test_frame_split_byte_by_byte():
+    decoder = protocol.FrameDecoder()
+    data = protocol.MAGIC + protocol.encode_frame(b"hello there")
+    received = []
+    for i in range(len(data)):
+        decoder.feed(data[i:i + 1])
+        received += frames(decoder)
+    assert received == [(protocol.TEXT, b"hello there")]
+    assert decoder.version == protocol.FRAMED
+
+
+def test_partial_magic_waits_for_more():
+    decoder = protocol.FrameDecoder()
+    decoder.feed(protocol.MAGIC_UTF8[:3])
+    assert frames(decoder) == []
+    assert decoder.version is None
+    decoder.feed(protocol.MAGIC_UTF8[3:] + protocol.encode_frame(b"x"))
+    assert frames(decoder) == [(protocol.TEXT, b"x")]
+    assert decoder.version == protocol.FRAMED_UTF8
+
+
+def test_raw_client_gets_each_read_as_one_message():
+    decoder = protocol.FrameDecoder()
+    decoder.feed(b"alice")
+    assert frames(decoder) == [(protocol.TEXT, b"alice")]
+    assert decoder.framed is False
+
+
+def test_oversized_frame_is_refused_from_its_header():
+    decoder = protocol.FrameDecoder(max_payload=16)
+    decoder.feed(protocol.MAGIC + protocol.HEADER.pack(protocol.TEXT, 17))
+    with pytest.raises(protocol.FrameError):
+        frames(decoder)
+
+
+def test_frame_larger_than_the_buffer_grows_it():
+    decoder = protocol.FrameDecoder(size=8)
+    payload = bytes(range(256)) * 40
+    data = protocol.MAGIC + protocol.encode_frame(payload)
+    for start in range(0, len(data), 1000):
+        decoder.feed(data[start:start + 1000])
+        received = frames(decoder)
+    assert received == [(protocol.TEXT, payload)]
+
+
+def test_character_split_across_frames():
+    decoder = protocol.FrameDecoder(version=protocol.FRAMED_UTF8)
+    encoded = "ü".encode()
+    decoder.feed(protocol.encode_frame(b"a" + encoded[:1])
+                 + protocol.encode_frame(encoded[1:]))
+    first, second = [payload for _, payload in frames(decoder)]
+    assert not decoder.ends_whole(first)
+    assert decoder.decode_text(first) + decoder.decode_text(second) == "aü"
+
+
+def test_compressed_round_trip():
+    data = "hello hello hello".encode() * 10
+    packed = protocol.compress(data, 6)
+    assert len(packed) < len(data)
+    assert protocol.decompress(packed) == data
+    with pytest.raises(protocol.FrameError):
+        protocol.decompress(packed, max_size=len(data) - 1)
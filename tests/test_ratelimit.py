@@ -0,0 +1,82 @@
+import socket
+
+import pytest
+
+import protocol
+import ratelimit
+import reactor_engine
+
+
+def test_bucket_starts_full_and_refills_at_rate():
+    bucket = ratelimit.TokenBucket(2.0, 4.0)
+    now = bucket.stamp
+    assert bucket.shortfall(4.0, now) == 0.0
+    bucket.take(4.0)
+    assert bucket.shortfall(1.0, now) == pytest.approx(0.5)
+    assert bucket.shortfall(1.0, now + 0.5) == 0.0
+
+
+def test_bucket_never_holds_more_than_burst():
+    bucket = ratelimit.TokenBucket(2.0, 4.0)
+    bucket.refill(bucket.stamp + 100.0)
+    assert bucket.tokens == 4.0
+
+
+def test_overdrawn_bucket_pays_back_first():
+    bucket = ratelimit.TokenBucket(2.0, 1.0)
+    now = bucket.stamp
+    bucket.take(3.0)
+    assert bucket.tokens == -2.0
+    assert bucket.shortfall(1.0, now) == pytest.approx(1.5)
+
+
+def test_bad_rates_are_refused():
+    with pytest.raises(ValueError):
+        ratelimit.TokenBucket(0, 1.0)
+    with pytest.raises(ValueError):
+        ratelimit.TokenBucket(1.0, -1.0)
+
+
+def test_burst_under_delay_is_paced_at_the_rate():
+    host = ratelimit.HostLimits("127.0.0.1", None, None)
+    limiter = ratelimit.Limiter(ratelimit.TokenBucket(2.0, 4.0), None, host)
+    waits = [limiter.check(10, delay=True) for _ in range(8)]
+    #The burst goes through, then every message waits half a second more
+    assert waits[:4] == [0.0] * 4
+    for extra, wait in enumerate(waits[4:], 1):
+        assert wait == pytest.approx(0.5 * extra, abs=0.01)
+
+
+def test_drop_only_charges_what_it_lets_through():
+    host = ratelimit.HostLimits("127.0.0.1", None, None)
+    limiter = ratelimit.Limiter(ratelimit.TokenBucket(2.0, 1.0), None, host)
+    assert limiter.check(10) == 0.0
+    assert limiter.check(10) > 0.0
+    assert limiter.check(10) == pytest.approx(0.5, abs=0.01)
+
+
+def test_reactor_holds_back_a_burst_under_delay(serv):
+    reactor = reactor_engine.Reactor(serv)
+    ours, theirs = socket.socketpair()
+    client = reactor_engine.ReactorClient(
+        ours, reactor.selector, serv.new_outbound_queue(),
+        serv.new_decoder(), reactor.dirty)
+    client.session = serv.attach(client, serv.admit("127.0.0.1"))
+    #The username and a burst arrive in one read
+    theirs.sendall(protocol.MAGIC_UTF8 + protocol.encode_frame(b"alice")
+                   + b"".join(protocol.encode_frame(f"line {n}".encode())
+                              for n in range(10)))
+    reactor.on_readable(client)
+    #Four tokens of burst, then the fifth line overdraws and pauses it
+    assert client.session.messages_in == 5
+    assert not client.reading
+    assert client in reactor.paused
+    assert len(client.decoder) > 0
+    #Once the pause is over one more line goes before the next pause
+    reactor.paused[client] = 0.0
+    reactor.resume_due()
+    assert client.session.messages_in == 6
+    assert not client.reading
+    serv.disconnect_client(client)
+    reactor.selector.close()
+    theirs.close()
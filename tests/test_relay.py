@@ -0,0 +1,63 @@
+import pytest
+
+import protocol
+
+
+@pytest.fixture
+def relaying(make_server):
+    serv = make_server(relay=True)
+    #Lines that take the decode path, relayed ones never get here
+    serv.decoded = []
+    handle_msg = serv.handle_msg
+
+    def recording(client, username, msg, size):
+        serv.decoded.append(msg)
+        handle_msg(client, username, msg, size)
+
+    serv.handle_msg = recording
+    return serv
+
+
+def test_utf8_chat_is_forwarded_without_decoding(relaying, connect):
+    alice = connect(relaying, "alice")
+    legacy = connect(relaying, "lee", magic=protocol.MAGIC)
+    bob = connect(relaying, "bob")
+    bob.say("  grüße")
+    assert alice.expect("bob:").endswith(" bob:   grüße")
+    #Latin-1 still has ü and ß, a legacy client gets them transcoded
+    assert legacy.expect("bob:").endswith(" bob:   grüße")
+    bob.say("日本")
+    assert legacy.expect("bob:").endswith(" bob: ??")
+    assert relaying.decoded == []
+    assert relaying.metrics.messages_in.values[""] == 2
+    assert relaying.find_user("bob").messages_in == 2
+
+
+def test_relayed_lines_are_kept_in_history(relaying, connect):
+    bob = connect(relaying, "bob")
+    bob.say("before you came")
+    bob.say("/rooms")
+    bob.expect("Rooms:")
+    alice = connect(relaying, "alice")
+    assert alice.expect("bob:").endswith(" bob: before you came")
+
+
+def test_commands_and_split_characters_are_decoded(relaying, connect):
+    alice = connect(relaying, "alice")
+    bob = connect(relaying, "bob")
+    bob.say("  /rooms")
+    bob.expect("Rooms:")
+    encoded = "é".encode()
+    bob.sock.sendall(protocol.encode_frame(b"caf" + encoded[:1])
+                     + protocol.encode_frame(encoded[1:]))
+    assert alice.expect("bob:").endswith(" bob: caf")
+    assert alice.expect("bob:").endswith(" bob: é")
+    assert relaying.decoded == ["  /rooms", "caf", "é"]
+
+
+def test_legacy_senders_are_decoded(relaying, connect):
+    alice = connect(relaying, "alice")
+    legacy = connect(relaying, "lee", magic=protocol.MAGIC)
+    legacy.sock.sendall(protocol.encode_frame("grüß".encode("latin-1")))
+    assert alice.expect("lee:").endswith(" lee: grüß")
+    assert relaying.decoded == ["grüß"]
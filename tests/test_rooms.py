@@ -0,0 +1,49 @@
+def test_chat_only_reaches_the_senders_room(serv, connect):
+    alice, bob, carol, dave = (connect(serv, name)
+                               for name in ("alice", "bob", "carol", "dave"))
+    alice.say("/create dev")
+    alice.expect("You are now in dev.")
+    bob.say("/join dev")
+    bob.expect("You are now in dev.")
+    alice.expect("bob has joined dev.")
+    assert {session.username for session in serv.rooms["dev"].members} \
+        == {"alice", "bob"}
+    carol.say("lobby line")
+    dave.expect("carol: lobby line")
+    bob.say("dev line")
+    assert alice.expect(": ").endswith("bob: dev line")
+
+
+def test_rooms_are_listed_with_their_occupancy(serv, connect):
+    alice = connect(serv, "alice")
+    connect(serv, "bob")
+    alice.say("/create dev 5")
+    alice.expect("You are now in dev.")
+    alice.say("/rooms")
+    assert alice.expect("Rooms:").endswith("Rooms: lobby (1/100), dev (1/5)")
+
+
+def test_full_and_missing_rooms_are_refused(serv, connect):
+    alice, bob = connect(serv, "alice"), connect(serv, "bob")
+    alice.say("/create tiny 1")
+    alice.expect("You are now in tiny.")
+    bob.say("/join tiny")
+    bob.expect("Room tiny is full.")
+    bob.say("/join nowhere")
+    bob.expect("There is no room named nowhere.")
+    bob.say("/create lobby")
+    bob.expect("Room lobby already exists.")
+    assert serv.rooms["tiny"].members == {serv.find_user("alice")}
+
+
+def test_room_is_dropped_with_its_last_member(serv, connect):
+    alice, bob = connect(serv, "alice"), connect(serv, "bob")
+    alice.say("/create dev")
+    alice.expect("You are now in dev.")
+    bob.say("/join dev")
+    bob.expect("You are now in dev.")
+    alice.say("/leave")
+    alice.expect("You are now in lobby.")
+    assert "dev" in serv.rooms
+    bob.close()
+    assert "dev" not in serv.rooms
@@ -0,0 +1,45 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import outbound
+import protocol
+import server
+
+
+def queued(serv: server.Server,
+           sock: socket.socket) -> outbound.QueuedConnection:
+    return outbound.QueuedConnection(sock, serv.new_outbound_queue(),
+                                     serv.new_decoder())
+
+
+def test_username_split_across_reads(serv):
+    ours, theirs = socket.socketpair()
+    client = queued(serv, ours)
+    data = protocol.MAGIC_UTF8 + protocol.encode_frame("zoë".encode())
+    usernames = []
+    reader = threading.Thread(
+        target=lambda: usernames.append(serv.process_username(client)))
+    reader.start()
+    #Split inside the magic, the header and the character
+    for piece in (data[:2], data[2:7], data[7:11], data[11:]):
+        theirs.sendall(piece)
+        time.sleep(0.05)
+    reader.join(timeout=5)
+    assert usernames == ["zoë"]
+    client.close()
+    theirs.close()
+
+
+def test_oversized_username_frame_is_a_frame_error(serv):
+    ours, theirs = socket.socketpair()
+    client = queued(serv, ours)
+    theirs.sendall(protocol.MAGIC + struct.pack("!BI", protocol.TEXT,
+                                                100_000_000))
+    with pytest.raises(protocol.FrameError):
+        serv.process_username(client)
+    client.close()
+    theirs.close()
@@ -0,0 +1,55 @@
+import socket
+
+import pytest
+
+import outbound
+import server
+import sessions
+
+
+def queued(serv: server.Server,
+           sock: socket.socket) -> outbound.QueuedConnection:
+    return outbound.QueuedConnection(sock, serv.new_outbound_queue(),
+                                     serv.new_decoder())
+
+
+def test_sessions_are_slotted():
+    session = sessions.Session(None, 3)
+    with pytest.raises(AttributeError):
+        session.nickname = "alice"
+
+
+def test_reused_descriptor_belongs_to_the_new_connection(serv):
+    ours, theirs = socket.socketpair()
+    old = queued(serv, ours)
+    serv.attach(old, serv.admit("127.0.0.1"))
+    assert serv.add_client(old, "alice")
+    serv.disconnect_client(old)
+    #The kernel hands out the lowest free descriptor, the one just closed
+    ours, theirs_again = socket.socketpair()
+    new = queued(serv, ours)
+    session = serv.attach(new, serv.admit("127.0.0.1"))
+    assert new.fd == old.fd
+    assert serv.session(old) is None
+    assert serv.session(new) is session
+    #A late disconnect of the old connection leaves the new one alone
+    serv.disconnect_client(old)
+    assert serv.sessions == {new.fd: session}
+    assert serv.add_client(new, "alice")
+    assert serv.client_map == {new.fd: session}
+    serv.disconnect_client(new)
+    theirs.close()
+    theirs_again.close()
+
+
+def test_messages_after_a_disconnect_from_another_thread(serv):
+    ours, theirs = socket.socketpair()
+    client = queued(serv, ours)
+    serv.attach(client, serv.admit("127.0.0.1"))
+    assert serv.add_client(client, "alice")
+    #The heartbeat or the bus dropped it, its reader still has frames
+    serv.disconnect_client(client)
+    for msg in ("hello", "/msg bob hi", "/join lobby", "/history"):
+        serv.handle_msg(client, "alice", msg, len(msg))
+    assert serv.broadcast_chat(client, "alice", "hello") == b""
+    theirs.close()
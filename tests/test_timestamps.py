@@ -0,0 +1,19 @@
+import timestamps
+
+
+def test_now_is_formatted_once_per_second(monkeypatch):
+    clock = timestamps.Clock("UTC", "%H:%M:%S")
+    monkeypatch.setattr(clock, "epoch", lambda: 3600)
+    assert clock.now() == "01:00:00"
+    #A stale cache entry for the same second is served as is
+    clock.cache = (3600, "cached")
+    assert clock.now() == "cached"
+    monkeypatch.setattr(clock, "epoch", lambda: 3601)
+    assert clock.now() == "01:00:01"
+
+
+def test_internal_forms_are_integers():
+    first = timestamps.Clock.monotonic_ns()
+    assert isinstance(timestamps.Clock.epoch(), int)
+    assert isinstance(first, int)
+    assert timestamps.Clock.monotonic_ns() >= first
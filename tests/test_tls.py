@@ -0,0 +1,117 @@
+import selectors
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+import pytest
+
+import metrics
+import reactor_engine
+import tls
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    """Self-signed certificate and key for localhost, made with openssl"""
+    if shutil.which("openssl") is None:
+        pytest.skip("needs the openssl command to make a certificate")
+    directory = tmp_path_factory.mktemp("tls")
+    cert, key = str(directory / "cert.pem"), str(directory / "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-days", "1", "-keyout", key, "-out", cert, "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=IP:127.0.0.1,DNS:localhost"],
+        check=True, capture_output=True)
+    return cert, key
+
+
+@pytest.fixture
+def secure(make_server, certificate):
+    return make_server(tls=tls.server_context(*certificate))
+
+
+@pytest.fixture
+def trusting(certificate):
+    return tls.client_context(certificate[0])
+
+
+def run_reactor(reactor: reactor_engine.Reactor,
+                stop: threading.Event) -> None:
+    """run_forever's dispatch, until stop is set"""
+    while not stop.is_set():
+        for key, events in reactor.selector.select(0.05):
+            client = key.data
+            if client is None:
+                reactor.accept()
+            elif client.handshaking:
+                reactor.on_handshake(client)
+            else:
+                if events & selectors.EVENT_WRITE and not client.closed:
+                    reactor.on_writable(client)
+                if events & selectors.EVENT_READ and not client.closed:
+                    reactor.on_readable(client)
+        reactor.flush_dirty()
+        reactor.serv.check_liveness()
+
+
+def test_threaded_chat_over_tls(secure, trusting, connect):
+    alice = connect(secure, "alice", tls=trusting)
+    bob = connect(secure, "bob", tls=trusting)
+    bob.say("over tls")
+    assert alice.expect("bob:").endswith(" bob: over tls")
+    assert alice.sock.version() is not None
+    assert secure.metrics.tls_handshakes.values == {tls.FULL: 2}
+
+
+def test_sessions_are_resumed(secure, trusting, connect):
+    first = connect(secure, "alice", tls=trusting)
+    #TLS 1.3 sends the ticket after the handshake, the welcome brought it
+    second = connect(secure, "bob", tls=trusting,
+                     session=first.sock.session)
+    assert second.sock.session_reused
+    assert secure.metrics.tls_handshakes.values == {
+        tls.FULL: 1, tls.RESUMED: 1}
+
+
+def test_failed_handshake_gives_its_slot_back(secure):
+    ours, theirs = socket.socketpair()
+    limiter = secure.admit("127.0.0.1")
+    theirs.sendall(b"plain text, not a ClientHello\r\n\r\n")
+    assert secure.start_tls(ours, limiter) is None
+    assert secure.admitted == 0
+    assert secure.metrics.disconnects.values == {metrics.TLS_ERROR: 1}
+    theirs.close()
+
+
+def test_reactor_handshakes_without_blocking(secure, trusting, connect):
+    secure.listen_for_connections()
+    reactor = reactor_engine.Reactor(secure)
+    stop = threading.Event()
+    loop = threading.Thread(target=run_reactor, args=(reactor, stop))
+    loop.start()
+    try:
+        #Never says a word, it mustn't hold up the others' handshakes
+        stalled = socket.create_connection(secure.sock.getsockname())
+        alice = connect(secure, "alice", tls=trusting,
+                        sock=socket.create_connection(
+                            secure.sock.getsockname()))
+        bob = connect(secure, "bob", tls=trusting,
+                      sock=socket.create_connection(
+                          secure.sock.getsockname()))
+        bob.say("from the reactor")
+        assert alice.expect("bob:").endswith(" bob: from the reactor")
+        #Out of time, the stalled handshake is dropped
+        session = next(session for session in secure.sessions.values()
+                       if session.username is None)
+        session.last_seen -= tls.HANDSHAKE_TIMEOUT
+        secure.watch(session, time.monotonic())
+        stalled.settimeout(5)
+        assert stalled.recv(1) == b""
+        assert secure.metrics.disconnects.values == {metrics.TLS_ERROR: 1}
+        stalled.close()
+    finally:
+        stop.set()
+        loop.join(5)
+        reactor.selector.close()
@@ -0,0 +1,51 @@
+import pytest
+
+import bus
+
+
+def test_names_are_unique_regardless_of_case(serv, connect):
+    alice = connect(serv, "Alice")
+    taken = connect(serv, "aLICE", reply="Username aLICE is already taken.")
+    with pytest.raises(ConnectionError):
+        taken.expect("Welcome")
+    assert serv.find_user("ALICE").username == "Alice"
+    alice.close()
+    connect(serv, "alice")
+
+
+def test_names_held_on_another_worker_are_taken(serv, connect):
+    serv.remote_users = {"bob": 1}
+    connect(serv, "Bob", reply="Username Bob is already taken.")
+    alice = connect(serv, "alice")
+    alice.say("/msg bob hi")
+    alice.expect("bob is on another worker")
+
+
+def test_private_message_reaches_only_its_recipient(serv, connect):
+    alice, bob, carol = (connect(serv, name)
+                         for name in ("alice", "Bob", "carol"))
+    alice.say("/msg BOB two  spaces")
+    assert alice.expect("(private)").endswith(
+        " To Bob (private): two  spaces")
+    assert bob.expect("(private)").endswith(
+        " alice (private): two  spaces")
+    alice.say("public")
+    assert carol.expect("alice:").endswith(" alice: public")
+
+
+def test_private_message_mistakes_are_answered(serv, connect):
+    alice = connect(serv, "alice")
+    alice.say("/msg nobody hi")
+    alice.expect("There is no user named nobody.")
+    alice.say("/msg Alice hi")
+    alice.expect("You can't message yourself.")
+    alice.say("/msg alice")
+    alice.expect("Commands:")
+
+
+def test_names_held_on_an_exited_worker_are_freed(serv):
+    serv.remote_users = {"bob": 1, "ann": 2}
+    assert serv.name_taken("Bob")
+    serv.deliver_remote((bus.WORKER_EXITED, "", b"1"))
+    assert not serv.name_taken("Bob")
+    assert serv.name_taken("ann")
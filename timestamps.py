@@ -0,0 +1,36 @@
+import datetime
+import time
+
+from zoneinfo import ZoneInfo
+
+
+class Clock():
+    """Timestamp service that formats the wall clock at most once a second"""
+
+    def __init__(self, time_zone: str, time_format: str):
+        self.tz = ZoneInfo(time_zone)
+        self.time_format = time_format
+        #(epoch second, formatted text), swapped as one tuple so threads
+        #never see a second paired with another second's text
+        self.cache: tuple[int, str] = (-1, "")
+
+    @staticmethod
+    def epoch() -> int:
+        """Current wall-clock time as whole seconds since the epoch"""
+        return int(time.time())
+
+    @staticmethod
+    def monotonic_ns() -> int:
+        """Monotonic nanoseconds, for measuring intervals"""
+        return time.monotonic_ns()
+
+    def now(self) -> str:
+        """Current time in time_format, reused for the rest of the second"""
+        second = self.epoch()
+        cached_second, text = self.cache
+        if cached_second == second:
+            return text
+        text = datetime.datetime.fromtimestamp(second, tz=self.tz).strftime(
+            self.time_format)
+        self.cache = (second, text)
+        return text
@@ -0,0 +1,37 @@
+import ssl
+
+#A self-signed certificate to try it out locally, clients pass cert.pem
+#to --ca:
+#openssl req -x509 -newkey rsa:2048 -nodes -days 30 -keyout key.pem \
+#    -out cert.pem -subj "/CN=localhost" \
+#    -addext "subjectAltName=IP:127.0.0.1,DNS:localhost"
+
+#Seconds a client gets to finish its TLS handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+#How a handshake went, resumed ones skip the certificate and key exchange
+FULL = "full"
+RESUMED = "resumed"
+
+
+def client_context(cafile: str | None=None) -> ssl.SSLContext:
+    """Context that verifies the server, cafile is trusted on top"""
+    #A self-signed server certificate is its own CA, pass it as cafile
+    return ssl.create_default_context(cafile=cafile)
+
+
+def handshake_kind(tls: ssl.SSLSocket | ssl.SSLObject) -> str:
+    return RESUMED if tls.session_reused else FULL
+
+
+def server_context(certfile: str, keyfile: str | None=None) -> ssl.SSLContext:
+    """Context for accepted connections, keyfile defaults to certfile"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    #Renegotiation can have a write wait on a read, which none of the
+    #engines expect
+    context.options |= ssl.OP_NO_RENEGOTIATION
+    #Session tickets are on by default. Their keys are made with the
+    #context, so every process forked after this resumes the others'.
+    return context